@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""
+Sidecar offset index for random access to the transcripts of the
+concatenated alignments.mln and alignments.pgln files
+
+The index is a text file next to the alignments (<file>.idx):
+    #<kind>\t<size of the alignments file>\t<anchor>
+    <transcript id>\t<offset>\t<length>\t<comma separated organisms>
+with one line per group (mln) or block (pgln), in the order of the file.
+Transcripts with regions on several chromosomes have several groups, they
+are returned together. The index is written in one pass over the file, or
+while the batches are concatenated (transcript_cache.py --index).
+"""
+
+# imports
+import os
+import re
+import sys
+import mmap
+from argparse import ArgumentParser
+
+INDEX_SUFFIX = ".idx"
+
+KINDS = ("mln", "pgln")
+
+# last line of a block of the pgln file
+PGLN_END = b"\\\\\n"
+
+MLN_ID_RE = re.compile(rb'>(\S+)')
+MLN_ORGANISM_RE = re.compile(rb'>\S+\s+(\S+)', re.M)
+PGLN_NAME_RE = re.compile(rb'^>([^>\s]\S*)', re.M)
+
+
+class AlignmentIndexError(Exception):
+    """Raised for missing transcripts and for indices of other files"""
+    pass
+
+
+def kind_of(path):
+    """Kind of alignments from the extension of the file"""
+    kind = os.path.splitext(path)[1][1:]
+    if kind not in KINDS:
+        raise AlignmentIndexError("Cannot tell the kind of alignments of %s" % path)
+    return kind
+
+
+def iter_groups(lines, kind, anchor=""):
+    """Yield the transcript id and the lines of each group (mln) or block (pgln)
+
+    Groups of the mln file are separated by blank lines which belong to the
+    group, blocks of the pgln file start with >><anchor>_<id> and end with
+    a \\\\ line.
+    """
+    group = []
+    name = None
+    prefix = b">>" + anchor.encode() + b"_"
+    for line in lines:
+        if kind == "mln":
+            if line.strip():
+                if name is None:
+                    m = MLN_ID_RE.match(line)
+                    name = m.group(1).decode() if m else ""
+                group.append(line)
+            elif name is not None:
+                group.append(line)
+                yield name, b"".join(group)
+                group, name = [], None
+        else:
+            if line.startswith(prefix) and name is None:
+                name = line[len(prefix):].split()[0].decode()
+            if name is not None:
+                group.append(line)
+                if line == PGLN_END:
+                    yield name, b"".join(group)
+                    group, name = [], None
+    if name is not None:
+        yield name, b"".join(group)
+
+
+def group_organisms(name, data, kind):
+    """Organisms of a group (mln) or block (pgln), in the order of the alignment"""
+    if kind == "mln":
+        return [m.decode() for m in MLN_ORGANISM_RE.findall(data)]
+    suffix = "_" + name
+    return [m.decode()[:-len(suffix)] for m in PGLN_NAME_RE.findall(data)
+            if m.decode().endswith(suffix)]
+
+
+class IndexWriter(object):
+    """Collect the index entries of a file while it is written
+
+    add() is called with each group in the order of the file, offsets are
+    counted from the sizes of the groups and of the data between them.
+
+    """
+    def __init__(self, kind, anchor=""):
+        self.kind = kind
+        self.anchor = anchor
+        self.entries = []
+
+    def add(self, name, offset, data):
+        self.entries.append((name, offset, len(data), group_organisms(name, data, self.kind)))
+
+    def write(self, path, size):
+        """Write the index of an alignments file of size bytes"""
+        with open(path + ".tmp", 'w') as out:
+            out.write("#%s\t%i\t%s\n" % (self.kind, size, self.anchor))
+            for name, offset, length, organisms in self.entries:
+                out.write("%s\t%i\t%i\t%s\n" % (name, offset, length, ",".join(organisms)))
+        os.rename(path + ".tmp", path)
+
+
+def build_index(path, kind=None, anchor="", index_path=None):
+    """Index an alignments file in one pass and write the index next to it"""
+    kind = kind or kind_of(path)
+    index_path = index_path or path + INDEX_SUFFIX
+    writer = IndexWriter(kind, anchor)
+    position = [0]
+
+    def counted(fh):
+        for line in fh:
+            position[0] += len(line)
+            yield line
+
+    with open(path, 'rb') as fh:
+        # a group is complete once its last line is read
+        for name, data in iter_groups(counted(fh), kind, anchor):
+            writer.add(name, position[0] - len(data), data)
+    writer.write(index_path, os.path.getsize(path))
+    return index_path
+
+
+class AlignmentFile(object):
+    """Random access to the transcripts of an indexed alignments file
+
+    The file is memory mapped, get() and get_many() only touch the pages of
+    the requested transcripts.
+
+    """
+    def __init__(self, path, index_path=None):
+        self.path = path
+        index_path = index_path or path + INDEX_SUFFIX
+        self.groups = {}
+        self.organisms = {}
+        self.order = []
+        with open(index_path) as fh:
+            header = fh.readline().rstrip("\n").split("\t")
+            if len(header) != 3 or header[0][1:] not in KINDS:
+                raise AlignmentIndexError("%s is not an alignment index" % index_path)
+            self.kind, size, self.anchor = header[0][1:], int(header[1]), header[2]
+            for line in fh:
+                name, offset, length, organisms = line.rstrip("\n").split("\t")
+                if name not in self.groups:
+                    self.groups[name] = []
+                    self.organisms[name] = []
+                    self.order.append(name)
+                self.groups[name].append((int(offset), int(length)))
+                for organism in organisms.split(","):
+                    if organism and organism not in self.organisms[name]:
+                        self.organisms[name].append(organism)
+        if os.path.getsize(path) != size:
+            raise AlignmentIndexError("%s does not index the current %s" % (index_path, path))
+        self.fh = open(path, 'rb')
+        self.data = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def get_bytes(self, name):
+        """Groups (mln) or blocks (pgln) of a transcript as in the file"""
+        try:
+            groups = self.groups[name]
+        except KeyError:
+            raise AlignmentIndexError("%s is not in %s" % (name, self.path))
+        return b"".join(self.data[offset:offset + length] for offset, length in groups)
+
+    def get(self, name):
+        """Text of the groups (mln) or blocks (pgln) of a transcript"""
+        return self.get_bytes(name).decode()
+
+    def get_alignments(self, name):
+        """Parsed alignments of a transcript
+
+        :returns: mln: {organism: [query, target]} like read_mln_to_dict,
+                  pgln: {sequence name: aligned sequence}
+
+        """
+        lines = self.get(name).splitlines()
+        alignments = {}
+        i = 0
+        while i < len(lines):
+            line = lines[i].rstrip()
+            if not line.startswith(">"):
+                i += 1
+            elif self.kind == "mln":
+                alignments[line.split(" ")[-1]] = [lines[i + 1].rstrip(), lines[i + 2].rstrip()]
+                i += 3
+            else:
+                alignments[line.lstrip(">")] = lines[i + 1].rstrip()
+                i += 2
+        return alignments
+
+    def get_many(self, names):
+        """Fetch several transcripts, reading the file in order
+
+        :returns: dictionary transcript id -> text
+
+        """
+        names = sorted(set(names), key=lambda name: self.groups[name][0][0] if name in self.groups else -1)
+        return dict((name, self.get(name)) for name in names)
+
+    def iter_range(self, start=0, stop=None):
+        """Yield (transcript id, text) of the transcripts start to stop (excluded) in file order"""
+        for name in self.order[start:stop]:
+            yield name, self.get(name)
+
+    def keys(self):
+        return list(self.order)
+
+    def __contains__(self, name):
+        return name in self.groups
+
+    def __len__(self):
+        return len(self.order)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--alignments",
+                        dest="alignments",
+                        required=True,
+                        help="alignments.mln or alignments.pgln file")
+    parser.add_argument("--kind",
+                        dest="kind",
+                        choices=KINDS,
+                        default=None,
+                        help="Kind of alignments, defaults to the extension of the file")
+    parser.add_argument("--anchor",
+                        dest="anchor",
+                        default="",
+                        help="Anchor (reference) assembly, prefix of the ids in pgln files")
+    parser.add_argument("--build",
+                        dest="build",
+                        action="store_true",
+                        default=False,
+                        help="Write the index next to the alignments")
+    parser.add_argument("--transcript",
+                        dest="transcript",
+                        default=None,
+                        help="Print the alignments of this transcript, list all\n"
+                             "transcripts and their organisms if not given")
+    options = parser.parse_args()
+
+    try:
+        if options.build:
+            build_index(options.alignments, options.kind, options.anchor)
+            return
+        with AlignmentFile(options.alignments) as alignments:
+            if options.transcript is None:
+                for name in alignments.keys():
+                    sys.stdout.write("%s\t%s\n" % (name, ",".join(alignments.organisms[name])))
+            else:
+                sys.stdout.write(alignments.get(options.transcript))
+    except AlignmentIndexError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.stderr.write("Interrupted by user\n")
+        sys.exit(1)
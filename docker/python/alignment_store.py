@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+Single indexed file holding the per-species query/target alignments of
+many transcripts, as an alternative to one pickle file per transcript
+
+Layout of the file (all integers little endian):
+    header: magic, offset of the hash table, number of slots, number of keys
+    records: key length (uint16), key, zlib compressed alignments
+    hash table: slots of (64 bit key hash, record offset, record length),
+                open addressing with linear probing, empty slots have offset 0
+
+The alignments of a transcript are encoded as "species\tquery\ttarget\n"
+lines before compression and decoded into the same {species: [query, target]}
+dictionary that rg_divide_alignment_file.py pickles.
+"""
+
+# imports
+import sys
+import mmap
+import zlib
+import struct
+import hashlib
+from argparse import ArgumentParser
+
+MAGIC = b'MZGALN01'
+HEADER = struct.Struct('<8sQQQ')
+SLOT = struct.Struct('<QQQ')
+KEY_LENGTH = struct.Struct('<H')
+
+
+def key_hash(key):
+    """Stable 64 bit hash of a transcript name"""
+    return struct.unpack('<Q', hashlib.blake2b(key.encode(), digest_size=8).digest())[0]
+
+
+def encode_alignments(alignments):
+    """Encode and compress a {species: [query, target]} dictionary"""
+    text = "".join("%s\t%s\t%s\n" % (species, query, target)
+                   for species, (query, target) in sorted(alignments.items()))
+    return zlib.compress(text.encode(), 1)
+
+
+def decode_alignments(data):
+    """Inverse of encode_alignments"""
+    alignments = {}
+    for line in zlib.decompress(data).decode().splitlines():
+        species, query, target = line.split("\t")
+        alignments[species] = [query, target]
+    return alignments
+
+
+class AlignmentStoreWriter(object):
+    """Append transcripts to a new alignment store
+
+    Records are written as they are added, only the hashes and offsets are
+    kept in memory until the hash table is written by close(). A transcript
+    that is added again replaces the earlier one, like a file that is
+    written again in the output directory.
+
+    """
+
+    def __init__(self, path):
+        self.fh = open(path, 'wb')
+        self.fh.write(HEADER.pack(MAGIC, 0, 0, 0))
+        self.entries = {}
+
+    def add(self, name, alignments):
+        """Write the alignments of transcript name"""
+        key = name.encode()
+        record = KEY_LENGTH.pack(len(key)) + key + encode_alignments(alignments)
+        self.entries[name] = (key_hash(name), self.fh.tell(), len(record))
+        self.fh.write(record)
+
+    def close(self):
+        """Write the hash table and the header"""
+        slots = 1
+        while slots < 2 * len(self.entries):
+            slots *= 2
+        table = [None] * slots
+        for entry in self.entries.values():
+            i = entry[0] % slots
+            while table[i] is not None:
+                i = (i + 1) % slots
+            table[i] = entry
+        table_offset = self.fh.tell()
+        empty = SLOT.pack(0, 0, 0)
+        self.fh.write(b"".join(SLOT.pack(*entry) if entry is not None else empty
+                               for entry in table))
+        self.fh.seek(0)
+        self.fh.write(HEADER.pack(MAGIC, table_offset, slots, len(self.entries)))
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AlignmentStore(object):
+    """Read only access to an alignment store
+
+    The file is memory mapped and a lookup reads one hash table slot
+    (plus collisions) and one record, independent of the number of
+    transcripts in the store.
+
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.table_offset, self.slots, self.count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise Exception("%s is not an alignment store" % path)
+
+    def slot(self, i):
+        return SLOT.unpack_from(self.data, self.table_offset + i * SLOT.size)
+
+    def record(self, offset, length):
+        key_length = KEY_LENGTH.unpack_from(self.data, offset)[0]
+        start = offset + KEY_LENGTH.size
+        return (self.data[start:start + key_length].decode(),
+                self.data[start + key_length:offset + length])
+
+    def get(self, name):
+        """Return the {species: [query, target]} alignments of a transcript
+
+        :raises KeyError: if the transcript is not in the store
+
+        """
+        if self.slots:
+            h = key_hash(name)
+            i = h % self.slots
+            while True:
+                slot_hash, offset, length = self.slot(i)
+                if offset == 0:
+                    break
+                if slot_hash == h:
+                    key, data = self.record(offset, length)
+                    if key == name:
+                        return decode_alignments(data)
+                i = (i + 1) % self.slots
+        raise KeyError(name)
+
+    __getitem__ = get
+
+    def __contains__(self, name):
+        try:
+            self.get(name)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def keys(self):
+        """Transcript names in the order they were added"""
+        entries = [self.slot(i) for i in range(self.slots)]
+        return [self.record(offset, length)[0]
+                for slot_hash, offset, length in sorted(entries, key=lambda e: e[1])
+                if offset != 0]
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--store",
+                        dest="store",
+                        required=True,
+                        help="Alignment store written by rg_divide_alignment_file.py")
+    parser.add_argument("--transcript",
+                        dest="transcript",
+                        default=None,
+                        help="Print the alignments of this transcript, list all\n"
+                             "transcripts if not given")
+    options = parser.parse_args()
+
+    with AlignmentStore(options.store) as store:
+        if options.transcript is None:
+            for name in store.keys():
+                sys.stdout.write(name + "\n")
+        else:
+            for species, (query, target) in sorted(store.get(options.transcript).items()):
+                sys.stdout.write("%s\n%s\n%s\n" % (species, query, target))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.stderr.write("Interrupted by user\n")
+        sys.exit(1)
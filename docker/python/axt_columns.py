@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+__version__ = "0.1"
+__doc__ = "Columnar, memory-mappable storage of the blocks of chromosome axt files"
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# import needed (external) modules
+# -----------------------------------------------------------------------------
+
+import sys
+import os
+import glob
+from collections import namedtuple
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import numpy as np
+import run_metrics
+from axt_index import GROUPED_CONTIGS
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Columnar storage
+# -----------------------------------------------------------------------------
+
+# suffix of the directory written next to each <chromosome>.axt file
+COLUMNS_SUFFIX = '.columns'
+
+# one .npy file per column, all of them can be opened with mmap_mode='r'.
+# Blocks are sorted by their start on the reference (1-based, inclusive);
+# number is the record number in the axt file, max_end the running maximum
+# of the ends, target_chromosome an index into target_names and the aligned
+# sequences of block i are reference_seq/target_seq[seq_offsets[i]:seq_offsets[i + 1]]
+AxtColumns = namedtuple('AxtColumns', [
+    'number',
+    'start',
+    'end',
+    'max_end',
+    'target_chromosome',
+    'target_start',
+    'target_end',
+    'strand',
+    'score',
+    'seq_offsets',
+    'reference_seq',
+    'target_seq',
+    'target_names'
+])
+
+
+def scan_axt(axt_path):
+
+    """
+    Read the headers of an axt file and return one tuple per block with
+    the header fields, the byte offset and the length of the alignment.
+    """
+
+    blocks = []
+    offset = 0
+    header = None
+    with open(axt_path, 'rb') as fh:
+        for line in fh:
+            if line[:1].isdigit():
+                header = line.split()
+                header_offset = offset
+            elif header is not None:
+                blocks.append((int(header[2]), int(header[0]), int(header[3]),
+                               header[4].decode(), int(header[5]), int(header[6]),
+                               -1 if header[7] == b'-' else 1, int(header[8]),
+                               header_offset, len(line.rstrip(b'\r\n'))))
+                header = None
+            offset += len(line)
+    blocks.sort()
+    return blocks
+
+
+def write_columns(axt_path, out=None):
+
+    """
+    Write the blocks of a chromosome axt file as numpy arrays into the
+    directory out, by default <chromosome>.axt.columns next to the axt file.
+    """
+
+    if out is None:
+        out = axt_path + COLUMNS_SUFFIX
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    blocks = scan_axt(axt_path)
+    target_names = sorted(set(b[3] for b in blocks))
+    target_index = dict((name, i) for i, name in enumerate(target_names))
+
+    start = np.array([b[0] for b in blocks], dtype=np.int64)
+    seq_offsets = np.zeros(len(blocks) + 1, dtype=np.int64)
+    np.cumsum([b[9] for b in blocks], out=seq_offsets[1:])
+    columns = {
+        'number': np.array([b[1] for b in blocks], dtype=np.int64),
+        'start': start,
+        'end': np.array([b[2] for b in blocks], dtype=np.int64),
+        'target_chromosome': np.array([target_index[b[3]] for b in blocks], dtype=np.int32),
+        'target_start': np.array([b[4] for b in blocks], dtype=np.int64),
+        'target_end': np.array([b[5] for b in blocks], dtype=np.int64),
+        'strand': np.array([b[6] for b in blocks], dtype=np.int8),
+        'score': np.array([b[7] for b in blocks], dtype=np.int64),
+        'seq_offsets': seq_offsets,
+        'target_names': np.array(target_names, dtype=np.str_)
+    }
+    columns['max_end'] = np.maximum.accumulate(columns['end'])
+    for name, values in columns.items():
+        np.save(os.path.join(out, name + '.npy'), values)
+
+    # fill the sequence buffers in the sorted block order
+    size = int(seq_offsets[-1])
+    reference_seq = np.lib.format.open_memmap(
+        os.path.join(out, 'reference_seq.npy'), mode='w+', dtype=np.uint8, shape=(size,))
+    target_seq = np.lib.format.open_memmap(
+        os.path.join(out, 'target_seq.npy'), mode='w+', dtype=np.uint8, shape=(size,))
+    with open(axt_path, 'rb') as fh:
+        for i, block in enumerate(blocks):
+            fh.seek(block[8])
+            fh.readline()
+            length = block[9]
+            reference_seq[seq_offsets[i]:seq_offsets[i + 1]] = np.frombuffer(fh.readline(), np.uint8, length)
+            target_seq[seq_offsets[i]:seq_offsets[i + 1]] = np.frombuffer(fh.readline(), np.uint8, length)
+    reference_seq.flush()
+    target_seq.flush()
+    del reference_seq, target_seq
+    return out
+
+
+def load_columns(path):
+
+    """ Open all columns written by write_columns as read only memmaps """
+
+    return AxtColumns(*[np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                        for name in AxtColumns._fields])
+
+
+def overlapping_blocks(columns, start, end):
+
+    """
+    Return the indices of the blocks that overlap the reference interval
+    start..end (1-based, inclusive).
+    """
+
+    last = np.searchsorted(columns.start, end, side='right')
+    first = np.searchsorted(columns.max_end[:last], start, side='left')
+    candidates = np.arange(first, last)
+    return candidates[columns.end[first:last] >= start]
+
+
+def block_alignment(columns, i):
+
+    """ Return the reference and target aligned sequences of block i """
+
+    begin, end = columns.seq_offsets[i], columns.seq_offsets[i + 1]
+    return (columns.reference_seq[begin:end].tobytes().decode(),
+            columns.target_seq[begin:end].tobytes().decode())
+
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Main function
+# -----------------------------------------------------------------------------
+
+
+def main():
+    """ Main function """
+
+    parser = ArgumentParser(
+        description=__doc__,
+        formatter_class=RawTextHelpFormatter
+    )
+
+    parser.add_argument(
+        "--alignment-dir",
+        dest="alignment_dir",
+        help="Directory with <chromosome>.axt files to convert",
+        required=True,
+        metavar="DIR"
+    )
+
+    run_metrics.add_argument(parser)
+
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        dest="verbose",
+        default=False,
+        required=False,
+        help="Verbose"
+    )
+
+    parser.add_argument(
+        '--version',
+        action='version',
+        version=__version__
+    )
+
+    # _________________________________________________________________________
+    # -------------------------------------------------------------------------
+    # get the arguments
+    # -------------------------------------------------------------------------
+    try:
+        options = parser.parse_args()
+    except(Exception):
+        parser.print_help()
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    metrics = run_metrics.Metrics(options.metrics)
+    metrics.start("write")
+    for axt_path in sorted(glob.glob(os.path.join(options.alignment_dir, '*.axt'))):
+        # small chromosomes grouped into one file by --group-contigs
+        if os.path.basename(axt_path) == GROUPED_CONTIGS:
+            continue
+        out = write_columns(axt_path)
+        metrics.count(1)
+        if options.verbose:
+            sys.stderr.write("Wrote %s%s" % (out, os.linesep))
+    metrics.close()
+
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Call the Main function and catch Keyboard interrups
+# -----------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.stderr.write("User interrupt!" + os.linesep)
+        sys.exit(0)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+__version__ = "0.1"
+__doc__ = "Interval index for random access to the blocks of a chromosome axt file"
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# import needed (external) modules
+# -----------------------------------------------------------------------------
+
+import sys
+import os
+import io
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from argparse import ArgumentParser, RawTextHelpFormatter
+import run_metrics
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Index
+# -----------------------------------------------------------------------------
+
+# suffix of the index written next to each <chromosome>.axt file
+INDEX_SUFFIX = '.idx'
+
+# magic number at the start of every index file
+INDEX_MAGIC = b'AXTIDX01'
+
+# file and index of the small chromosomes grouped by
+# split_pairwise_alignments_by_chromosome.py --group-contigs
+GROUPED_CONTIGS = 'contigs.axt'
+GROUPED_CONTIGS_INDEX = 'contigs.axt.index'
+
+# blocks sorted by their start on the reference, 1-based and inclusive as in
+# the axt header; max_ends[i] is the largest end of blocks 0..i and offsets
+# are the byte offsets of the block headers in the axt file
+AxtIndex = namedtuple('AxtIndex', ['starts', 'ends', 'max_ends', 'offsets'])
+
+
+def build_index(axt_path):
+
+    """ Scan a chromosome axt file once and return its interval index """
+
+    with open(axt_path, 'rb') as fh:
+        return index_lines(fh)
+
+
+def index_lines(lines):
+
+    """ Return the interval index of the lines (bytes) of an axt file """
+
+    blocks = []
+    offset = 0
+    for line in lines:
+        if line[:1].isdigit():
+            fields = line.split()
+            blocks.append((int(fields[2]), int(fields[3]), offset))
+        offset += len(line)
+    blocks.sort()
+
+    index = AxtIndex(array('q'), array('q'), array('q'), array('q'))
+    max_end = 0
+    for start, end, offset in blocks:
+        max_end = max(max_end, end)
+        index.starts.append(start)
+        index.ends.append(end)
+        index.max_ends.append(max_end)
+        index.offsets.append(offset)
+    return index
+
+
+def write_index(index, path):
+
+    """ Write the index columns as little endian int64 arrays """
+
+    with open(path, 'wb') as fh:
+        fh.write(INDEX_MAGIC)
+        fh.write(struct.pack('<Q', len(index.starts)))
+        for column in index:
+            if sys.byteorder == 'big':
+                column = array('q', column)
+                column.byteswap()
+            column.tofile(fh)
+
+
+def read_index(path):
+
+    """ Read an index written by write_index """
+
+    with open(path, 'rb') as fh:
+        if fh.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise Exception("%s is not an axt index file" % path)
+        size = struct.unpack('<Q', fh.read(8))[0]
+        columns = []
+        for _ in AxtIndex._fields:
+            column = array('q')
+            column.fromfile(fh, size)
+            if sys.byteorder == 'big':
+                column.byteswap()
+            columns.append(column)
+    return AxtIndex(*columns)
+
+
+def index_chromosome(axt_path):
+
+    """ Build the index of an axt file and write it next to it """
+
+    write_index(build_index(axt_path), axt_path + INDEX_SUFFIX)
+    return axt_path + INDEX_SUFFIX
+
+
+def merge_intervals(intervals):
+
+    """ Sort and merge overlapping or adjacent (start, end) intervals """
+
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def overlapping_offsets(index, intervals):
+
+    """
+    Return the sorted byte offsets of all blocks that overlap at least one of
+    the (start, end) intervals (1-based, inclusive).
+    """
+
+    offsets = set()
+    for start, end in merge_intervals(intervals):
+        # blocks starting after the interval cannot overlap it and the
+        # running maximum of the ends skips blocks that end before it
+        last = bisect_right(index.starts, end)
+        first = bisect_left(index.max_ends, start, 0, last)
+        for i in range(first, last):
+            if index.ends[i] >= start:
+                offsets.add(index.offsets[i])
+    return sorted(offsets)
+
+
+def read_grouped_chromosome(alignment_dir, chromosome):
+
+    """
+    Return the alignments of a chromosome that was grouped into the
+    contigs.axt file of alignment_dir, raise KeyError if it was not
+    """
+
+    index_path = os.path.join(alignment_dir, GROUPED_CONTIGS_INDEX)
+    if not os.path.exists(index_path):
+        raise KeyError(chromosome)
+    with open(index_path) as index:
+        for line in index:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] == chromosome:
+                with open(os.path.join(alignment_dir, GROUPED_CONTIGS), 'rb') as fp:
+                    fp.seek(int(fields[1]))
+                    return fp.read(int(fields[2])).decode()
+    raise KeyError(chromosome)
+
+
+def fetch_blocks(axt_path, intervals, index=None):
+
+    """
+    Fetch blocks generator:
+    Yield (name, alignment1, alignment2) of the blocks of axt_path that
+    overlap the intervals, in the order of the axt file. The index is read
+    from the file next to axt_path unless it is given.
+    """
+
+    if index is None:
+        index = read_index(axt_path + INDEX_SUFFIX)
+    with open(axt_path, 'rb') as fh:
+        for block in fetch_file_blocks(fh, intervals, index):
+            yield block
+
+
+def fetch_file_blocks(fh, intervals, index):
+
+    """ Yield the blocks of the open (binary) axt file fh, see fetch_blocks """
+
+    for offset in overlapping_offsets(index, intervals):
+        fh.seek(offset)
+        name = fh.readline().decode()
+        alignment1 = fh.readline().decode()
+        alignment2 = fh.readline().decode()
+        yield (name, alignment1, alignment2)
+
+
+def read_regions(path):
+
+    """ Read a match.tab file and return the exon intervals per chromosome """
+
+    regions = {}
+    with open(path) as fp:
+        for line in fp:
+            fields = line.split('\t')
+            if len(fields) < 4:
+                continue
+            regions.setdefault(fields[1], []).append((int(fields[2]), int(fields[3])))
+    return regions
+
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Main function
+# -----------------------------------------------------------------------------
+
+
+def main():
+    """ Main function """
+
+    parser = ArgumentParser(
+        description=__doc__ + os.linesep +
+        "Write the blocks of the chromosome axt files that overlap the regions " +
+        "of a match.tab file into a new alignment directory",
+        formatter_class=RawTextHelpFormatter
+    )
+
+    parser.add_argument(
+        "--alignment-dir",
+        dest="alignment_dir",
+        help="Directory with the indexed <chromosome>.axt files",
+        required=True,
+        metavar="DIR"
+    )
+
+    parser.add_argument(
+        "--regions",
+        dest="regions",
+        help="Regions in match.tab format",
+        required=True,
+        metavar="FILE"
+    )
+
+    parser.add_argument(
+        "--out",
+        dest="out",
+        help="Output directory",
+        required=True,
+        metavar="DIR"
+    )
+
+    run_metrics.add_argument(parser)
+
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        dest="verbose",
+        default=False,
+        required=False,
+        help="Verbose"
+    )
+
+    parser.add_argument(
+        '--version',
+        action='version',
+        version=__version__
+    )
+
+    # _________________________________________________________________________
+    # -------------------------------------------------------------------------
+    # get the arguments
+    # -------------------------------------------------------------------------
+    try:
+        options = parser.parse_args()
+    except(Exception):
+        parser.print_help()
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    if not os.path.exists(options.out):
+        os.makedirs(options.out)
+
+    metrics = run_metrics.Metrics(options.metrics)
+    for chromosome, intervals in sorted(read_regions(options.regions).items()):
+        axt_path = os.path.join(options.alignment_dir, chromosome + '.axt')
+        metrics.start("index")
+        if os.path.exists(axt_path):
+            fh = open(axt_path, 'rb')
+            if os.path.exists(axt_path + INDEX_SUFFIX):
+                index = read_index(axt_path + INDEX_SUFFIX)
+            else:
+                index = index_lines(fh)
+        else:
+            # small chromosomes may be grouped into contigs.axt
+            try:
+                fh = io.BytesIO(read_grouped_chromosome(options.alignment_dir, chromosome).encode())
+            except KeyError:
+                continue
+            index = index_lines(fh)
+        metrics.count(1)
+        metrics.start("write")
+        blocks = 0
+        with fh, open(os.path.join(options.out, chromosome + '.axt'), 'w') as w:
+            for name, alignment1, alignment2 in fetch_file_blocks(fh, intervals, index):
+                w.write(name)
+                w.write(alignment1)
+                w.write(alignment2)
+                w.write(os.linesep)
+                blocks += 1
+        metrics.count(blocks)
+        if options.verbose:
+            sys.stderr.write("%s: %i of %i blocks%s" % (chromosome, blocks, len(index.starts), os.linesep))
+    metrics.close()
+
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Call the Main function and catch Keyboard interrups
+# -----------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.stderr.write("User interrupt!" + os.linesep)
+        sys.exit(0)
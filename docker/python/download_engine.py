@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+__version__ = "0.1"
+__doc__ = "Concurrent, resumable downloads with verification and a local content-addressed cache"
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# import needed (external) modules
+# -----------------------------------------------------------------------------
+
+import sys
+import os
+import json
+import shutil
+import hashlib
+import posixpath
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Download engine
+# -----------------------------------------------------------------------------
+
+# size of the blocks read from the network and from files
+BLOCK_SIZE = 1024 * 1024
+
+# suffix of partially downloaded files, kept to resume the download
+PART_SUFFIX = ".part"
+
+# name of the checksum file in the UCSC download directories
+MD5SUM_FILE = "md5sum.txt"
+
+
+class DownloadError(Exception):
+    """ Raised when a file cannot be downloaded or verified """
+    pass
+
+
+def file_md5(path, size=None):
+
+    """ Return the md5 of the first size bytes (default all) of a file """
+
+    md5 = hashlib.md5()
+    remaining = size
+    with open(path, 'rb') as fh:
+        while remaining is None or remaining > 0:
+            block = fh.read(BLOCK_SIZE if remaining is None else min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            md5.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return md5
+
+
+def remote_md5sums(url, timeout=60):
+
+    """
+    Read the md5sum.txt of the remote directory of url and return a
+    dictionary file name -> md5. Returns an empty dictionary if the
+    directory has no checksum file.
+    """
+
+    md5sum_url = posixpath.join(posixpath.dirname(url), MD5SUM_FILE)
+    try:
+        with urllib.request.urlopen(md5sum_url, timeout=timeout) as response:
+            text = response.read().decode()
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return {}
+        raise
+    md5sums = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            md5sums[fields[1].lstrip("*")] = fields[0]
+    return md5sums
+
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Content-addressed cache
+# -----------------------------------------------------------------------------
+
+def cache_object_path(cache_dir, md5):
+
+    """ Path of the cached file with the given md5 """
+
+    return os.path.join(cache_dir, "objects", md5[:2], md5)
+
+
+def cache_url_path(cache_dir, url):
+
+    """ Path of the record that maps url to the md5 of its content """
+
+    return os.path.join(cache_dir, "urls", hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+
+def cache_lookup(cache_dir, url, md5=None):
+
+    """
+    Return the path of the cached content of url (or of the content with
+    the given md5) or None if it is not cached.
+    """
+
+    if md5 is None:
+        try:
+            with open(cache_url_path(cache_dir, url)) as fp:
+                md5 = json.load(fp)["md5"]
+        except (IOError, ValueError, KeyError):
+            return None
+    path = cache_object_path(cache_dir, md5)
+    return path if os.path.exists(path) else None
+
+
+def place_file(source, destination):
+
+    """ Hard link source to destination, copy it on another file system """
+
+    tmp = destination + PART_SUFFIX
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.rename(tmp, destination)
+
+
+def cache_store(cache_dir, url, path, md5, size):
+
+    """ Add a downloaded file to the cache """
+
+    obj = cache_object_path(cache_dir, md5)
+    if not os.path.exists(obj):
+        if not os.path.exists(os.path.dirname(obj)):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+        place_file(path, obj)
+    record = cache_url_path(cache_dir, url)
+    if not os.path.exists(os.path.dirname(record)):
+        os.makedirs(os.path.dirname(record), exist_ok=True)
+    with open(record + PART_SUFFIX, 'w') as fp:
+        json.dump({"url": url, "md5": md5, "size": size}, fp)
+    os.rename(record + PART_SUFFIX, record)
+
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Downloads
+# -----------------------------------------------------------------------------
+
+def fetch(url, destination, timeout=60):
+
+    """
+    Download url to destination, resuming a partial <destination>.part
+    with an HTTP Range request. The file is renamed to destination once
+    its size matches the size announced by the server.
+    Returns the md5 of the downloaded file.
+    """
+
+    part = destination + PART_SUFFIX
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header("Range", "bytes=%i-" % offset)
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code != 416 or not offset:
+            raise
+        # the range starts at the end of the remote file (Content-Range:
+        # bytes */<size>), the partial file is complete if it has its size
+        total = (e.headers.get("Content-Range", "") if e.headers else "").split("/")[-1]
+        e.close()
+        if total.isdigit() and int(total) == offset:
+            os.rename(part, destination)
+            return file_md5(destination).hexdigest()
+        # the remote file shrank or was replaced, download it again
+        os.remove(part)
+        return fetch(url, destination, timeout)
+
+    with response:
+        if response.status == 206:
+            # Content-Range: bytes <start>-<end>/<size>
+            content_range = response.headers.get("Content-Range", "")
+            start = int(content_range.split(" ")[-1].split("-")[0])
+            if start != offset:
+                raise DownloadError("Unexpected range %s for %s" % (content_range, url))
+            total = content_range.split("/")[-1]
+            md5 = file_md5(part)
+            mode = 'ab'
+        else:
+            offset = 0
+            total = response.headers.get("Content-Length")
+            md5 = hashlib.md5()
+            mode = 'wb'
+        total = int(total) if total not in (None, "*") else None
+
+        with open(part, mode) as fh:
+            while True:
+                block = response.read(BLOCK_SIZE)
+                if not block:
+                    break
+                fh.write(block)
+                md5.update(block)
+
+    size = os.path.getsize(part)
+    if total is not None and size != total:
+        raise DownloadError("Incomplete download of %s: %i of %i bytes" % (url, size, total))
+    os.rename(part, destination)
+    return md5.hexdigest()
+
+
+def download(url, destination, cache_dir=None, expected_md5=None, retries=3,
+             timeout=60, verbose=False):
+
+    """
+    Download url to destination:
+    The content is taken from the cache if it is there, otherwise it is
+    downloaded (resuming partial downloads, up to retries attempts),
+    verified against expected_md5 if given and added to the cache.
+    Raises DownloadError if the file cannot be downloaded or verified.
+    """
+
+    directory = os.path.dirname(destination)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    if cache_dir is not None:
+        cached = cache_lookup(cache_dir, url, expected_md5)
+        if cached is not None:
+            if verbose:
+                sys.stdout.write("Using cached " + url + os.linesep)
+            place_file(cached, destination)
+            return destination
+
+    error = None
+    for attempt in range(1, retries + 1):
+        try:
+            if verbose:
+                sys.stdout.write("Downloading %s (attempt %i)%s" % (url, attempt, os.linesep))
+            md5 = fetch(url, destination, timeout)
+        except urllib.error.HTTPError as e:
+            # missing files and other client errors do not go away by retrying
+            if 400 <= e.code < 500 and e.code not in (408, 429):
+                raise DownloadError("Could not download %s: %s" % (url, e))
+            error = e
+            continue
+        except (IOError, DownloadError) as e:
+            error = e
+            continue
+        if expected_md5 is not None and md5 != expected_md5:
+            os.remove(destination)
+            error = DownloadError("Checksum mismatch for %s: %s instead of %s" % (url, md5, expected_md5))
+            continue
+        if cache_dir is not None:
+            cache_store(cache_dir, url, destination, md5, os.path.getsize(destination))
+        return destination
+
+    raise DownloadError("Could not download %s: %s" % (url, error))
+
+
+def download_all(jobs, threads=4, cache_dir=None, verify_md5=False, retries=3,
+                 timeout=60, verbose=False):
+
+    """
+    Download (url, destination) jobs with a pool of threads. With
+    verify_md5 the files are checked against the md5sum.txt of their
+    remote directory, where it exists.
+    Returns a list of (url, DownloadError) for the jobs that failed.
+    """
+
+    md5sums = {}
+
+    def run(job):
+        url, destination = job
+        expected_md5 = None
+        # files in the cache were verified before they were added
+        cached = cache_dir is not None and cache_lookup(cache_dir, url) is not None
+        if verify_md5 and not cached:
+            directory = posixpath.dirname(url)
+            if directory not in md5sums:
+                md5sums[directory] = remote_md5sums(url, timeout)
+            expected_md5 = md5sums[directory].get(posixpath.basename(url))
+        download(url, destination, cache_dir, expected_md5, retries, timeout, verbose)
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [(job, executor.submit(run, job)) for job in jobs]
+        for (url, destination), future in futures:
+            try:
+                future.result()
+            except DownloadError as e:
+                failures.append((url, e))
+            except (IOError, ValueError) as e:
+                failures.append((url, DownloadError("Could not download %s: %s" % (url, e))))
+    return failures
@@ -12,7 +12,8 @@ __doc__ = "Download pairwise alignments from ucsc"
 
 import sys
 import os
-import wget
+from download_engine import download_all
+import run_metrics
 from argparse import ArgumentParser, RawTextHelpFormatter
 
 # _____________________________________________________________________________
@@ -66,6 +67,35 @@ def main():
         metavar="FILE"
     )
 
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        help="Directory of a local cache of downloaded files, shared between runs",
+        required=False,
+        default=None,
+        metavar="DIR"
+    )
+
+    parser.add_argument(
+        "--verify-md5",
+        action="store_true",
+        dest="verify_md5",
+        default=False,
+        required=False,
+        help="Verify the files against the md5sum.txt of the UCSC directory"
+    )
+
+    parser.add_argument(
+        "--retries",
+        dest="retries",
+        type=int,
+        default=3,
+        required=False,
+        help="Number of attempts per file, partial downloads are resumed (default 3)"
+    )
+
+    run_metrics.add_argument(parser)
+
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -97,7 +127,7 @@ def main():
     # Get the needed assembly from file
     try:
         with open(options.assemblies) as f:
-            assemblies = f.read().split(',')
+            assemblies = [x.strip() for x in f.read().split(',')]
             org_version = [x for x in assemblies if options.organism_to_download.lower() in x.lower()]
             if not org_version:
                 print("Organism to download not in provided assembly list!")
@@ -106,8 +136,9 @@ def main():
                 print("Multiple versions for organism to download given in assembly list!")
                 sys.exit(1)
             org_version = org_version[0]
-    except:
-        sys.stderr.write("Couldn't load assemblies file.")
+    except IOError as e:
+        sys.stderr.write("Couldn't load assemblies file: %s%s" % (e, os.linesep))
+        sys.exit(1)
 
     start = options.organism_link
     f_s_l = org_version
@@ -120,12 +151,20 @@ def main():
         os.makedirs(output_dir)
 
     download_link = os.path.join(start + f_s, remote_file_name)
-    try:
-        if options.verbose:
-            sys.stdout.write("Downloading " + download_link + os.linesep)
-        wget.download(download_link, os.path.join(output_dir, out_file_name))
-    except:
-        sys.stderr.write("Could not download " + download_link + os.linesep)
+    metrics = run_metrics.Metrics(options.metrics)
+    metrics.start("download")
+    metrics.count(1)
+    failures = download_all([(download_link, os.path.join(output_dir, out_file_name))],
+                            threads=1,
+                            cache_dir=options.cache_dir,
+                            verify_md5=options.verify_md5,
+                            retries=options.retries,
+                            verbose=options.verbose)
+    for url, error in failures:
+        sys.stderr.write(str(error) + os.linesep)
+    if failures:
+        sys.exit(1)
+    metrics.close()
 
 # _____________________________________________________________________________
 # -----------------------------------------------------------------------------
@@ -12,7 +12,8 @@ __doc__ = "Download pairwise alignments from ucsc"
 
 import sys
 import os
-import wget
+from download_engine import download_all
+import run_metrics
 from argparse import ArgumentParser, RawTextHelpFormatter
 
 # _____________________________________________________________________________
@@ -53,6 +54,52 @@ def main():
         metavar="FILE"
     )
 
+    parser.add_argument(
+        "--base-url",
+        dest="base_url",
+        help="Base URL of the download server (default %(default)s)",
+        required=False,
+        default="http://hgdownload.soe.ucsc.edu/goldenPath/"
+    )
+
+    parser.add_argument(
+        "--threads",
+        dest="threads",
+        type=int,
+        default=4,
+        required=False,
+        help="Number of files downloaded in parallel (default 4)"
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        help="Directory of a local cache of downloaded files, shared between runs",
+        required=False,
+        default=None,
+        metavar="DIR"
+    )
+
+    parser.add_argument(
+        "--verify-md5",
+        action="store_true",
+        dest="verify_md5",
+        default=False,
+        required=False,
+        help="Verify the files against the md5sum.txt of the UCSC directory"
+    )
+
+    parser.add_argument(
+        "--retries",
+        dest="retries",
+        type=int,
+        default=3,
+        required=False,
+        help="Number of attempts per file, partial downloads are resumed (default 3)"
+    )
+
+    run_metrics.add_argument(parser)
+
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -81,22 +128,35 @@ def main():
         parser.print_help()
         sys.exit(1)
 
-    start = "http://hgdownload.soe.ucsc.edu/goldenPath/" + options.organism + "/vs"
+    start = options.base_url.rstrip("/") + "/" + options.organism + "/vs"
+    jobs = []
     with open(options.organisms) as fp:
         for f in fp:
             f_s = f.strip()
+            if not f_s:
+                continue
             f_s_l = f_s[0].lower() + f_s[1:]
             output_dir = os.path.join(options.out, options.organism + "_to_" + f_s_l)
             file_name = options.organism + "." + f_s_l + ".net.axt.gz"
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
             download_link = start + f_s + "/" + file_name
-            try:
-                if options.verbose:
-                    sys.stdout.write("Downloading " + download_link + os.linesep)
-                wget.download(download_link, os.path.join(output_dir, file_name))
-            except:
-                sys.stderr.write("Could not download " + download_link + os.linesep)
+            jobs.append((download_link, os.path.join(output_dir, file_name)))
+
+    metrics = run_metrics.Metrics(options.metrics)
+    metrics.start("download")
+    metrics.count(len(jobs))
+    failures = download_all(jobs,
+                            threads=options.threads,
+                            cache_dir=options.cache_dir,
+                            verify_md5=options.verify_md5,
+                            retries=options.retries,
+                            verbose=options.verbose)
+    for url, error in failures:
+        sys.stderr.write(str(error) + os.linesep)
+    if failures:
+        sys.exit(1)
+    metrics.close()
 
 
 
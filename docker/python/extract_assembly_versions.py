@@ -12,10 +12,157 @@ __doc__ = "Extract the assembly versions for a set of species for which pairwise
 
 import sys
 import os
-import wget
-from argparse import ArgumentParser, RawTextHelpFormatter
-import random
 import re
+import json
+import time
+import hashlib
+import functools
+import urllib.error
+import urllib.request
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import newick
+import run_metrics
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Discovery of the available pairwise alignments
+# -----------------------------------------------------------------------------
+
+#directories with pairwise alignments look like this <a href="vsMm10/">vsMm10/</a>
+DIR_RE = re.compile(r'<a\s+href="vs([a-zA-Z]+\d+)/"')
+
+#name and version of an assembly, e.g. mm10 -> (mm, 10)
+ASSEMBLY_RE = re.compile(r'([a-zA-Z]+)(\d+)')
+
+
+def parse_listing(html):
+
+    """ Return the assemblies (e.g. Mm10) of the vsXxxN directories of a listing """
+
+    return DIR_RE.findall(html)
+
+
+def cache_path(cache_dir, url):
+
+    """ Path of the cached listing of url """
+
+    return os.path.join(cache_dir, "listing_" + hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+
+def read_cache(path):
+
+    """ Return the cached listing entry or None """
+
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def write_cache(path, entry):
+
+    """ Atomically replace the cached listing, concurrent runs may share it """
+
+    tmp = "%s.%i.tmp" % (path, os.getpid())
+    with open(tmp, 'w') as fp:
+        json.dump(entry, fp)
+    os.rename(tmp, path)
+
+
+@functools.lru_cache(maxsize=None)
+def assembly_directories(url, cache_dir=None, ttl=86400, timeout=60):
+
+    """
+    Return the assemblies with pairwise alignments in the remote directory.
+
+    With a cache_dir the parsed listing is kept for ttl seconds; after that
+    it is revalidated with If-None-Match / If-Modified-Since and only
+    downloaded again if it changed. A stale listing is used if the server
+    cannot be reached. Results are memoized per process.
+    """
+
+    entry = None
+    path = None
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        path = cache_path(cache_dir, url)
+        entry = read_cache(path)
+        if entry is not None and time.time() - entry["fetched"] < ttl:
+            return tuple(entry["directories"])
+
+    request = urllib.request.Request(url)
+    if entry is not None:
+        if entry.get("etag"):
+            request.add_header("If-None-Match", entry["etag"])
+        if entry.get("last_modified"):
+            request.add_header("If-Modified-Since", entry["last_modified"])
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            directories = parse_listing(response.read().decode("utf-8", "replace"))
+            headers = response.headers
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            # unchanged, the cached listing is valid for another ttl
+            entry["fetched"] = time.time()
+            write_cache(path, entry)
+            return tuple(entry["directories"])
+        if e.code < 500 or entry is None:
+            raise
+        sys.stderr.write("Could not get %s (%s), using cached listing%s" % (url, e, os.linesep))
+        return tuple(entry["directories"])
+    except urllib.error.URLError as e:
+        if entry is None:
+            raise
+        sys.stderr.write("Could not reach %s (%s), using cached listing%s" % (url, e.reason, os.linesep))
+        return tuple(entry["directories"])
+
+    if path is not None:
+        write_cache(path, {
+            "url": url,
+            "fetched": time.time(),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "directories": directories
+        })
+    return tuple(directories)
+
+
+def latest_versions(directories, species):
+
+    """
+    For each of the species identify the most recent assembly version
+    (highest index value) among the directories
+    """
+
+    species = set(species)
+    versions = {}
+    for directory in directories:
+        m = ASSEMBLY_RE.match(directory)
+        #in the directory name, first letter of assembly name is cap, in the species tree is lower case
+        assembly = m.group(1)
+        assembly = assembly[0].lower() + assembly[1:]
+        version = int(m.group(2))
+        if assembly in species and versions.get(assembly, -1) < version:
+            versions[assembly] = version
+    return versions
+
+
+def rewrite_tree(tree, versions):
+
+    """
+    Replace the assembly versions of the species in the tree with the
+    given versions, in one pass over the tree
+    """
+
+    if not versions:
+        return tree
+    #longest names first so that no species is matched by a prefix of another
+    names = sorted(versions, key=lambda name: (-len(name), name))
+    versionRe = re.compile(r'(?<![a-zA-Z])(' + "|".join(map(re.escape, names)) + r')\d+')
+    return versionRe.sub(lambda m: m.group(1) + str(versions[m.group(1)]), tree)
 
 # _____________________________________________________________________________
 # -----------------------------------------------------------------------------
@@ -76,6 +223,36 @@ def main():
         metavar="FILE"
     )
 
+    parser.add_argument(
+        "--out_pruned_tree",
+        dest="out_pruned_tree",
+        help="path to output tree with only the reference and the found assemblies",
+        required=False,
+        default=None,
+        metavar="FILE"
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        help="Directory where the parsed listing of --remote_dir is cached,\n"
+             "can be shared by concurrent runs",
+        required=False,
+        default=None,
+        metavar="DIR"
+    )
+
+    parser.add_argument(
+        "--cache-ttl",
+        dest="cache_ttl",
+        type=int,
+        help="Seconds before a cached listing is revalidated (default 86400)",
+        required=False,
+        default=86400
+    )
+
+    run_metrics.add_argument(parser)
+
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -108,19 +285,6 @@ def main():
     refAssembly = options.reference
     speciesList = options.species_to_download
 
-    #get the content of the directory containing pairwise alignments
-    output_dir = os.path.dirname(options.phylogenetic_tree)
-    tmp_file = "tmp" + str(random.random())
-    tmp_file = os.path.join(output_dir, tmp_file)
-    try:
-        wget.download(options.remote_dir, tmp_file)
-    except:
-        sys.stderr.write("Could not download " + options.remote_dir + os.linesep)
-
-    #parse the html and identify all directories with pairwise alignments
-    #they look like this <a href="vsMm10/">vsMm10/</a>
-    dirRe = re.compile(r'<a\s+href="vs([a-zA-Z]+\d+)/"')
-    
     #usage:
     #python extract_assembly_versions.py 
     #--reference hg38 
@@ -132,41 +296,36 @@ def main():
 
     #for each of the species in the speciesList
     #identify the most recent assembly version (highest index value)
+    metrics = run_metrics.Metrics(options.metrics)
     species = speciesList.split(',')
-    versions = {}
-    with open(tmp_file) as f:
-        #find all occurrences of directories we may be interested in
-        dirs = dirRe.findall(f.read())
-        for dir in dirs:
-            m = re.match(r'([a-zA-Z]+)(\d+)', dir)
-            #in the directory name, first letter of assembly name is cap, in the species tree is lower case
-            assembly = m.group(1)
-            assembly = assembly[0].lower() + assembly[1:]
-            version = int(m.group(2))
-            if(assembly in species):
-                if(assembly in versions.keys()):
-                    if(versions[assembly] < version):
-                        versions[assembly] = version
-                else:
-                    versions[assembly] = version
-                        
-    #cleanup: remove the temporary file
-    os.remove(tmp_file)
-    
+    metrics.start("download")
+    try:
+        directories = assembly_directories(options.remote_dir, options.cache_dir, options.cache_ttl)
+    except (IOError, ValueError) as e:
+        sys.stderr.write("Could not download %s: %s%s" % (options.remote_dir, e, os.linesep))
+        sys.exit(1)
+    metrics.count(len(directories))
+    versions = latest_versions(directories, species)
+
     #read phylogenetic tree and check that the species
     #for which we found alignments are represented
-    assemblyRe = re.compile(r'[^a-z]([a-zA-Z]+)\d+:')
     foundSpecies = []
     treeContent = ''
 
     #read tree
+    metrics.start("parse")
     with open(options.phylogenetic_tree) as f:
         treeContent = f.read()
+    tree = newick.parse(treeContent)
+    metrics.count(len(tree.leaves()))
 
     #find represented species
-    treeSpecies = assemblyRe.findall(treeContent)
+    treeSpecies = set(newick.assembly_name(leaf.name) for leaf in tree.leaves())
     for val in species:
         if val in treeSpecies:
+            if val not in versions:
+                sys.stderr.write("No pairwise alignments found for " + val + os.linesep)
+                continue
             foundSpecies.append(val)
 
     #save corresponding assembly versions
@@ -174,6 +333,9 @@ def main():
     for val in foundSpecies:
         foundAlignments.append(val + str(versions[val]))
         
+    metrics.start("write")
+    metrics.count(len(foundAlignments))
+
     #output the list of assembly versions for which we will download alignments
     #in a format like this
     #organisms: ["rheMac3","mm10","bosTau8","felCat8","galGal4","rn6"]
@@ -184,17 +346,24 @@ def main():
     #write a new phylogenetic tree file that contains,
     #for the species of interest,
     #the assembly version that we will use
-    newTreeContent = treeContent
-    for val in foundSpecies:
-        replString = val + str(versions[val])
-        searchString = val + "\d+"
-        newTreeContent = re.sub(searchString, replString, newTreeContent)
+    newTreeContent = rewrite_tree(treeContent, dict((val, versions[val]) for val in foundSpecies))
 
     #write out the tree
     new_tree_file = open(options.out_tree, 'w')
     new_tree_file.write(newTreeContent)
     new_tree_file.close()
 
+    #prune the tree to the reference and the assemblies we will use,
+    #renaming and pruning in one pass over the tree
+    if options.out_pruned_tree is not None:
+        keep = foundAlignments + [refAssembly]
+        pruned = newick.update_and_prune(tree, dict((val, versions[val]) for val in foundSpecies), keep)
+        if pruned is None:
+            sys.stderr.write("None of the assemblies is in the tree" + os.linesep)
+            sys.exit(1)
+        newick.write_tree(pruned, options.out_pruned_tree)
+    metrics.close()
+
 # _____________________________________________________________________________
 # -----------------------------------------------------------------------------
 # Call the Main function and catch Keyboard interrups
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+__version__ = "0.1"
+__doc__ = "Minimal Newick trees: parsing, renaming of assembly versions and pruning"
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# import needed (external) modules
+# -----------------------------------------------------------------------------
+
+import sys
+import os
+import re
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Trees
+# -----------------------------------------------------------------------------
+
+#name and version of an assembly, e.g. mm10 -> (mm, 10)
+ASSEMBLY_RE = re.compile(r'^([a-zA-Z]+)(\d+)$')
+
+#branch lengths are written like ape's write.tree does
+LENGTH_FORMAT = "%.10g"
+
+
+class NewickError(Exception):
+    """ Raised for malformed Newick trees """
+    pass
+
+
+class Node(object):
+    """ Node of a tree, a leaf if it has no children """
+
+    __slots__ = ("name", "length", "children")
+
+    def __init__(self, name="", length=None, children=None):
+        self.name = name
+        self.length = length
+        self.children = children if children is not None else []
+
+    def leaves(self):
+        """ Leaf nodes below this node, in the order of the tree """
+        stack = [self]
+        leaves = []
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(reversed(node.children))
+            else:
+                leaves.append(node)
+        return leaves
+
+
+def parse(text):
+
+    """ Parse one Newick tree and return its root node """
+
+    text = text.strip()
+    if not text.endswith(";"):
+        raise NewickError("Newick tree does not end with ;")
+    tokens = re.findall(r'[(),:;]|[^(),:;]+', text)
+
+    root = Node()
+    stack = []
+    node = root
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token == "(":
+            child = Node()
+            node.children.append(child)
+            stack.append(node)
+            node = child
+        elif token == ",":
+            if not stack:
+                raise NewickError("Unexpected , at the top level of the tree")
+            node = Node()
+            stack[-1].children.append(node)
+        elif token == ")":
+            if not stack:
+                raise NewickError("Unbalanced ) in tree")
+            node = stack.pop()
+        elif token == ":":
+            i += 1
+            try:
+                node.length = float(tokens[i])
+            except (IndexError, ValueError):
+                raise NewickError("Invalid branch length in tree")
+        elif token == ";":
+            break
+        else:
+            node.name = token.strip()
+        i += 1
+    if stack:
+        raise NewickError("Unbalanced ( in tree")
+
+    return root
+
+
+def write(root):
+
+    """ Return the Newick string of a tree """
+
+    parts = []
+
+    def label(node):
+        if node.length is None:
+            return node.name
+        return node.name + ":" + LENGTH_FORMAT % node.length
+
+    #iterative post-order, trees can be deeper than the recursion limit
+    stack = [(root, False)]
+    while stack:
+        node, done = stack.pop()
+        if isinstance(node, str):
+            parts.append(node)
+        elif not node.children:
+            parts.append(label(node))
+        elif done:
+            parts.append(")" + label(node))
+        else:
+            stack.append((node, True))
+            for j, child in enumerate(reversed(node.children)):
+                stack.append((child, False))
+                if j < len(node.children) - 1:
+                    stack.append((",", False))
+            parts.append("(")
+    return "".join(parts) + ";"
+
+
+def assembly_name(name):
+
+    """ Name of an assembly without its version, e.g. mm10 -> mm """
+
+    m = ASSEMBLY_RE.match(name)
+    return m.group(1) if m else name
+
+
+def update_and_prune(root, versions, keep=None):
+
+    """
+    In one post-order pass over the tree:
+    rename leaves <species><version> to the versions given per species and,
+    if keep is given, drop all leaves whose (renamed) name is not in keep.
+    Like ape's drop.tip, nodes left with one child are merged with it
+    (adding up the branch lengths) and the branches above the new root are
+    removed. Returns the new root, None if no leaf is kept.
+    """
+
+    keep = set(keep) if keep is not None else None
+    results = {}
+    stack = [(root, False)]
+    while stack:
+        node, done = stack.pop()
+        if not node.children:
+            species = assembly_name(node.name)
+            if species in versions:
+                node.name = species + str(versions[species])
+            results[id(node)] = node if keep is None or node.name in keep else None
+        elif not done:
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.children)
+        else:
+            children = [results.pop(id(child)) for child in node.children]
+            node.children = [child for child in children if child is not None]
+            if not node.children:
+                results[id(node)] = None
+            elif len(node.children) == 1:
+                child = node.children[0]
+                if node.length is not None:
+                    child.length = node.length + (child.length or 0.0)
+                results[id(node)] = child
+            else:
+                results[id(node)] = node
+
+    new_root = results[id(root)]
+    if new_root is not None and new_root is not root:
+        #branches above the new root are dropped
+        new_root.length = None
+    return new_root
+
+
+def read_tree(path):
+
+    """ Read a Newick tree from a file """
+
+    with open(path) as fp:
+        return parse(fp.read())
+
+
+def write_tree(root, path):
+
+    """ Write a tree to a file, terminated by a new line """
+
+    with open(path, 'w') as fp:
+        fp.write(write(root) + "\n")
+
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Main function
+# -----------------------------------------------------------------------------
+
+
+def main():
+    """ Main function """
+
+    parser = ArgumentParser(
+        description=__doc__ + os.linesep +
+        "Prune a tree to the reference and the assemblies of an assemblies file",
+        formatter_class=RawTextHelpFormatter
+    )
+
+    parser.add_argument(
+        "--input_tree",
+        dest="input_tree",
+        help="Tree in Newick format",
+        required=True,
+        metavar="FILE"
+    )
+
+    parser.add_argument(
+        "--reference_organism",
+        dest="reference_organism",
+        help="Assembly of the reference organism (e.g. hg38)",
+        required=True
+    )
+
+    parser.add_argument(
+        "--organisms",
+        dest="organisms",
+        help="File with the comma separated assemblies to keep",
+        required=True,
+        metavar="FILE"
+    )
+
+    parser.add_argument(
+        "--output_tree",
+        dest="output_tree",
+        help="Pruned tree",
+        required=True,
+        metavar="FILE"
+    )
+
+    parser.add_argument(
+        '--version',
+        action='version',
+        version=__version__
+    )
+
+    # _________________________________________________________________________
+    # -------------------------------------------------------------------------
+    # get the arguments
+    # -------------------------------------------------------------------------
+    try:
+        options = parser.parse_args()
+    except(Exception):
+        parser.print_help()
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    with open(options.organisms) as fp:
+        keep = [x.strip() for x in fp.read().split(',') if x.strip()]
+    keep.append(options.reference_organism)
+
+    root = update_and_prune(read_tree(options.input_tree), {}, keep)
+    if root is None:
+        sys.stderr.write("None of the organisms is in the tree" + os.linesep)
+        sys.exit(1)
+    write_tree(root, options.output_tree)
+
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Call the Main function and catch Keyboard interrups
+# -----------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.stderr.write("User interrupt!" + os.linesep)
+        sys.exit(0)
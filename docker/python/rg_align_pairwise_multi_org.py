@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+"""
+Merge the pairwise alignments of each transcript in an mln file into one
+multiple alignment and replace the anchor by the original transcript sequence.
+
+Drop-in replacement of alignPairwiseMultiOrg.pl: same arguments, same pgln
+output on stdout. The columns are merged with numpy index arithmetic instead
+of walking the alignments character by character.
+"""
+
+__date__ = "2020-04-03"
+__license__ = "GPL"
+
+# imports
+import re
+import sys
+import numpy as np
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import run_metrics
+
+
+# redefine a functions for writing to stdout and stderr to save some writting
+syserr = sys.stderr.write
+sysout = sys.stdout.write
+
+GAP = ord("-")
+
+# the files are handled as bytes, like the perl script does
+HEADER_RE = re.compile(rb'>(\S+)\s+\S+')
+ORGANISM_RE = re.compile(rb'>\S+\s+(\S+)')
+FASTA_ID_RE = re.compile(rb'\S+')
+
+
+def read_fasta(path):
+    """Read the sequences of a fasta file as DFastaFileFormat does
+
+    :param path: fasta file
+    :returns: dictionary id (first word of the header) -> sequence
+
+    """
+    names = []
+    sequences = []
+    with open(path, 'rb') as fh:
+        for line in fh:
+            line = line.replace(b"\n", b"")
+            if b">" in line:
+                names.append(line[1:] if line.startswith(b">") else line)
+                sequences.append([])
+            elif names:
+                sequences[-1].append(line)
+
+    records = {}
+    for i, header in enumerate(names):
+        m = FASTA_ID_RE.search(header)
+        if m is None:
+            raise ValueError("the fasta input %i(%s) contains a header that cannot be converted into an Id"
+                             % (i, header.decode("latin-1")))
+        if m.group(0) in records:
+            raise ValueError("sequence %s is multiple times in the file" % m.group(0).decode("latin-1"))
+        records[m.group(0)] = b"".join(sequences[i])
+    return records
+
+
+def chomp(line):
+    """Remove the new line at the end of a line"""
+    return line[:-1] if line.endswith(b"\n") else line
+
+
+def iter_mln_groups(path):
+    """Yield the transcript id and the [(query, target, organism), ...] of each group of an mln file
+
+    A group starts with a >id organism line and ends with a blank line.
+    """
+    with open(path, 'rb') as fh:
+        for line in fh:
+            m = HEADER_RE.search(line)
+            if m is None:
+                continue
+            transcript = m.group(1)
+            group = []
+            organism = None
+            while line.strip():
+                m = ORGANISM_RE.search(line)
+                if m is not None:
+                    organism = m.group(1)
+                query = chomp(fh.readline())
+                target = chomp(fh.readline())
+                group.append((query, target, organism))
+                line = fh.readline()
+            yield transcript, group
+
+
+def merge_columns_scalar(group):
+    """Merge the alignments of a group column by column as alignMultiUTR does
+
+    Only used for groups whose alignments do not have the same number of
+    anchor bases, where the perl script drops or shifts characters.
+    """
+    pointers = [0] * len(group)
+    rows = []
+    anchor = group[0][0]
+    while pointers[0] < len(anchor):
+        if not rows:
+            rows = [bytearray() for i in range(len(group) + 1)]
+        gaps = [query[p:p + 1] == b"-" for (query, target, organism), p in zip(group, pointers)]
+        if not any(gaps):
+            rows[0] += anchor[pointers[0]:pointers[0] + 1]
+        else:
+            rows[0] += b"-"
+        for i, (query, target, organism) in enumerate(group):
+            if gaps[i] or not any(gaps):
+                rows[i + 1] += target[pointers[i]:pointers[i] + 1]
+                pointers[i] += 1
+            else:
+                rows[i + 1] += b"-"
+    return [bytes(row) for row in rows]
+
+
+def merge_columns(group):
+    """Merge the pairwise alignments of a group into one multiple alignment
+
+    Columns with a base of the anchor in all alignments are kept aligned.
+    The insertions (gaps in the query) of all alignments before an anchor
+    base are stacked into as many columns as the longest of them, insertions
+    after the last anchor base are kept as long as those of the first
+    alignment.
+
+    :param group: list of (query, target, organism)
+    :returns: [anchor, target 1, ..., target n] as bytes, empty if the first
+              alignment is empty
+
+    """
+    if not group[0][0]:
+        return []
+    queries = [np.frombuffer(query, dtype=np.uint8) for query, target, organism in group]
+    gaps = [query == GAP for query in queries]
+    bases = [np.flatnonzero(~gap) for gap in gaps]
+    size = len(bases[0])
+    if any(len(b) != size for b in bases) or any(len(q) != len(t) for q, t, o in group):
+        return merge_columns_scalar(group)
+
+    # column of the base before each base (-1 for the first) and number of
+    # insertion columns before each base and after the last one
+    previous = [np.concatenate(([-1], b)) for b in bases]
+    inserts = np.array([np.concatenate((np.diff(p) - 1, [len(q) - 1 - p[-1]]))
+                        for p, q in zip(previous, queries)])
+    widths = inserts[:, :size].max(axis=0)
+    # output columns of the bases and of the first insertion before each of them
+    base_columns = np.cumsum(widths) + np.arange(size)
+    insert_columns = np.concatenate((base_columns - widths, base_columns[-1:] + 1 if size else [0]))
+    length = insert_columns[-1] + inserts[0, -1]
+
+    anchor = np.full(length, GAP, dtype=np.uint8)
+    anchor[base_columns] = queries[0][bases[0]]
+    rows = [anchor.tobytes()]
+    for (query, target, organism), gap, base, before in zip(group, gaps, bases, previous):
+        target = np.frombuffer(target, dtype=np.uint8)
+        row = np.full(length, GAP, dtype=np.uint8)
+        row[base_columns] = target[base]
+        columns = np.flatnonzero(gap)
+        slots = np.cumsum(~gap)[columns]
+        steps = columns - before[slots] - 1
+        keep = (slots < size) | (steps < inserts[0, -1])
+        row[insert_columns[slots[keep]] + steps[keep]] = target[columns[keep]]
+        rows.append(row.tobytes())
+    return rows
+
+
+def replace_anchor_scalar(aligned, original):
+    """Replace the bases of the aligned anchor one by one as replaceAlnAnchorByOriginal does"""
+    replaced = bytearray(aligned)
+    counter = -1
+    for i, c in enumerate(aligned):
+        if c != GAP:
+            counter += 1
+            if counter > len(original):
+                syserr("%s\t%i\t%i\n" % (original.decode("latin-1"), counter, len(original)))
+            if i > len(replaced):
+                raise ValueError("the anchor is longer than the original sequence")
+            replaced[i:i + 1] = original[counter:counter + 1]
+    return bytes(replaced)
+
+
+def replace_anchor(aligned, original):
+    """Replace the bases of the aligned anchor by the original sequence, keeping the gaps"""
+    anchor = np.frombuffer(aligned, dtype=np.uint8)
+    columns = np.flatnonzero(anchor != GAP)
+    if len(columns) > len(original):
+        return replace_anchor_scalar(aligned, original)
+    anchor = anchor.copy()
+    anchor[columns] = np.frombuffer(original, dtype=np.uint8, count=len(columns))
+    return anchor.tobytes()
+
+
+def format_alignment(anchor_name, transcript, group, rows, original):
+    """Return the pgln record of one transcript"""
+    name = anchor_name + b"_" + transcript
+    lines = [b">>" + name, replace_anchor(rows[0], original) if rows else b""]
+    for (query, target, organism), row in zip(group, rows[1:]):
+        lines.append(b">" + organism + b"_" + transcript)
+        lines.append(row)
+    lines.append(b"\\\\\n")
+    return b"\n".join(lines)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    parser.add_argument("mln",
+                        help="Pairwise alignments of the transcripts in mln format")
+    parser.add_argument("sequences",
+                        help="Original transcript sequences in fasta format")
+    parser.add_argument("anchor",
+                        help="Anchor (reference) assembly, e.g. hg38")
+    parser.add_argument("-v",
+                        "--verbose",
+                        dest="verbose",
+                        action="store_true",
+                        default=False,
+                        help="Be loud!")
+    run_metrics.add_argument(parser)
+    try:
+        options = parser.parse_args()
+    except(Exception):
+        parser.print_help()
+        sys.exit(1)
+
+    """Main logic of the script"""
+    metrics = run_metrics.Metrics(options.metrics)
+    metrics.start("parse")
+    try:
+        sequences = read_fasta(options.sequences)
+    except ValueError as e:
+        syserr("%s\n" % e)
+        sys.exit(1)
+    metrics.count(len(sequences))
+
+    # groups are read, merged and written one at a time
+    metrics.start("align")
+    anchor_name = options.anchor.encode()
+    out = sys.stdout.buffer
+    count = 0
+    for transcript, group in iter_mln_groups(options.mln):
+        rows = merge_columns(group)
+        if transcript not in sequences:
+            out.flush()
+            syserr("the sequence %s is not in the %s \n" % (transcript.decode("latin-1"), options.sequences))
+            sys.exit(1)
+        try:
+            out.write(format_alignment(anchor_name, transcript, group, rows, sequences[transcript]))
+        except ValueError as e:
+            out.flush()
+            syserr("%s: %s\n" % (transcript.decode("latin-1"), e))
+            sys.exit(1)
+        count += 1
+    out.flush()
+    metrics.count(count)
+    metrics.close()
+    if options.verbose:
+        syserr("Merged the alignments of %i transcripts\n" % count)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        syserr("Interrupted by user\n")
+        sys.exit(1)
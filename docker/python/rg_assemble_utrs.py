@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+"""
+Assemble the reference-anchored pairwise alignments of the regions of a
+match.tab file from the chromosome axt files of each organism.
+
+Drop-in replacement of assembleUTRsFromPairwiseConsMultiRemovedComments.pl:
+same arguments, same <anchor>_Reg-to-<organism>_a<N>.aln output files.
+Instead of enumerating every exonic base the alignment blocks are projected
+through an interval index of the regions and sliced as a whole.
+"""
+
+__date__ = "2020-04-02"
+__license__ = "GPL"
+
+# imports
+import io
+import os
+import re
+import sys
+from bisect import bisect_right
+from collections import namedtuple
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import axt_index
+import run_metrics
+
+
+# redefine a functions for writing to stdout and stderr to save some writting
+syserr = sys.stderr.write
+sysout = sys.stdout.write
+
+# character of the positions of the regions that are not covered by an alignment block
+UNK = "N"
+
+# complement as in the perl script, other characters are kept
+COMPLEMENT = str.maketrans("ACGTNRYWSMKBDHVacgtnrywsmkbdhv",
+                           "TGCANYRWSKMVDHBtgcanyrwskmvdhb")
+
+# match.tab columns: name.exon, chromosome, start, end, strand (1-based, inclusive)
+NAME, CHROM, START, END, STRAND = 0, 1, 2, 3, 4
+
+LONG_ID_RE = re.compile(r'(\S+)\.\d+$')
+SHORT_ID_RE = re.compile(r'(\S+)\|TR')
+
+# regions of one chromosome: coverage segments sorted by start with the prefix
+# maximum of their ends (see axt_index), the transcript and the number of its
+# regions covering each segment; and the regions sorted by start with a range
+# maximum table of their ends
+Chromosome = namedtuple('Chromosome', ['starts', 'ends', 'max_ends', 'transcripts', 'counts',
+                                       'region_starts', 'region_ends', 'region_max', 'min_start'])
+
+
+def transcript_ids(name):
+    """Return the (long, short) transcript id of a name.exon region name
+
+    :param name: e.g. ENST0001|TR(1..100)CDS(10..90).3
+    :returns: (ENST0001|TR(1..100)CDS(10..90), ENST0001)
+
+    """
+    m = LONG_ID_RE.search(name)
+    long_id = m.group(1) if m else name
+    m = SHORT_ID_RE.search(name)
+    short_id = m.group(1) if m else long_id
+    return long_id, short_id
+
+
+def read_regions(path):
+    """Read the regions of a match.tab file
+
+    :param path: match.tab file
+    :returns: regions per chromosome as (short id, start, end) and a
+              dictionary short id -> (long id, strand) (last region wins)
+
+    """
+    regions = {}
+    transcripts = {}
+    with open(path) as fh:
+        for line in fh:
+            fields = line.split()
+            if not fields:
+                continue
+            long_id, short_id = transcript_ids(fields[NAME])
+            regions.setdefault(fields[CHROM], []).append(
+                (short_id, int(fields[START]), int(fields[END])))
+            transcripts[short_id] = (long_id, fields[STRAND])
+    return regions, transcripts
+
+
+def coverage_segments(intervals):
+    """Split the union of possibly overlapping intervals into segments
+
+    :param intervals: list of (start, end), 1-based inclusive
+    :returns: sorted list of disjoint (start, end, count) with the number of
+              intervals covering each segment
+
+    """
+    events = {}
+    for start, end in intervals:
+        if start <= end:
+            events[start] = events.get(start, 0) + 1
+            events[end + 1] = events.get(end + 1, 0) - 1
+    segments = []
+    count = 0
+    previous = None
+    for position in sorted(events):
+        if count > 0:
+            segments.append((previous, position - 1, count))
+        count += events[position]
+        previous = position
+    return segments
+
+
+def range_max_table(values):
+    """Sparse table for maximum queries over ranges of values"""
+    table = [list(values)]
+    width = 1
+    while 2 * width <= len(values):
+        row = table[-1]
+        table.append([max(row[i], row[i + width]) for i in range(len(row) - width)])
+        width *= 2
+    return table
+
+
+def range_max(table, lo, hi):
+    """Maximum of values[lo:hi] of a range_max_table, None if the range is empty"""
+    if lo >= hi:
+        return None
+    level = (hi - lo).bit_length() - 1
+    row = table[level]
+    return max(row[lo], row[hi - (1 << level)])
+
+
+def index_chromosome(regions):
+    """Build the interval index of the regions of one chromosome
+
+    :param regions: list of (short id, start, end)
+    :returns: Chromosome
+
+    """
+    per_transcript = {}
+    for short_id, start, end in regions:
+        per_transcript.setdefault(short_id, []).append((start, end))
+    segments = []
+    for short_id, intervals in per_transcript.items():
+        segments.extend((start, end, short_id, count)
+                        for start, end, count in coverage_segments(intervals))
+    segments.sort(key=lambda segment: segment[0])
+
+    max_ends = []
+    max_end = 0
+    for segment in segments:
+        max_end = max(max_end, segment[1])
+        max_ends.append(max_end)
+
+    ordered = sorted(regions, key=lambda region: region[1])
+    return Chromosome([s[0] for s in segments],
+                      [s[1] for s in segments],
+                      max_ends,
+                      [s[2] for s in segments],
+                      [s[3] for s in segments],
+                      [r[1] for r in ordered],
+                      [r[2] for r in ordered],
+                      range_max_table([r[2] for r in ordered]),
+                      min(r[1] for r in regions))
+
+
+def overlapping(chromosome, start, end):
+    """Coverage segments overlapping start..end, sorted by start
+
+    :returns: list of (start, end, transcript, count)
+
+    """
+    found = []
+    i = bisect_right(chromosome.starts, end) - 1
+    while i >= 0 and chromosome.max_ends[i] >= start:
+        if chromosome.ends[i] >= start:
+            found.append((chromosome.starts[i], chromosome.ends[i],
+                          chromosome.transcripts[i], chromosome.counts[i]))
+        i -= 1
+    found.reverse()
+    return found
+
+
+def column_mapper(seq):
+    """Return a function giving the column of the k-th (0-based) non-gap character of seq"""
+    if "-" not in seq:
+        return lambda k: k
+    run_starts = []
+    run_bases = []
+    bases = 0
+    for m in re.finditer(r'[^-]+', seq):
+        run_starts.append(m.start())
+        run_bases.append(bases)
+        bases += m.end() - m.start()
+
+    def column(k):
+        i = bisect_right(run_bases, k) - 1
+        return run_starts[i] + k - run_bases[i]
+    return column
+
+
+def repeat_columns(seq, count):
+    """Repeat each character of seq count times"""
+    if count == 1:
+        return seq
+    return "".join(c * count for c in seq)
+
+
+class Assembler(object):
+    """Project the alignment blocks of one chromosome onto the transcripts
+
+    Mirrors assembleAlignment of the perl script: blocks are processed in the
+    order of the axt file, positions up to last (the largest block end seen)
+    are done, positions of the regions between two blocks are filled with UNK.
+    """
+
+    def __init__(self, chromosome, alignments):
+        self.chromosome = chromosome
+        self.alignments = alignments
+        self.last = chromosome.min_start - 1
+        # regions before head have been passed (shifted off the sorted list)
+        self.head = 0
+
+    def passed(self, position):
+        """Drop the regions at the head of the sorted list that end before position"""
+        ends = self.chromosome.region_ends
+        while self.head < len(ends) and ends[self.head] < position:
+            self.head += 1
+
+    def regions_overlap(self, start, end):
+        """Whether one of the remaining regions overlaps start..end"""
+        chromosome = self.chromosome
+        hi = bisect_right(chromosome.region_starts, end, self.head)
+        largest = range_max(chromosome.region_max, self.head, hi)
+        return largest is not None and largest >= start
+
+    def fill(self, start, end):
+        """Append UNK for each covered position of start..end"""
+        for s, e, transcript, count in overlapping(self.chromosome, start, end):
+            length = (min(e, end) - max(s, start) + 1) * count
+            alignment = self.alignments.setdefault(transcript, ([], []))
+            alignment[0].append(UNK * length)
+            alignment[1].append(UNK * length)
+
+    def add_block(self, start, end, seq_q, seq_t):
+        """Project one axt block (start..end on the reference) onto the transcripts"""
+        self.passed(self.last)
+        if self.head == len(self.chromosome.region_ends):
+            return False
+        overlap_gap = self.regions_overlap(self.last + 1, start - 1)
+        self.passed(start)
+        overlap_block = self.regions_overlap(start, end)
+
+        if overlap_gap:
+            self.fill(self.last + 1, start - 1)
+        if overlap_block:
+            # each column belongs to the position of the last non-gap
+            # query character up to it (leading gaps to start - 1)
+            bases = len(seq_q) - seq_q.count("-")
+            first = max(start - 1, self.last + 1)
+            last = start - 1 + bases
+            column = column_mapper(seq_q)
+            for s, e, transcript, count in overlapping(self.chromosome, first, last):
+                s, e = max(s, first), min(e, last)
+                if s > e:
+                    continue
+                left = 0 if s == start - 1 else column(s - start)
+                right = column(e - start + 1) if e - start + 1 < bases else len(seq_q)
+                alignment = self.alignments.setdefault(transcript, ([], []))
+                alignment[0].append(repeat_columns(seq_q[left:right], count))
+                alignment[1].append(repeat_columns(seq_t[left:right], count))
+        self.last = max(end, self.last)
+        return True
+
+    def finish(self):
+        """Fill the positions of the regions after the last alignment block"""
+        ends = self.chromosome.region_ends
+        if self.head < len(ends):
+            self.fill(self.last + 1, max(0, max(ends[self.head:])))
+
+
+def read_axt_blocks(fh):
+    """Yield (start, end, query, target) of the blocks of an open axt file"""
+    for line in fh:
+        if line.startswith("#"):
+            continue
+        fields = line.split()
+        if len(fields) < 9:
+            continue
+        seq_q = fh.readline().replace("\n", "")
+        seq_t = fh.readline().replace("\n", "")
+        yield int(fields[2]), int(fields[3]), seq_q, seq_t
+
+
+def open_chromosome(path):
+    """Open the axt file of a chromosome, or its part of the grouped contigs.axt
+
+    :returns: text file object or None if the chromosome has no alignments
+
+    """
+    if os.path.exists(path):
+        return open(path)
+    chromosome = os.path.basename(path)[:-len(".axt")]
+    try:
+        return io.StringIO(axt_index.read_grouped_chromosome(os.path.dirname(path), chromosome))
+    except KeyError:
+        return None
+
+
+def assemble_chromosome(path, regions):
+    """Assemble the alignments of the transcripts with regions on one chromosome
+
+    :param path: axt file of the chromosome
+    :param regions: list of (short id, start, end)
+    :returns: dictionary short id -> (query, target)
+
+    """
+    alignments = {}
+    assembler = Assembler(index_chromosome(regions), alignments)
+    fh = open_chromosome(path)
+    if fh is None:
+        syserr("The alignment file %s does not exist\n" % path)
+    else:
+        with fh:
+            for start, end, seq_q, seq_t in read_axt_blocks(fh):
+                if not assembler.add_block(start, end, seq_q, seq_t):
+                    # all regions are passed, nothing more can be added
+                    break
+    assembler.finish()
+    return dict((transcript, ("".join(q), "".join(t)))
+                for transcript, (q, t) in alignments.items())
+
+
+def assemble_alignment(alignments_dir, regions, transcripts):
+    """Assemble the alignments of all transcripts from the axt files of one organism
+
+    :param alignments_dir: directory with the <chromosome>.axt files
+    :param regions: regions per chromosome (see read_regions)
+    :param transcripts: short id -> (long id, strand)
+    :returns: list of (long id, query, target) in the order of the perl script
+
+    """
+    records = []
+    for chrom in sorted(regions):
+        alignments = assemble_chromosome(os.path.join(alignments_dir, chrom + ".axt"), regions[chrom])
+        for short_id in sorted(alignments):
+            long_id, strand = transcripts[short_id]
+            seq_q, seq_t = alignments[short_id]
+            if strand == "-":
+                seq_q = seq_q.translate(COMPLEMENT)[::-1]
+                seq_t = seq_t.translate(COMPLEMENT)[::-1]
+            records.append((long_id, seq_q, seq_t))
+    return records
+
+
+def write_aln(records, path):
+    """Write the records in the aln format (>>id, query, target)"""
+    with open(path, 'w') as out:
+        for long_id, seq_q, seq_t in records:
+            out.write(">>%s\n%s\n%s\n" % (long_id, seq_q, seq_t))
+
+
+def write_mln(organism_records, path):
+    """Multiplex the records of all organisms as mergeAssembledUTRs.pl does
+
+    :param organism_records: list of (organism, records) in alignment order
+
+    """
+    with open(path, 'w') as out:
+        i = 0
+        complete = True
+        while complete:
+            for organism, records in organism_records:
+                if i < len(records):
+                    long_id, seq_q, seq_t = records[i]
+                    out.write(">%s %s\n%s\n%s\n" % (long_id, organism, seq_q, seq_t))
+                else:
+                    complete = False
+            out.write("\n")
+            i += 1
+
+
+def main():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    parser.add_argument("alignments_dir",
+                        help="Directory with the <anchor>_to_<organism> directories of chromosome axt files")
+    parser.add_argument("anchor",
+                        help="Anchor (reference) assembly, e.g. hg38")
+    parser.add_argument("organisms",
+                        help="Comma separated organisms, in the order of the alignment")
+    parser.add_argument("regions",
+                        help="Regions in match.tab format")
+    parser.add_argument("output_dir",
+                        help="Directory of the <anchor>_Reg-to-<organism>_a<N>.aln files")
+    parser.add_argument("--mln",
+                        dest="mln",
+                        default=None,
+                        help="Also write the multiplexed alignments of all organisms\n"
+                             "(as mergeAssembledUTRs.pl) to this file")
+    parser.add_argument("-v",
+                        "--verbose",
+                        dest="verbose",
+                        action="store_true",
+                        default=False,
+                        help="Be loud!")
+    run_metrics.add_argument(parser)
+    try:
+        options = parser.parse_args()
+    except(Exception):
+        parser.print_help()
+        sys.exit(1)
+
+    """Main logic of the script"""
+    metrics = run_metrics.Metrics(options.metrics)
+    metrics.start("parse")
+    regions, transcripts = read_regions(options.regions)
+    metrics.count(sum(len(chromosome_regions) for chromosome_regions in regions.values()))
+    if not os.path.exists(options.output_dir):
+        os.makedirs(options.output_dir)
+
+    organism_records = []
+    for counter, organism in enumerate(options.organisms.rstrip(",").split(","), 1):
+        alignments_dir = os.path.join(options.alignments_dir, "%s_to_%s" % (options.anchor, organism))
+        out_file = os.path.join(options.output_dir, "%s_Reg-to-%s_a%i.aln" % (options.anchor, organism, counter))
+        sysout("...generating %s\n" % out_file)
+        metrics.start("assemble")
+        records = assemble_alignment(alignments_dir, regions, transcripts)
+        metrics.count(len(records))
+        metrics.start("write")
+        write_aln(records, out_file)
+        metrics.count(len(records))
+        organism_records.append((organism, records))
+        if options.verbose:
+            syserr("Assembled %i alignments for %s\n" % (len(records), organism))
+
+    if options.mln is not None:
+        write_mln(organism_records, options.mln)
+    metrics.close()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        syserr("Interrupted by user\n")
+        sys.exit(1)
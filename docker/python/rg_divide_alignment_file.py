@@ -13,9 +13,19 @@ __license__ = "GPL"
 # imports
 import os
 import sys
+import io
+import gzip
+import time
+import tarfile
+import zipfile
+import hashlib
 import itertools
 import pickle as cp
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import run_metrics
+from alignment_store import AlignmentStoreWriter
 
 # redefine a functions for writing to stdout and stderr to save some writting
 syserr = sys.stderr.write
@@ -25,28 +35,181 @@ sysout = sys.stdout.write
 def isa_group_separator(line):
     return line=='\n'
 
-def read_mln_to_dict(filetoread):
-    data = {}
+def iter_mln(filetoread):
+    """Yield the name and the alignments of one transcript at a time
+
+    Only the lines of the current transcript are held in memory.
+    """
     with open(filetoread) as f:
         #format of aln file:
         #>description line
         #query seq alnmt
         #target seq algnmt
         for key, block in itertools.groupby(f, isa_group_separator):
-            group = list(block)
-            if not key:
-                tmp = {}
-                #parse 3 lines at a time: description, query  alnmt, target alnmt
-                #save the info in a dictionary indexed by species
-                for i in range(0, len(group)-2, 3):
-                    species_name = group[i].rstrip().split(" ")[-1]
-                    query_name = group[i].rstrip().split(" ")[0][1:].replace('|', '__')
-                    query_alnmt = group[i+1].rstrip()
-                    target_alnmt = group[i+2].rstrip()
-                    tmp[species_name] = [query_alnmt, target_alnmt]
-                #save the data for this query in the central dictionary
-                data[query_name] = tmp
-    return data
+            if key:
+                continue
+            tmp = {}
+            query_name = None
+            #parse 3 lines at a time: description, query  alnmt, target alnmt
+            #save the info in a dictionary indexed by species
+            for description, query_alnmt, target_alnmt in zip(block, block, block):
+                description = description.rstrip().split(" ")
+                species_name = description[-1]
+                query_name = description[0][1:].replace('|', '__')
+                tmp[species_name] = [query_alnmt.rstrip(), target_alnmt.rstrip()]
+            if query_name is not None:
+                yield query_name, tmp
+
+def read_mln_to_dict(filetoread):
+    #save the data for each query in the central dictionary
+    return dict(iter_mln(filetoread))
+
+def transcript_path(output_dir, name, fanout=0):
+    """Path of the file of a transcript below fanout levels of subdirectories
+
+    Each level is named by two hex digits of the md5 of the transcript name,
+    so that no directory holds more than a 256th of the files of its parent.
+    """
+    digest = hashlib.md5(name.encode()).hexdigest()
+    levels = [digest[2 * i:2 * i + 2] for i in range(fanout)]
+    return os.path.join(output_dir, *(levels + [name]))
+
+def write_transcript(path, value):
+    with open(path, 'wb') as aln:
+        cp.dump(value, aln, protocol=0)
+
+def write_transcripts(transcripts, output_dir, fanout=0, writers=1, verbose=False):
+    """Write each transcript into its own file with a pool of writer threads
+
+    At most a few transcripts per writer are queued, so the memory stays
+    bounded when transcripts are parsed faster than they are written.
+    A transcript with groups on several chromosomes is yielded once per
+    group, its writes wait for each other so that the file holds the last
+    group like when writing sequentially.
+    Returns the number of transcripts written.
+    """
+    created = set()
+    pending = set()
+    # path -> its write that is queued or running, and back
+    in_flight = {}
+    paths = {}
+    count = 0
+
+    def finished(futures):
+        for future in futures:
+            future.result()
+            del in_flight[paths.pop(future)]
+
+    with ThreadPoolExecutor(max_workers=writers) as executor:
+        for count, (name, value) in enumerate(transcripts, 1):
+            path = transcript_path(output_dir, name, fanout)
+            directory = os.path.dirname(path)
+            if directory not in created:
+                if not os.path.exists(directory):
+                    os.makedirs(directory, exist_ok=True)
+                created.add(directory)
+            if path in in_flight:
+                previous = in_flight[path]
+                wait([previous])
+                pending.discard(previous)
+                finished([previous])
+            if len(pending) >= 4 * writers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                finished(done)
+            future = executor.submit(write_transcript, path, value)
+            paths[future] = path
+            in_flight[path] = future
+            pending.add(future)
+            if verbose and count % 1000 == 0:
+                syserr("Saved %i transcripts to %s\r" % (count, output_dir))
+        finished(pending)
+    return count
+
+class ParallelGzipWriter(object):
+    """Write-only file object compressing blocks of data in parallel
+
+    Every block of block_size bytes is compressed into its own gzip member
+    by a pool of threads (zlib releases the GIL) and the members are written
+    in order. Concatenated members form a valid gzip file.
+    """
+
+    def __init__(self, fh, threads, block_size=4 * 1024 * 1024):
+        self.fh = fh
+        self.threads = threads
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = []
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self.submit()
+        return len(data)
+
+    def submit(self):
+        block = b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.executor.submit(gzip.compress, block))
+        # write finished members in order, keep a bounded number in flight
+        while self.pending and (self.pending[0].done() or len(self.pending) > 2 * self.threads):
+            self.fh.write(self.pending.pop(0).result())
+
+    def close(self):
+        if self.buffered:
+            self.submit()
+        for future in self.pending:
+            self.fh.write(future.result())
+        self.pending = []
+        self.executor.shutdown()
+
+def write_archive(transcripts, archive, fanout=0, threads=1):
+    """Write the transcript files directly into a tar.gz or zip archive
+
+    Entries have the names of the files of write_transcripts relative to
+    the output directory; tar entries are prefixed with ./ like the ones of
+    tar -C <output_dir> . and are compressed by threads gzip threads.
+    Returns the number of transcripts written.
+    """
+    count = 0
+    if archive.endswith(".zip"):
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as out:
+            for count, (name, value) in enumerate(transcripts, 1):
+                out.writestr(transcript_path("", name, fanout), cp.dumps(value, protocol=0))
+        return count
+
+    with open(archive, 'wb') as fh:
+        if threads > 1:
+            compressed = ParallelGzipWriter(fh, threads)
+        else:
+            compressed = gzip.GzipFile(fileobj=fh, mode='wb')
+        with tarfile.open(fileobj=compressed, mode='w|') as out:
+            directories = set()
+            def add_directory(path):
+                if path not in directories:
+                    directories.add(path)
+                    info = tarfile.TarInfo(path)
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    info.mtime = time.time()
+                    out.addfile(info)
+            add_directory("./")
+            for count, (name, value) in enumerate(transcripts, 1):
+                path = transcript_path(".", name, fanout)
+                parts = path.split("/")
+                for level in range(2, len(parts)):
+                    add_directory("/".join(parts[:level]) + "/")
+                data = cp.dumps(value, protocol=0)
+                info = tarfile.TarInfo(path)
+                info.size = len(data)
+                info.mode = 0o644
+                info.mtime = time.time()
+                out.addfile(info, io.BytesIO(data))
+        compressed.close()
+    return count
 
 def main():
     parser = ArgumentParser(description=__doc__)
@@ -62,6 +225,31 @@ def main():
     parser.add_argument("--output-dir",
                         dest="output_dir",
                         help="Directory for the divided files")
+    parser.add_argument("--output-file",
+                        dest="output_file",
+                        help="Write all transcripts into one indexed alignment store\n"
+                             "(see alignment_store.py) instead of --output-dir")
+    parser.add_argument("--output-archive",
+                        dest="output_archive",
+                        help="Write the transcript files directly into a tar.gz\n"
+                             "(or .zip) archive instead of --output-dir")
+    parser.add_argument("--compress-threads",
+                        dest="compress_threads",
+                        type=int,
+                        default=1,
+                        help="Number of threads compressing the tar.gz archive, defaults to 1")
+    parser.add_argument("--writers",
+                        dest="writers",
+                        type=int,
+                        default=1,
+                        help="Number of threads writing transcript files, defaults to 1")
+    parser.add_argument("--fanout",
+                        dest="fanout",
+                        type=int,
+                        default=0,
+                        help="Levels of hashed subdirectories (256 per level) below\n"
+                             "--output-dir, defaults to 0 (all files in --output-dir)")
+    run_metrics.add_argument(parser)
     try:
         options = parser.parse_args()
     except Exception:
@@ -70,23 +258,47 @@ def main():
 
 
     """Main logic of the script"""
-    try:
-        if options.verbose:
-            syserr("Reading alignment file\n")
-        multiple_alignment_dict = read_mln_to_dict(options.mln)
-    except OSError:
+    metrics = run_metrics.Metrics(options.metrics)
+    if not os.path.exists(options.mln):
         raise OSError("Cannot open multiple alignment file %s" % options.mln)
+    if options.verbose:
+        syserr("Reading alignment file\n")
+    #transcripts are written as soon as they are parsed
+    metrics.start("write")
+    transcripts = metrics.counted(iter_mln(options.mln))
+
+    if options.output_file is not None:
+        count = 0
+        with AlignmentStoreWriter(options.output_file) as store:
+            for name, value in transcripts:
+                store.add(name, value)
+                count += 1
+        metrics.close()
+        if options.verbose:
+            syserr("Saved %i transcripts to %s\n" % (count, options.output_file))
+        return
+
+    if options.output_archive is not None:
+        count = write_archive(transcripts,
+                              options.output_archive,
+                              options.fanout,
+                              options.compress_threads)
+        metrics.close()
+        if options.verbose:
+            syserr("Saved %i transcripts to %s\n" % (count, options.output_archive))
+        return
 
     if not os.path.exists(options.output_dir):
         os.makedirs(options.output_dir)
 
-    for name, value in multiple_alignment_dict.items():
-        if options.verbose:
-            syserr("Saving %s to %s\r" % (name, options.output_dir))
-        with open(os.path.join(options.output_dir, name), 'wb') as aln:
-            cp.dump(value, aln, protocol=0)
+    count = write_transcripts(transcripts,
+                              options.output_dir,
+                              options.fanout,
+                              options.writers,
+                              options.verbose)
+    metrics.close()
     if options.verbose:
-        syserr("\n")
+        syserr("Saved %i transcripts to %s\n" % (count, options.output_dir))
 
 if __name__ == '__main__':
     try:
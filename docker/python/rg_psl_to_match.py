@@ -11,19 +11,179 @@ __email__ = "r.gumienny@unibas.ch"
 __license__ = "GPL"
 
 # imports
+import os
 import sys
 import errno
+import itertools
+import numpy as np
 from contextlib import contextmanager
 from argparse import ArgumentParser, RawTextHelpFormatter
 
+import run_metrics
+
 
 # redefine a functions for writing to stdout and stderr to save some writting
 syserr = sys.stderr.write
 sysout = sys.stdout.write
 
-#auxilliary function to change array offset (0 vs 1)
-def minus1(val):
-    return val-1
+# batch files written with --output-dir, named like by rg_split_match_tab.py
+BATCH_PREFIX = "output.match.tab_part_"
+
+# psl file format, columns:
+# 1. matches - Number of bases that match that aren't repeats
+# 2. misMatches - Number of bases that don't match
+# 3. repMatches - Number of bases that match but are part of repeats
+# 4. nCount - Number of "N" bases
+# 5. qNumInsert - Number of inserts in query
+# 6. qBaseInsert - Number of bases inserted in query
+# 7. tNumInsert - Number of inserts in target
+# 8. tBaseInsert - Number of bases inserted in target
+# 9. strand - "+" or "-" for query strand. For translated alignments, second "+"or "-" is for target genomic strand.
+# 10. qName - Query sequence name
+# 11. qSize - Query sequence size.
+# 12. qStart - Alignment start position in query
+# 13. qEnd - Alignment end position in query
+# 14. tName - Target sequence name
+# 15. tSize - Target sequence size
+# 16. tStart - Alignment start position in target
+# 17. tEnd - Alignment end position in target
+# 18. blockCount - Number of blocks in the alignment (a block contains no gaps)
+# 19. blockSizes - Comma-separated list of sizes of each block. If the query is a protein and the target the genome, blockSizes are in amino acids. See below for more information on protein query PSLs.
+# 20. qStarts - Comma-separated list of starting positions of each block in query
+# 21. tStarts - Comma-separated list of starting positions of each block in target
+#
+# we need the following (0-based): $10,$14,$9,$19,$20,$21
+NAME, CHROM, STRAND, BLOCK_SIZES, Q_STARTS, T_STARTS = 9, 13, 8, 18, 19, 20
+
+# one line of the match.tab file per block (exon):
+# name.exon, chromosome, genome start, genome end, strand,
+# transcript start, transcript end (1-based, inclusive)
+MATCH_FORMAT = "%s.%i\t%s\t%i\t%i\t%s\t%i\t%i\n"
+
+
+def complete_blocks(lists, n):
+    """Keep the first n entries of comma separated lists, each followed by a comma
+
+    :param lists: comma separated lists of block sizes, query and target starts
+    :param n: number of blocks to keep
+    :returns: list of truncated lists
+
+    """
+    if n == 0:
+        return ['', '', '']
+    return [",".join(l.split(',')[:n]) + ',' for l in lists]
+
+
+def to_array(text):
+    """Parse the concatenated comma terminated integer lists of a chunk"""
+    return np.fromstring(text[:-1], dtype=np.int64, sep=',')
+
+
+def convert_rows(lines):
+    """Convert a chunk of PSL lines into the rows of the match.tab file
+
+    Blocks are the entries of the comma terminated lists of block sizes,
+    query and target starts; an entry without a closing comma is ignored.
+    The coordinates of all blocks of the chunk are computed in bulk.
+
+    :param lines: lines in adjusted PSL format
+    :returns: match.tab rows, transcript names and number of rows per line
+
+    """
+    names, chroms, strands, counts = [], [], [], []
+    sizes, qstarts, tstarts = [], [], []
+    for line in lines:
+        l = line.rstrip().split('\t')
+        block_lists = [l[BLOCK_SIZES], l[Q_STARTS], l[T_STARTS]]
+        n = block_lists[0].count(',')
+        if n != block_lists[1].count(',') or n != block_lists[2].count(',') or \
+                block_lists[0][-1:] != ',' or block_lists[1][-1:] != ',' or block_lists[2][-1:] != ',':
+            n = min(b.count(',') for b in block_lists)
+            block_lists = complete_blocks(block_lists, n)
+        names.append(l[NAME])
+        chroms.append(l[CHROM])
+        strands.append(l[STRAND])
+        counts.append(n)
+        sizes.append(block_lists[0])
+        qstarts.append(block_lists[1])
+        tstarts.append(block_lists[2])
+
+    counts = np.array(counts, dtype=np.int64)
+    total = int(counts.sum())
+    if total == 0:
+        return [], names, counts
+    sizes = to_array(''.join(sizes))
+    qstarts = to_array(''.join(qstarts))
+    tstarts = to_array(''.join(tstarts))
+
+    # number of each block within its transcript, starting at 1
+    first_block = np.repeat(np.cumsum(counts) - counts, counts)
+    exon = np.arange(1, total + 1) - first_block
+    columns = [np.repeat(np.array(names, dtype=object), counts),
+               exon,
+               np.repeat(np.array(chroms, dtype=object), counts),
+               tstarts + 1,
+               tstarts + sizes,
+               np.repeat(np.array(strands, dtype=object), counts),
+               qstarts + 1,
+               qstarts + sizes]
+    rows = list(map(MATCH_FORMAT.__mod__, zip(*[c.tolist() for c in columns])))
+    return rows, names, counts
+
+
+def convert_chunk(lines):
+    """Convert a chunk of PSL lines into the text of the match.tab file
+
+    :param lines: lines in adjusted PSL format
+    :returns: match.tab text of the lines
+
+    """
+    return ''.join(convert_rows(lines)[0])
+
+
+class BatchWriter(object):
+    """Write match.tab rows directly into batch files of batch_size genes
+
+    Genes are keyed like in rg_split_match_tab.py, by the match.tab name
+    without the exon number, which is the PSL query name. Batches are
+    filled in the order in which genes are first seen, and rows of a gene
+    that reappears later are appended to the batch the gene belongs to.
+
+    """
+
+    def __init__(self, output_dir, batch_size):
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.batch_of = {}
+        self.batches = 0
+        self.genes_in_batch = 0
+        # batches of a previous run, possibly more than this run writes
+        for name in os.listdir(output_dir):
+            if name.startswith(BATCH_PREFIX):
+                os.remove(os.path.join(output_dir, name))
+
+    def path(self, batch):
+        return os.path.join(self.output_dir, BATCH_PREFIX + "%04d" % (batch,))
+
+    def write(self, lines):
+        """Convert a chunk of PSL lines and append the rows to their batches"""
+        rows, names, counts = convert_rows(lines)
+        batch_rows = {}
+        end = 0
+        for name, count in zip(names, counts.tolist()):
+            if count == 0:
+                continue
+            start, end = end, end + count
+            if name not in self.batch_of:
+                if self.batches == 0 or self.genes_in_batch == self.batch_size:
+                    self.batches += 1
+                    self.genes_in_batch = 0
+                self.batch_of[name] = self.batches
+                self.genes_in_batch += 1
+            batch_rows.setdefault(self.batch_of[name], []).extend(rows[start:end])
+        for batch, text in sorted(batch_rows.items()):
+            with open(self.path(batch), 'a') as out:
+                out.write(''.join(text))
 
 def main():
     parser = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
@@ -40,6 +200,22 @@ def main():
                         dest="output", 
                         default=sys.stdout, 
                         help="Output file in match.tab format. Defaults to sys.stdout.")
+    parser.add_argument("--output-dir", 
+                        dest="output_dir", 
+                        default=None, 
+                        help="Write the match.tab rows directly into batch files\n"
+                             "output.match.tab_part_NNNN of this directory instead of --output.")
+    parser.add_argument("--batch-size", 
+                        dest="batch_size", 
+                        type=int, 
+                        default=10, 
+                        help="Number of genes in the batch with --output-dir, defaults to 10")
+    parser.add_argument("--chunk-size", 
+                        dest="chunk_size", 
+                        type=int, 
+                        default=100000, 
+                        help="Number of PSL lines converted at once. Defaults to 100000.")
+    run_metrics.add_argument(parser)
     try:
         options = parser.parse_args()
     except(Exception):
@@ -48,69 +224,45 @@ def main():
 
 
     """Main logic of the script"""
+    metrics = run_metrics.Metrics(options.metrics)
     all_tr = 0
     written_tr = 0
-    with smart_open(options.input, 'r') as psl, smart_open(options.output, 'w') as out:
-        for line in psl:
-            all_tr += 1
-            try:
-                l = line.rstrip().split('\t')
-                '''psl file format, columns:
-                1. matches - Number of bases that match that aren't repeats
-                2. misMatches - Number of bases that don't match
-                3. repMatches - Number of bases that match but are part of repeats
-                4. nCount - Number of "N" bases
-                5. qNumInsert - Number of inserts in query
-                6. qBaseInsert - Number of bases inserted in query
-                7. tNumInsert - Number of inserts in target
-                8. tBaseInsert - Number of bases inserted in target
-                9. strand - "+" or "-" for query strand. For translated alignments, second "+"or "-" is for target genomic strand.
-                10. qName - Query sequence name
-                11. qSize - Query sequence size.
-                12. qStart - Alignment start position in query
-                13. qEnd - Alignment end position in query
-                14. tName - Target sequence name
-                15. tSize - Target sequence size
-                16. tStart - Alignment start position in target
-                17. tEnd - Alignment end position in target
-                18. blockCount - Number of blocks in the alignment (a block contains no gaps)
-                19. blockSizes - Comma-separated list of sizes of each block. If the query is a protein and the target the genome, blockSizes are in amino acids. See below for more information on protein query PSLs.
-                20. qStarts - Comma-separated list of starting positions of each block in query
-                21. tStarts - Comma-separated list of starting positions of each block in target
-                #
-                # we need the following:               
-                # $10,$14,$9,$18,$19,$20,$21'''
-                col_list = [10, 14, 9, 18, 19, 20, 21]
-                col_list = list(map(minus1, col_list))
-                l = [l[i] for i in col_list]
-                name = l[0] #transcript name
-                chrom = l[1] #chromosome
-                strand = l[2] #strand
-                #nblocks = int(l[3]) #nr blocks (exons)
-                #l[4] = exon lengths
-                #l[5] = exon starts in transcript
-                #l[6] = exon starts in genome
-                domain = ''
-            except KeyError:
-                print(name)
-                continue
-            i = 1
-            written_tr += 1
-#            for plen, trcoor, gcoor in zip(l[4].split(','), l[5].split(','), l[6].split(','))[:-1]:
-
-            for (plen, trcoor, gcoor) in zip(l[4].split(',')[:-1], l[5].split(',')[:-1], l[6].split(',')[:-1]):
-                outtext = "%s%s.%i\t%s\t%i\t%i\t%s\t%i\t%i\n"%(name,
-                                                               domain,
-                                                               i,
-                                                               chrom,
-                                                               int(gcoor)+1,
-                                                               int(gcoor)+int(plen),
-                                                               strand,
-                                                               int(trcoor)+1,
-                                                               int(trcoor)+int(plen))
-                out.write(outtext)
-                i+=1
-    out.close()
+    if options.output_dir is not None:
+        # write the batches of rg_split_match_tab.py without the match.tab file
+        if not os.path.exists(options.output_dir):
+            os.makedirs(options.output_dir)
+        batch_writer = BatchWriter(options.output_dir, options.batch_size)
+        with smart_open(options.input, 'r') as psl:
+            while True:
+                metrics.start("parse")
+                lines = list(itertools.islice(psl, options.chunk_size))
+                if not lines:
+                    break
+                metrics.count(len(lines))
+                all_tr += len(lines)
+                metrics.start("write")
+                batch_writer.write(lines)
+                metrics.count(len(lines))
+                written_tr += len(lines)
+        if options.verbose:
+            syserr("Wrote %i batches\n" % batch_writer.batches)
+    else:
+        with smart_open(options.input, 'r') as psl, smart_open(options.output, 'w') as out:
+            while True:
+                metrics.start("parse")
+                lines = list(itertools.islice(psl, options.chunk_size))
+                if not lines:
+                    break
+                metrics.count(len(lines))
+                all_tr += len(lines)
+                metrics.start("transform")
+                text = convert_chunk(lines)
+                metrics.count(len(lines))
+                metrics.start("write")
+                out.write(text)
+                metrics.count(len(lines))
+                written_tr += len(lines)
+    metrics.close()
     if options.verbose:
         syserr("Wrote %i sequences out of %i\n" % (written_tr, all_tr))
 
@@ -12,15 +12,25 @@ __license__ = "GPL"
 import os
 import sys
 import errno
+import heapq
+import hashlib
+import tempfile
+import itertools
 import pandas as pd
 from contextlib import contextmanager
 from argparse import ArgumentParser, RawTextHelpFormatter
 
+import run_metrics
+import transcript_cache
+
 
 # redefine a functions for writing to stdout and stderr to save some writting
 syserr = sys.stderr.write
 sysout = sys.stdout.write
 
+# name of the batch files without their number (or hash with --incremental)
+BATCH_PREFIX = "output.match.tab_part_"
+
 
 def main():
     parser = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
@@ -43,18 +53,207 @@ def main():
                         type=int,
                         default=10,
                         help="Number of genes in the batch, defaults to 10")
-    
+    # ways of cutting the batches, the batches of --batch-size genes in
+    # the order of the input if none is given
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--streaming",
+                      dest="streaming",
+                      action="store_true",
+                      default=False,
+                      help="Write the batches while reading, keeping one batch in memory.\n"
+                           "Genes are batched in the order of the input if the rows of each\n"
+                           "gene are contiguous, otherwise the input is sorted externally.")
+    parser.add_argument("--sort-buffer",
+                        dest="sort_buffer",
+                        type=int,
+                        default=1000000,
+                        help="Number of lines sorted in memory by the external sort,\n"
+                             "defaults to 1000000")
+    mode.add_argument("--by-chromosome",
+                      dest="by_chromosome",
+                      action="store_true",
+                      default=False,
+                      help="Order the genes by chromosome before cutting batches of\n"
+                           "--batch-size genes, so each batch touches few chromosomes")
+    mode.add_argument("--balanced-batches",
+                      dest="balanced_batches",
+                      type=int,
+                      default=None,
+                      help="Pack the genes into this number of batches of similar\n"
+                           "estimated cost instead of batches of --batch-size genes")
+    parser.add_argument("--scan-weight",
+                        dest="scan_weight",
+                        type=float,
+                        default=0.01,
+                        help="Cost of scanning the alignments of one chromosome base\n"
+                             "relative to assembling one exonic base, defaults to 0.01")
+    mode.add_argument("--incremental",
+                      dest="incremental",
+                      action="store_true",
+                      default=False,
+                      help="Name the batches by a hash of their genes and keep the\n"
+                           "batch files of earlier runs whose genes did not change,\n"
+                           "so that only new and changed genes are processed again")
+    parser.add_argument("--organisms",
+                        dest="organisms",
+                        default="",
+                        help="Comma separated organisms, part of the gene hashes of --incremental\n"
+                             "and of the cache keys")
+    parser.add_argument("--sequences",
+                        dest="sequences",
+                        default=None,
+                        help="Transcript sequences in fasta format, part of the gene\n"
+                             "hashes of --incremental and of the cache keys")
+    parser.add_argument("--reference",
+                        dest="reference",
+                        default=None,
+                        help="Reference assembly (e.g. hg38), part of the cache keys")
+    parser.add_argument("--assemblies",
+                        dest="assemblies",
+                        default=None,
+                        help="File with the comma separated assemblies of the organisms\n"
+                             "(assemblies.txt), part of the cache keys")
+    parser.add_argument("--keys",
+                        dest="keys",
+                        default=None,
+                        help="Write the cache key of each gene to this file, defaults to\n"
+                             "keys.tsv in the output directory with --cache")
+    parser.add_argument("--cache",
+                        dest="cache",
+                        default=None,
+                        help="Cache database of transcript_cache.py, genes with cached\n"
+                             "results are left out of the batches")
+    parser.add_argument("--manifest",
+                        dest="manifest",
+                        default=None,
+                        help="Manifest with the estimated cost of each batch (--balanced-batches)\n"
+                             "or the batch of each gene (--incremental), defaults to\n"
+                             "batch_costs.tsv or manifest.tsv in the output directory")
+    run_metrics.add_argument(parser)
+
     try:
         options = parser.parse_args()
     except Exception:
         parser.print_help()
         sys.exit()
 
+    if options.balanced_batches is not None and options.balanced_batches < 1:
+        parser.error("--balanced-batches must be at least 1")
+
     if not os.path.exists(options.output_dir):
         os.makedirs(options.output_dir)
 
     """Main logic of the script"""
+    metrics = run_metrics.Metrics(options.metrics)
+    sequence_digests = {}
+    if options.sequences is not None:
+        metrics.start("parse")
+        with open(options.sequences) as fasta:
+            sequence_digests = read_sequence_digests(fasta)
+
+    cached = set()
+    if options.keys is not None or options.cache is not None:
+        if options.reference is None or options.assemblies is None:
+            parser.error("--keys and --cache need --reference and --assemblies")
+        if options.cache is not None and not (options.incremental or options.by_chromosome or options.streaming
+                                              or options.balanced_batches is not None):
+            parser.error("--cache needs --incremental, --balanced-batches, --by-chromosome or --streaming")
+        signature = transcript_cache.assembly_signature(options.reference,
+                                                        [x for x in options.organisms.split(",") if x],
+                                                        transcript_cache.read_assemblies(options.assemblies))
+        metrics.start("keys")
+        with open(options.input) as match_tab:
+            keys = [(key, gene_digest(gene_rows, signature, sequence_digests.get(key, "")))
+                    for key, gene_rows in group_genes(read_rows(match_tab)).items()]
+        metrics.count(len(keys))
+        if options.cache is not None:
+            metrics.start("cache")
+            with transcript_cache.TranscriptCache(options.cache) as cache:
+                found = cache.cached(key for gene, key in keys)
+            cached = set(gene for gene, key in keys if key in found)
+            metrics.count(len(keys))
+            if options.verbose:
+                syserr("%i of %i genes are cached\n" % (len(cached), len(keys)))
+        transcript_cache.write_keys(options.keys or os.path.join(options.output_dir, "keys.tsv"),
+                                    keys, cached)
+
+    if options.incremental:
+        metrics.start("parse")
+        with open(options.input) as match_tab:
+            genes = group_genes(metrics.counted(read_rows(match_tab, cached)))
+        metrics.start("transform")
+        digests = dict((key, gene_digest(gene_rows, options.organisms, sequence_digests.get(key, "")))
+                       for key, gene_rows in genes.items())
+        metrics.count(len(digests))
+        metrics.start("write")
+        batches, kept = write_incremental_batches(genes, digests, options.output_dir, options.batch_size)
+        write_incremental_manifest(options.manifest or os.path.join(options.output_dir, "manifest.tsv"),
+                                   batches, digests)
+        metrics.count(len(genes))
+        metrics.close()
+        if options.verbose:
+            syserr("Wrote %i batches, kept %i unchanged batches\n" % (len(batches) - kept, kept))
+        return
+
+    if options.balanced_batches is not None:
+        metrics.start("parse")
+        with open(options.input) as match_tab:
+            genes, chromosome_costs = estimate_costs(metrics.counted(read_rows(match_tab, cached)),
+                                                     options.scan_weight)
+        metrics.start("transform")
+        batch_of, batches = balance_batches(genes, chromosome_costs, options.balanced_batches)
+        metrics.count(len(batch_of))
+        metrics.start("write")
+        with open(options.input) as match_tab:
+            write_assigned_batches(metrics.counted(read_rows(match_tab, cached)), batch_of, options.output_dir)
+        write_manifest(options.manifest or os.path.join(options.output_dir, "batch_costs.tsv"),
+                       batches)
+        metrics.close()
+        if options.verbose:
+            syserr("Wrote %i batches\n" % len(batches))
+        return
+
+    if options.by_chromosome:
+        metrics.start("parse")
+        with open(options.input) as match_tab:
+            batch_of = shard_by_chromosome(metrics.counted(read_rows(match_tab, cached)), options.batch_size)
+        metrics.start("write")
+        with open(options.input) as match_tab:
+            write_assigned_batches(metrics.counted(read_rows(match_tab, cached)), batch_of, options.output_dir)
+        metrics.close()
+        if options.verbose:
+            syserr("Wrote %i batches\n" % len(set(batch_of.values())))
+        return
+
+    if options.streaming:
+        # rows are read while the batches are written
+        metrics.start("write")
+        try:
+            with open(options.input) as match_tab:
+                batches = write_batches(contiguous_genes(metrics.counted(read_rows(match_tab, cached))),
+                                        options.output_dir,
+                                        options.batch_size)
+        except GenesNotContiguous as e:
+            if options.verbose:
+                syserr("Rows of gene %s are not contiguous, sorting the input\n" % e)
+            remove_batches(options.output_dir)
+            metrics.start("sort")
+            with open(options.input) as match_tab:
+                rows = external_sort(metrics.counted(read_rows(match_tab, cached)), row_key,
+                                     options.sort_buffer, options.output_dir)
+                metrics.start("write")
+                batches = write_batches(contiguous_genes(rows),
+                                        options.output_dir,
+                                        options.batch_size)
+        metrics.close()
+        if options.verbose:
+            syserr("Wrote %i batches\n" % batches)
+        return
+
+    metrics.start("parse")
     df = pd.read_csv(options.input, header=None, sep = '\t')
+    metrics.count(len(df))
+    metrics.start("write")
     df['index'] = [".".join(i.split(".")[:-1]) for i in df[0]]
     for i, batch in enumerate(batch_iterator(iter(df.groupby('index')), options.batch_size), 1):
         pd.concat((d[1] for d in batch))[range(7)].to_csv(os.path.join(options.output_dir,
@@ -62,7 +261,331 @@ def main():
                                                 index=False,
                                                 header=False,
                                                 sep="\t")
+    metrics.count(len(df))
+    metrics.close()
+
+
+
+class GenesNotContiguous(Exception):
+    """Raised when the rows of a gene are not next to each other"""
+    pass
+
+
+def gene_key(name):
+    """Gene key of a match.tab name, the name without the exon number"""
+    return ".".join(name.split(".")[:-1])
+
+
+def row_key(row):
+    """Gene key of a match.tab row"""
+    return gene_key(row.split("\t", 1)[0])
+
+
+def batch_path(output_dir, i):
+    """Path of the i-th batch file"""
+    return os.path.join(output_dir, BATCH_PREFIX + "%04d" % (i,))
+
+
+def read_rows(lines, skip=()):
+    """Yield the non empty rows of a match.tab file limited to the 7 columns
+    of the batch files and terminated by a new line, leaving out the rows of
+    the genes in skip
+    """
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line.strip():
+            row = "\t".join(line.split("\t")[:7]) + "\n"
+            if not skip or row_key(row) not in skip:
+                yield row
+
+
+def contiguous_genes(rows):
+    """Group consecutive rows of the same gene
+
+    :param rows: match.tab rows
+    :yield: gene key and list of rows of the gene
+    :raises GenesNotContiguous: if a gene occurs again after other genes
+
+    """
+    seen = set()
+    for key, gene_rows in itertools.groupby(rows, row_key):
+        if key in seen:
+            raise GenesNotContiguous(key)
+        seen.add(key)
+        yield key, list(gene_rows)
+
+
+def external_sort(rows, key, buffer_size, tmp_dir=None):
+    """Sort rows with bounded memory
+
+    Runs of buffer_size rows are sorted in memory and written to temporary
+    files that are then merged. Both sorts are stable, so rows with the
+    same key keep their input order like in pandas groupby.
+
+    """
+    runs = []
+    while True:
+        run = list(itertools.islice(rows, buffer_size))
+        if not run:
+            break
+        run.sort(key=key)
+        fh = tempfile.TemporaryFile('w+', dir=tmp_dir)
+        fh.writelines(run)
+        fh.seek(0)
+        runs.append(fh)
+    return heapq.merge(*runs, key=key)
+
+
+def write_batches(genes, output_dir, batch_size):
+    """Write batches of batch_size genes while reading them
+
+    :param genes: iterator over gene keys and rows
+    :returns: number of batches written
+
+    """
+    i = 0
+    for i, batch in enumerate(batch_iterator(genes, batch_size), 1):
+        with open(batch_path(output_dir, i), 'w') as out:
+            for key, gene_rows in batch:
+                out.writelines(gene_rows)
+    return i
+
+
+def remove_batches(output_dir):
+    """Remove batch files written before falling back to the external sort"""
+    for name in os.listdir(output_dir):
+        if name.startswith(BATCH_PREFIX):
+            os.remove(os.path.join(output_dir, name))
+
+
+def estimate_costs(rows, scan_weight):
+    """Estimate the cost of assembling the alignments of each gene
+
+    The cost of a gene is its number of exonic bases. A batch additionally
+    scans the alignments of every chromosome it touches once, which costs
+    scan_weight per base of the chromosome, estimated by the largest
+    coordinate of the chromosome in the match.tab file.
+
+    :returns: dictionary gene key -> [cost, set of chromosomes] and
+              dictionary chromosome -> scan cost
+
+    """
+    genes = {}
+    extent = {}
+    for row in rows:
+        fields = row.split("\t")
+        chromosome, start, end = fields[1], int(fields[2]), int(fields[3])
+        gene = genes.setdefault(row_key(row), [0, set()])
+        gene[0] += abs(end - start) + 1
+        gene[1].add(chromosome)
+        extent[chromosome] = max(extent.get(chromosome, 0), start, end)
+    return genes, dict((c, scan_weight * e) for c, e in extent.items())
+
+
+def balance_batches(genes, chromosome_costs, number_of_batches):
+    """Pack genes into batches of similar cost touching few chromosomes
+
+    Genes are assigned from the most to the least expensive to the batch
+    where the cost after adding them is lowest, comparing the least loaded
+    batch with the least loaded batches that already scan the chromosomes
+    of the gene. Heaps are updated lazily, stale entries are skipped.
+
+    :returns: dictionary gene key -> batch number (from 1) and list of
+              [cost, number of genes, set of chromosomes] per batch
+
+    """
+    costs = [0.0] * number_of_batches
+    batches = [[0.0, 0, set()] for _ in range(number_of_batches)]
+    heap = [(0.0, b) for b in range(number_of_batches)]
+    chromosome_heaps = {}
+    batch_of = {}
+
+    def least_loaded(h):
+        while h and h[0][0] != costs[h[0][1]]:
+            heapq.heappop(h)
+        return h[0][1] if h else None
+
+    for key, (cost, chromosomes) in sorted(genes.items(), key=lambda g: (-g[1][0], g[0])):
+        candidates = set([least_loaded(heap)])
+        for chromosome in chromosomes:
+            candidate = least_loaded(chromosome_heaps.get(chromosome, []))
+            if candidate is not None:
+                candidates.add(candidate)
+
+        def added_cost(b):
+            return cost + sum(chromosome_costs[c] for c in chromosomes - batches[b][2])
+
+        b = min(candidates, key=lambda b: (costs[b] + added_cost(b), b))
+        costs[b] += added_cost(b)
+        batches[b][0] = costs[b]
+        batches[b][1] += 1
+        batches[b][2] |= chromosomes
+        batch_of[key] = b
+        heapq.heappush(heap, (costs[b], b))
+        for chromosome in batches[b][2]:
+            heapq.heappush(chromosome_heaps.setdefault(chromosome, []), (costs[b], b))
+
+    # number the non empty batches from 1
+    numbers = {}
+    for b in range(number_of_batches):
+        if batches[b][1]:
+            numbers[b] = len(numbers) + 1
+    return (dict((key, numbers[b]) for key, b in batch_of.items()),
+            [batches[b] for b in sorted(numbers)])
+
+
+def shard_by_chromosome(rows, batch_size):
+    """Assign genes to batches by chromosome first and gene count second
+
+    Genes are ordered by the chromosome of their first row and their key,
+    and consecutive runs of batch_size genes form the batches. A batch
+    therefore only spans chromosomes where one chromosome ends and the
+    next begins.
+
+    :returns: dictionary gene key -> batch number (from 1)
+
+    """
+    chromosome_of = {}
+    for row in rows:
+        key = row_key(row)
+        if key not in chromosome_of:
+            chromosome_of[key] = row.split("\t", 2)[1]
+    genes = sorted(chromosome_of, key=lambda key: (chromosome_of[key], key))
+    return dict((key, i // batch_size + 1) for i, key in enumerate(genes))
+
+
+def write_assigned_batches(rows, batch_of, output_dir, buffer_size=10000):
+    """Write each row to the batch file of its gene, in input order
+
+    Rows are buffered per batch and appended to the batch files in blocks,
+    so the number of open files does not grow with the number of batches.
+
+    """
+    for i in set(batch_of.values()):
+        open(batch_path(output_dir, i), 'w').close()
+    buffers = {}
+    for row in rows:
+        i = batch_of[row_key(row)]
+        buffer = buffers.setdefault(i, [])
+        buffer.append(row)
+        if len(buffer) >= buffer_size:
+            with open(batch_path(output_dir, i), 'a') as out:
+                out.writelines(buffer)
+            del buffer[:]
+    for i, buffer in buffers.items():
+        with open(batch_path(output_dir, i), 'a') as out:
+            out.writelines(buffer)
+
+
+def write_manifest(path, batches):
+    """Write the batch file name, estimated cost, number of genes and
+    chromosomes of each batch, to let schedulers start expensive jobs first
+    """
+    with open(path, 'w') as out:
+        out.write("batch\tcost\tgenes\tchromosomes\n")
+        for i, (cost, genes, chromosomes) in enumerate(batches, 1):
+            out.write("%s\t%.2f\t%i\t%s\n" % (os.path.basename(batch_path("", i)),
+                                                cost,
+                                                genes,
+                                                ",".join(sorted(chromosomes))))
+
+
+def group_genes(rows):
+    """Rows of each gene, in input order
+
+    :returns: dictionary gene key -> list of rows
+
+    """
+    genes = {}
+    for row in rows:
+        genes.setdefault(row_key(row), []).append(row)
+    return genes
+
+
+def read_sequence_digests(lines):
+    """md5 of each sequence of a fasta file, keyed by the first word of the header"""
+    digests = {}
+    name = None
+    md5 = None
+    for line in lines:
+        if line.startswith(">"):
+            if name is not None:
+                digests[name] = md5.hexdigest()
+            fields = line[1:].split()
+            name = fields[0] if fields else ""
+            md5 = hashlib.md5()
+        elif name is not None:
+            md5.update(line.strip().encode())
+    if name is not None:
+        digests[name] = md5.hexdigest()
+    return digests
+
+
+def gene_digest(gene_rows, organisms, sequence_digest=""):
+    """Hash of everything the alignments of a gene depend on: its rows
+    (name and coordinates), the aligned organisms and its sequence
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(organisms.encode() + b"\0" + sequence_digest.encode() + b"\0")
+    for row in gene_rows:
+        sha1.update(row.encode())
+    return sha1.hexdigest()
+
+
+def batch_id(digests):
+    """Name of the batch with genes of the given hashes, independent of their order"""
+    return hashlib.sha1("\n".join(sorted(digests)).encode()).hexdigest()[:16]
+
+
+def write_incremental_batches(genes, digests, output_dir, batch_size):
+    """Write batches named by the hashes of their genes
+
+    Batch files of earlier runs are kept as they are if the hashes of their
+    genes still give their name, so neither their name nor their content nor
+    their modification time changes. Other batch files are removed. The
+    genes that are not in a kept batch are ordered by chromosome and key
+    and cut into new batches of batch_size genes.
+
+    :returns: dictionary batch id -> list of gene keys and number of kept batches
+
+    """
+    batches = {}
+    claimed = set()
+    for name in sorted(os.listdir(output_dir)):
+        if not name.startswith(BATCH_PREFIX):
+            continue
+        path = os.path.join(output_dir, name)
+        with open(path) as fh:
+            keys = list(group_genes(read_rows(fh)))
+        if (keys and all(key in digests and key not in claimed for key in keys)
+                and batch_id(digests[key] for key in keys) == name[len(BATCH_PREFIX):]):
+            batches[name[len(BATCH_PREFIX):]] = keys
+            claimed.update(keys)
+        else:
+            os.remove(path)
+    kept = len(batches)
+
+    pool = sorted((key for key in genes if key not in claimed),
+                  key=lambda key: (genes[key][0].split("\t", 2)[1], key))
+    for keys in batch_iterator(iter(pool), batch_size):
+        i = batch_id(digests[key] for key in keys)
+        path = os.path.join(output_dir, BATCH_PREFIX + i)
+        with open(path + ".tmp", 'w') as out:
+            for key in keys:
+                out.writelines(genes[key])
+        os.rename(path + ".tmp", path)
+        batches[i] = keys
+    return batches, kept
+
 
+def write_incremental_manifest(path, batches, digests):
+    """Write the batch and the hash of each gene"""
+    with open(path + ".tmp", 'w') as out:
+        out.write("gene\thash\tbatch\n")
+        for i in sorted(batches):
+            for key in sorted(batches[i]):
+                out.write("%s\t%s\t%s\n" % (key, digests[key], i))
+    os.rename(path + ".tmp", path)
 
 
 def batch_iterator(iterator, batch_size):
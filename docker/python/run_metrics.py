@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+"""
+Run metrics of the scripts of the workflow and their summary per rule
+
+A script records its phases (e.g. parse, transform, write) with Metrics and
+writes one JSON file per invocation when it is given --metrics FILE:
+
+    metrics = run_metrics.Metrics(options.metrics)
+    metrics.start("parse")
+    rows = read_rows(fh)
+    metrics.count(len(rows))
+    metrics.start("write")
+    ...
+    metrics.close()
+
+Each phase and the whole run get their wall time, CPU time (of the process
+and of its finished children) and the bytes read and written
+(/proc/self/io, which includes the finished children), the phases the
+number of records counted in them and the run its peak RSS and the
+largest number of records of a phase.
+The file is written at exit with the status "failed" and the error if
+close() was not reached.
+
+The Snakefile writes the files of a run to <local_log>/metrics/<rule>.json
+or <local_log>/metrics/<rule>/<batch>.json, run this script on that
+directory to summarize them by rule, find stragglers and derive the
+resources of the rules for cluster.json.
+"""
+
+__date__ = "2020-04-07"
+__license__ = "GPL"
+
+# imports
+import os
+import sys
+import json
+import math
+import time
+import atexit
+import socket
+import resource
+from collections import OrderedDict
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+
+# redefine a functions for writing to stdout and stderr to save some writting
+syserr = sys.stderr.write
+sysout = sys.stdout.write
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+MB = 1024.0 * 1024.0
+
+PHASE_FIELDS = ("wall_seconds", "cpu_seconds", "children_cpu_seconds", "bytes_read", "bytes_written")
+
+
+def read_io():
+    """Bytes read and written by this process and its finished children, None without /proc"""
+    try:
+        with open("/proc/self/io") as fh:
+            fields = dict(line.split(":") for line in fh)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def peak_rss():
+    """Peak RSS in bytes of this process and of the largest of its finished children
+
+    VmHWM is used when available because ru_maxrss of a process includes
+    the peak RSS of the process that started it.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    rss = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    return rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * RSS_UNIT
+
+
+def snapshot():
+    """Counters of the process at this moment"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = read_io()
+    return {"wall_seconds": time.perf_counter(),
+            "cpu_seconds": usage.ru_utime + usage.ru_stime,
+            "children_cpu_seconds": children.ru_utime + children.ru_stime,
+            "bytes_read": io[0] if io else None,
+            "bytes_written": io[1] if io else None}
+
+
+def difference(end, start):
+    """Counters of end minus those of start, None if a counter is not available"""
+    return dict((field, None if end[field] is None or start[field] is None else end[field] - start[field])
+                for field in PHASE_FIELDS)
+
+
+def add_argument(parser):
+    """Add the --metrics option to the parser of a script"""
+    parser.add_argument("--metrics",
+                        dest="metrics",
+                        default=None,
+                        help="Write the run time, memory, I/O and records of each phase\n"
+                             "to this JSON file (see run_metrics.py)")
+
+
+class Metrics(object):
+    """Record the phases of one invocation of a script
+
+    Without a path the counters are still kept, so scripts call the same
+    methods whether the metrics are written or not.
+
+    """
+    def __init__(self, path=None, script=None):
+        self.path = path
+        self.script = script or os.path.basename(sys.argv[0])
+        self.phases = OrderedDict()
+        self.current = None
+        self.phase_start = None
+        self.status = None
+        self.error = None
+        self.start_time = time.time()
+        self.begin = snapshot()
+        if path is not None:
+            self.excepthook = sys.excepthook
+            sys.excepthook = self.record_exception
+            atexit.register(self.write)
+
+    def start(self, name):
+        """End the current phase and start (or continue) the phase name"""
+        now = snapshot()
+        self.stop(now)
+        self.entry(name)["calls"] += 1
+        self.current = name
+        self.phase_start = now
+
+    def entry(self, name):
+        """Counters of the phase name"""
+        if name not in self.phases:
+            self.phases[name] = OrderedDict([("calls", 0), ("records", 0)] +
+                                            [(field, 0) for field in PHASE_FIELDS])
+        return self.phases[name]
+
+    def stop(self, now=None):
+        """End the current phase"""
+        if self.current is None:
+            return
+        now = now or snapshot()
+        phase = self.phases[self.current]
+        for field, value in difference(now, self.phase_start).items():
+            phase[field] = None if value is None or phase[field] is None else phase[field] + value
+        self.current = None
+
+    def phase(self, name):
+        """Context manager running a block in the phase name, then going back to the previous phase"""
+        return _Phase(self, name)
+
+    def count(self, records, phase=None):
+        """Add records to a phase, by default to the current one"""
+        phase = phase or self.current
+        if phase is None:
+            raise ValueError("no phase to count %i records in" % records)
+        self.entry(phase)["records"] += records
+
+    def counted(self, iterable, phase=None):
+        """Yield the items of iterable, counting them as records of a phase, by default of the current one"""
+        entry = self.entry(phase or self.current)
+        for item in iterable:
+            entry["records"] += 1
+            yield item
+
+    def record_exception(self, kind, value, traceback):
+        self.status = "failed"
+        self.error = "%s: %s" % (kind.__name__, value)
+        self.excepthook(kind, value, traceback)
+
+    def close(self):
+        """End the run successfully and write the metrics"""
+        if self.status is None:
+            self.status = "ok"
+        self.write()
+
+    def report(self):
+        """Metrics of the run as a dictionary"""
+        self.stop()
+        total = difference(snapshot(), self.begin)
+        rss, children_rss = peak_rss()
+        report = OrderedDict([("script", self.script),
+                              ("argv", sys.argv[1:]),
+                              ("host", socket.gethostname()),
+                              ("pid", os.getpid()),
+                              ("start", time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start_time))),
+                              ("status", self.status or "failed"),
+                              ("error", self.error),
+                              ("peak_rss_mb", round(rss / MB, 1)),
+                              ("children_peak_rss_mb", round(children_rss / MB, 1)),
+                              ("records", max([phase["records"] for phase in self.phases.values()] or [0]))])
+        report.update(total)
+        report["phases"] = self.phases
+        for values in [report] + list(self.phases.values()):
+            for field in ("wall_seconds", "cpu_seconds", "children_cpu_seconds"):
+                if values[field] is not None:
+                    values[field] = round(values[field], 4)
+        return report
+
+    def write(self):
+        """Write the metrics to the JSON file, once"""
+        if self.path is None:
+            return
+        path, self.path = self.path, None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path + ".tmp", 'w') as out:
+            json.dump(self.report(), out, indent=2)
+            out.write("\n")
+        os.rename(path + ".tmp", path)
+
+
+class _Phase(object):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.previous = self.metrics.current
+        self.metrics.start(self.name)
+        return self
+
+    def count(self, records):
+        self.metrics.count(records, self.name)
+
+    def __exit__(self, *args):
+        if self.previous is not None:
+            self.metrics.start(self.previous)
+        else:
+            self.metrics.stop()
+
+
+def read_metrics(directory, since=None):
+    """Read the metrics files below directory
+
+    :param since: only read the metrics of jobs started at or after this
+                  time (YYYY-MM-DDTHH:MM:SS), e.g. those of the last run
+
+    :returns: list of (rule, batch, metrics), the rule is the first path
+              component below directory and the batch the rest of the path
+
+    """
+    jobs = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(root, name)
+            parts = os.path.relpath(path, directory)[:-len(".json")].split(os.sep)
+            with open(path) as fh:
+                try:
+                    metrics = json.load(fh)
+                except ValueError:
+                    syserr("Skipping %s, it is not a metrics file\n" % path)
+                    continue
+            if since is not None and metrics.get("start", "") < since:
+                continue
+            jobs.append((parts[0], "/".join(parts[1:]), metrics))
+    return jobs
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def total(values):
+    """Sum of the values, None if one of them is not known"""
+    values = list(values)
+    return None if any(value is None for value in values) else sum(values)
+
+
+def summarize(jobs, straggler_factor=2.0, straggler_seconds=10.0):
+    """Summarize the jobs of a run by rule
+
+    :param jobs: list of (rule, batch, metrics) of read_metrics
+    :param straggler_factor: jobs running this many times longer than the
+                             median of their rule are stragglers
+    :param straggler_seconds: jobs faster than this are never stragglers
+    :returns: summary of each rule and the stragglers
+
+    """
+    rules = OrderedDict()
+    for rule, batch, metrics in sorted(jobs, key=lambda job: (job[0], job[1])):
+        rules.setdefault(rule, []).append((batch, metrics))
+
+    summary = OrderedDict()
+    stragglers = []
+    for rule, runs in rules.items():
+        walls = [metrics["wall_seconds"] for batch, metrics in runs]
+        slowest = max(runs, key=lambda run: run[1]["wall_seconds"])
+        largest = max(runs, key=lambda run: run[1]["peak_rss_mb"] + run[1]["children_peak_rss_mb"])
+        phases = OrderedDict()
+        for batch, metrics in runs:
+            for name, phase in metrics["phases"].items():
+                if name not in phases:
+                    phases[name] = OrderedDict((field, []) for field in ("records",) + PHASE_FIELDS)
+                for field in phases[name]:
+                    phases[name][field].append(phase[field])
+        summary[rule] = OrderedDict([
+            ("jobs", len(runs)),
+            ("failed", [batch for batch, metrics in runs if metrics["status"] != "ok"]),
+            ("wall_seconds_total", round(sum(walls), 2)),
+            ("wall_seconds_median", round(median(walls), 2)),
+            ("wall_seconds_max", round(max(walls), 2)),
+            ("slowest", slowest[0]),
+            ("cpu_seconds_total", round(sum(metrics["cpu_seconds"] + metrics["children_cpu_seconds"]
+                                            for batch, metrics in runs), 2)),
+            ("peak_rss_mb_max", round(largest[1]["peak_rss_mb"] + largest[1]["children_peak_rss_mb"], 1)),
+            ("largest", largest[0]),
+            ("bytes_read", total(metrics["bytes_read"] for batch, metrics in runs)),
+            ("bytes_written", total(metrics["bytes_written"] for batch, metrics in runs)),
+            ("records", sum(metrics["records"] for batch, metrics in runs)),
+            ("phases", OrderedDict((name, OrderedDict((field, total(values)) for field, values in fields.items()))
+                                   for name, fields in phases.items()))])
+        if len(runs) > 1:
+            middle = median(walls) or 0.01
+            limit = max(straggler_factor * middle, straggler_seconds)
+            stragglers.extend(OrderedDict([("rule", rule), ("batch", batch),
+                                           ("wall_seconds", metrics["wall_seconds"]),
+                                           ("times_median", round(metrics["wall_seconds"] / middle, 1)),
+                                           ("host", metrics["host"])])
+                              for batch, metrics in runs if metrics["wall_seconds"] > limit)
+    return summary, sorted(stragglers, key=lambda s: -s["times_median"])
+
+
+def cluster_resources(summary, cluster_config=None, memory_margin=1.5, time_margin=2.0):
+    """Resources of each rule in the cluster.json format
+
+    The memory is the largest peak RSS (with the children) and the time the
+    longest run of the rule, times the margins, rounded up to whole GB and
+    minutes. Other settings of the rules and __default__ are kept.
+
+    """
+    resources = OrderedDict()
+    for rule, values in (cluster_config or {}).items():
+        resources[rule] = OrderedDict(values)
+    for rule, values in summary.items():
+        memory = max(1, int(math.ceil(values["peak_rss_mb_max"] * memory_margin / 1024.0)))
+        minutes = max(10, int(math.ceil(values["wall_seconds_max"] * time_margin / 60.0)))
+        resources.setdefault(rule, OrderedDict())
+        resources[rule]["mem"] = "%iG" % memory
+        resources[rule]["time"] = "%02i:%02i:00" % (minutes // 60, minutes % 60)
+    return resources
+
+
+def format_bytes(value):
+    return "-" if value is None else "%.1f" % (value / MB)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    parser.add_argument("metrics_dir",
+                        help="Directory with the metrics files of a run")
+    parser.add_argument("--output",
+                        dest="output",
+                        default=None,
+                        help="Write the summary, the stragglers and the jobs as JSON to this file")
+    parser.add_argument("--stragglers",
+                        dest="stragglers",
+                        type=float,
+                        default=2.0,
+                        help="Jobs running this many times longer than the median of their\n"
+                             "rule are reported as stragglers, defaults to 2")
+    parser.add_argument("--straggler-seconds",
+                        dest="straggler_seconds",
+                        type=float,
+                        default=10.0,
+                        help="Jobs faster than this are never reported as stragglers,\n"
+                             "defaults to 10")
+    parser.add_argument("--since",
+                        dest="since",
+                        default=None,
+                        help="Only summarize the jobs started at or after this time\n"
+                             "(YYYY-MM-DDTHH:MM:SS), e.g. the start of the last run")
+    parser.add_argument("--cluster-config",
+                        dest="cluster_config",
+                        default=None,
+                        help="cluster.json to update with the resources measured for each rule")
+    parser.add_argument("--cluster-output",
+                        dest="cluster_output",
+                        default=None,
+                        help="Write the cluster configuration with the measured memory and time\n"
+                             "of each rule (with margins) to this file")
+    options = parser.parse_args()
+
+    jobs = read_metrics(options.metrics_dir, options.since)
+    if not jobs:
+        syserr("No metrics files in %s%s\n" % (options.metrics_dir,
+                                                 "" if options.since is None else " since " + options.since))
+        sys.exit(1)
+    summary, stragglers = summarize(jobs, options.stragglers, options.straggler_seconds)
+
+    sysout("%-40s %5s %6s %10s %10s %10s %10s %10s %10s %12s  %s\n"
+           % ("rule", "jobs", "failed", "wall_sum", "wall_med", "wall_max", "cpu_sum",
+              "rss_max_mb", "read_mb", "records", "slowest"))
+    for rule, values in summary.items():
+        sysout("%-40s %5i %6i %10.1f %10.1f %10.1f %10.1f %10.1f %10s %12i  %s\n"
+               % (rule, values["jobs"], len(values["failed"]), values["wall_seconds_total"],
+                  values["wall_seconds_median"], values["wall_seconds_max"], values["cpu_seconds_total"],
+                  values["peak_rss_mb_max"], format_bytes(values["bytes_read"]), values["records"],
+                  values["slowest"]))
+    for straggler in stragglers:
+        sysout("straggler: %s %s %.1f s (%.1f times the median) on %s\n"
+               % (straggler["rule"], straggler["batch"], straggler["wall_seconds"],
+                  straggler["times_median"], straggler["host"]))
+
+    if options.output is not None:
+        with open(options.output, 'w') as out:
+            json.dump(OrderedDict([("rules", summary),
+                                   ("stragglers", stragglers),
+                                   ("jobs", [OrderedDict([("rule", rule), ("batch", batch), ("metrics", metrics)])
+                                             for rule, batch, metrics in jobs])]), out, indent=2)
+            out.write("\n")
+    if options.cluster_output is not None:
+        cluster_config = None
+        if options.cluster_config is not None:
+            with open(options.cluster_config) as fh:
+                cluster_config = json.load(fh, object_pairs_hook=OrderedDict)
+        with open(options.cluster_output, 'w') as out:
+            json.dump(cluster_resources(summary, cluster_config), out, indent=2)
+            out.write("\n")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        syserr("Interrupted by user\n")
+        sys.exit(1)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+__version__ = "0.1"
+__doc__ = "Split the pairwise alignments of all organisms of an assemblies file by chromosome"
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# import needed (external) modules
+# -----------------------------------------------------------------------------
+
+import sys
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import axt_index
+import newick
+import run_metrics
+from split_pairwise_alignments_by_chromosome import (
+    open_alignment,
+    compression_format,
+    split_alignment,
+    split_chunk,
+    plain_chunks,
+    read_plain_chunk,
+    bgzip_chunks,
+    read_bgzip_chunk,
+    merge_chromosome,
+    group_contigs,
+    write_done,
+    MAX_OPEN_FILES
+)
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Workers
+# -----------------------------------------------------------------------------
+
+# semaphore shared by all workers, held while reading from an alignment file.
+# It is set before the pool is started and inherited by the forked workers.
+IO_THROTTLE = None
+
+
+def split_stream(path, out, max_open=MAX_OPEN_FILES):
+
+    """ Decompress and split a whole (gzip compressed) alignment file """
+
+    with open_alignment(path, throttle=IO_THROTTLE) as fp:
+        return split_alignment(fp, out, max_open=max_open)
+
+
+def split_throttled_chunk(index, reader, path, start, end, out, max_open=MAX_OPEN_FILES):
+
+    """ Read a chunk of the alignment file holding the I/O semaphore and split it """
+
+    with IO_THROTTLE:
+        data = reader(path, start, end)
+    return split_chunk(index, data, out, max_open)
+
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Scheduling
+# -----------------------------------------------------------------------------
+
+def organism_jobs(alignments_dir, reference, assemblies):
+
+    """
+    Return (assembly, alignment file, output directory) for each assembly.
+    The directory of an organism is named <reference>_to_<species> as in the
+    pipeline, or <reference>_to_<assembly> as written by the text file
+    download script.
+    """
+
+    jobs = []
+    for assembly in assemblies:
+        species = newick.assembly_name(assembly)
+        for name in (species, assembly):
+            out = os.path.join(alignments_dir, reference + "_to_" + name)
+            path = os.path.join(out, reference + "." + name + ".net.axt.gz")
+            if os.path.exists(path):
+                jobs.append((assembly, path, out))
+                break
+        else:
+            raise IOError("No pairwise alignment found for " + assembly)
+    return jobs
+
+
+def split_organisms(jobs, processes, io_slots, chunk_size, post_processing=(),
+                    max_open=MAX_OPEN_FILES, group_size=0, verbose=False):
+
+    """
+    Split the alignment files of all organisms with one pool of processes:
+    gzip files are decompressed and split as a whole by one worker each,
+    plain and bgzip files are cut into chunks that are split independently
+    and merged per chromosome. Reads from the alignment files are limited to
+    io_slots at a time across all workers. Chromosomes with less than
+    group_size bytes of alignments are grouped into one contigs.axt file
+    (see group_contigs). Largest files are scheduled
+    first for a better packing of the workers. Once all chromosome files of
+    an organism are written (and post processed), its Done file is written.
+    Returns a dictionary with the number of records per chromosome per
+    organism.
+    """
+
+    global IO_THROTTLE
+    IO_THROTTLE = multiprocessing.BoundedSemaphore(io_slots)
+    results = {}
+    # per organism: output directory, chunk counts per chromosome, pending futures
+    state = {}
+    tasks = {}
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+
+        def submit(name, stage, function, *args):
+            future = executor.submit(function, *args)
+            tasks[future] = (name, stage)
+            state[name]["pending"].add(future)
+
+        def post_process(name):
+            out = state[name]["out"]
+            if group_size > 0:
+                for chromosome in group_contigs(out, results[name], group_size):
+                    del results[name][chromosome]
+            for function in post_processing:
+                for chromosome in results[name]:
+                    submit(name, "post", function, os.path.join(out, chromosome + '.axt'))
+            if not state[name]["pending"]:
+                finish(name)
+
+        def finish(name):
+            write_done(state[name]["out"])
+            if verbose:
+                sys.stderr.write("Split %s into %i chromosomes%s" % (name, len(results[name]), os.linesep))
+
+        for name, path, out in sorted(jobs, key=lambda job: -os.path.getsize(job[1])):
+            if not os.path.exists(out):
+                os.makedirs(out)
+            state[name] = {"out": out, "chunks": {}, "pending": set()}
+            compression = compression_format(path)
+            if compression == 'gzip':
+                submit(name, "stream", split_stream, path, out, max_open)
+                continue
+            if compression == 'bgzip':
+                chunks, reader = bgzip_chunks(path, chunk_size), read_bgzip_chunk
+            else:
+                chunks, reader = plain_chunks(path, chunk_size), read_plain_chunk
+            for index, (start, end) in enumerate(chunks):
+                submit(name, "chunk", split_throttled_chunk, index, reader, path, start, end, out, max_open)
+
+        while tasks:
+            done, _ = wait(list(tasks), return_when=FIRST_COMPLETED)
+            for future in done:
+                name, stage = tasks.pop(future)
+                organism = state[name]
+                organism["pending"].discard(future)
+                result = future.result()
+                if stage == "stream":
+                    results[name] = result
+                elif stage == "chunk":
+                    index, chunk_counts = result
+                    for chromosome, count in chunk_counts.items():
+                        organism["chunks"].setdefault(chromosome, []).append((index, count))
+                if organism["pending"]:
+                    continue
+                # all tasks of the current stage of the organism are done
+                if stage == "chunk":
+                    results[name] = dict((key, sum(c for i, c in value))
+                                         for key, value in organism["chunks"].items())
+                    for chromosome, value in organism["chunks"].items():
+                        submit(name, "merge", merge_chromosome, organism["out"], chromosome, sorted(value))
+                    if not organism["pending"]:
+                        post_process(name)
+                elif stage in ("stream", "merge"):
+                    post_process(name)
+                else:
+                    finish(name)
+
+    return results
+
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Main function
+# -----------------------------------------------------------------------------
+
+
+def main():
+    """ Main function """
+
+    parser = ArgumentParser(
+        description=__doc__,
+        formatter_class=RawTextHelpFormatter
+    )
+
+    parser.add_argument(
+        "--assemblies",
+        dest="assemblies",
+        help="File with the comma separated assemblies (e.g. assemblies.txt)",
+        required=True,
+        metavar="FILE"
+    )
+
+    parser.add_argument(
+        "--reference",
+        dest="reference",
+        help="Reference assembly (e.g. hg38)",
+        required=True
+    )
+
+    parser.add_argument(
+        "--alignments-dir",
+        dest="alignments_dir",
+        help="Directory with the <reference>_to_<organism> directories",
+        required=True,
+        metavar="DIR"
+    )
+
+    parser.add_argument(
+        "--processes",
+        dest="processes",
+        type=int,
+        default=1,
+        help="Number of worker processes shared by all organisms, defaults to 1"
+    )
+
+    parser.add_argument(
+        "--io-slots",
+        dest="io_slots",
+        type=int,
+        default=2,
+        help="Number of workers that may read alignment files at the same time, defaults to 2"
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        type=int,
+        default=64,
+        help="Size (MB) of the chunks of plain and bgzip files that are split in parallel, defaults to 64"
+    )
+
+    parser.add_argument(
+        "--max-open-files",
+        dest="max_open_files",
+        type=int,
+        default=MAX_OPEN_FILES,
+        help="Number of chromosome files each worker keeps open at the same time, defaults to %i" % MAX_OPEN_FILES
+    )
+
+    parser.add_argument(
+        "--group-contigs",
+        dest="group_contigs",
+        type=int,
+        default=0,
+        help="Group the chromosomes with less than this many bytes of alignments\n"
+             "into one indexed contigs.axt file, defaults to 0 (no grouping)"
+    )
+
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        dest="index",
+        default=False,
+        required=False,
+        help="Write an interval index next to each chromosome axt file"
+    )
+
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        dest="columnar",
+        default=False,
+        required=False,
+        help="Also write each chromosome as memory-mappable numpy columns (requires numpy)"
+    )
+
+    run_metrics.add_argument(parser)
+
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        dest="verbose",
+        default=False,
+        required=False,
+        help="Verbose"
+    )
+
+    parser.add_argument(
+        '--version',
+        action='version',
+        version=__version__
+    )
+
+    # _________________________________________________________________________
+    # -------------------------------------------------------------------------
+    # get the arguments
+    # -------------------------------------------------------------------------
+    try:
+        options = parser.parse_args()
+    except(Exception):
+        parser.print_help()
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    if options.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1 (MB)")
+
+    with open(options.assemblies) as fp:
+        assemblies = [x.strip() for x in fp.read().split(',') if x.strip()]
+
+    post_processing = []
+    if options.index:
+        post_processing.append(axt_index.index_chromosome)
+    if options.columnar:
+        import axt_columns
+        post_processing.append(axt_columns.write_columns)
+
+    metrics = run_metrics.Metrics(options.metrics)
+    metrics.start("split")
+    metrics.count(len(assemblies))
+    split_organisms(organism_jobs(options.alignments_dir, options.reference, assemblies),
+                    options.processes,
+                    options.io_slots,
+                    options.chunk_size * 1024 * 1024,
+                    post_processing,
+                    options.max_open_files,
+                    options.group_contigs,
+                    options.verbose)
+    metrics.close()
+
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Call the Main function and catch Keyboard interrups
+# -----------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.stderr.write("User interrupt!" + os.linesep)
+        sys.exit(0)
@@ -12,13 +12,120 @@ __doc__ = "Split pairwise alignment in files based on the chromosome"
 
 import sys
 import os
+import io
+import gzip
+import zlib
+import struct
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
 from argparse import ArgumentParser, RawTextHelpFormatter
 
+import axt_index
+import run_metrics
+
 # _____________________________________________________________________________
 # -----------------------------------------------------------------------------
 # Main function
 # -----------------------------------------------------------------------------
 
+# magic number shared by gzip and bgzip (blocked gzip) files
+GZIP_MAGIC = b'\x1f\x8b'
+
+# size of the buffer used for reading the (compressed) alignment stream
+BUFFER_SIZE = 16 * 1024 * 1024
+
+
+# records in an axt file are separated by an empty line
+RECORD_SEPARATOR = b'\n\n'
+
+# size of the header of a bgzip block, up to and including BSIZE
+BGZF_HEADER_SIZE = 18
+
+# size of the buffer of a chromosome that triggers a write to its file
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# size of all chromosome buffers that triggers a write of all of them
+MAX_BUFFERED = 64 * 1024 * 1024
+
+# number of chromosome files that are kept open at the same time
+MAX_OPEN_FILES = 128
+
+# file and index of the chromosomes grouped by group_contigs
+GROUPED_CONTIGS = axt_index.GROUPED_CONTIGS
+GROUPED_CONTIGS_INDEX = axt_index.GROUPED_CONTIGS_INDEX
+
+
+class ThrottledRawIO(io.RawIOBase):
+
+    """
+    Raw file whose reads are done while holding throttle, a semaphore that
+    can be shared between processes to bound the number of concurrent reads.
+    """
+
+    def __init__(self, fh, throttle):
+        self.fh = fh
+        self.throttle = throttle
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        with self.throttle:
+            return self.fh.readinto(b)
+
+    def close(self):
+        self.fh.close()
+        super(ThrottledRawIO, self).close()
+
+
+@contextmanager
+def open_alignment(path, buffer_size=BUFFER_SIZE, binary=False, throttle=None):
+
+    """
+    Open a pairwise alignment file for streaming:
+    Plain text, gzip and bgzip compressed files are recognized from their
+    magic number and returned as a text stream with large buffered reads,
+    so compressed alignments do not need to be uncompressed on disk first.
+    With binary=True the uncompressed byte stream is returned instead.
+    Each read of the file is done while holding throttle, if given.
+    """
+
+    if throttle is None:
+        raw = open(path, 'rb', buffering=buffer_size)
+    else:
+        raw = io.BufferedReader(ThrottledRawIO(open(path, 'rb', buffering=0), throttle), buffer_size)
+    with raw:
+        if raw.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+            # bgzip files are concatenated gzip members, which gzip reads
+            stream = io.BufferedReader(
+                gzip.GzipFile(fileobj=raw, mode='rb'),
+                buffer_size
+            )
+        else:
+            stream = raw
+        if binary:
+            yield stream
+        else:
+            with io.TextIOWrapper(stream) as fp:
+                yield fp
+
+
+def compression_format(path):
+
+    """ Return 'plain', 'gzip' or 'bgzip' depending on the file header """
+
+    with open(path, 'rb') as fh:
+        header = fh.read(BGZF_HEADER_SIZE)
+    if header[:len(GZIP_MAGIC)] != GZIP_MAGIC:
+        return 'plain'
+    # bgzip sets FEXTRA and stores the block size in a 'BC' subfield
+    if len(header) == BGZF_HEADER_SIZE and header[3] & 4 and header[12:14] == b'BC':
+        return 'bgzip'
+    return 'gzip'
+
+
 def readAlignment(fp):
 
     """
@@ -47,6 +154,425 @@ def find_chromosome(l):
     return l.strip().split(" ")[1]
 
 
+class ChromosomeWriter(object):
+
+    """
+    Write text into one <chromosome>.axt<suffix> file per chromosome:
+    The text of each chromosome is buffered in memory and written in blocks
+    of buffer_size, all buffers are written when they hold more than
+    max_buffered in total. At most max_open files are open at the same time,
+    the least recently used one is closed and later reopened for appending,
+    so assemblies with many thousand contigs stay below the open file limit.
+    """
+
+    def __init__(self, out, suffix="", buffer_size=WRITE_BUFFER_SIZE,
+                 max_buffered=MAX_BUFFERED, max_open=MAX_OPEN_FILES):
+        self.out = out
+        self.suffix = suffix
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+        self.max_open = max_open
+        self.buffers = {}
+        self.sizes = {}
+        self.buffered = 0
+        self.handles = OrderedDict()
+        self.created = set()
+
+    def write(self, chromosome, text):
+        buffer = self.buffers.get(chromosome)
+        if buffer is None:
+            buffer = self.buffers[chromosome] = []
+            self.sizes[chromosome] = 0
+        buffer.append(text)
+        self.sizes[chromosome] += len(text)
+        self.buffered += len(text)
+        if self.sizes[chromosome] >= self.buffer_size:
+            self.flush(chromosome)
+        elif self.buffered >= self.max_buffered:
+            self.flush_all()
+
+    def handle(self, chromosome):
+        fh = self.handles.pop(chromosome, None)
+        if fh is None:
+            if len(self.handles) >= self.max_open:
+                self.handles.popitem(last=False)[1].close()
+            mode = 'a' if chromosome in self.created else 'w'
+            fh = open(os.path.join(self.out, chromosome + '.axt' + self.suffix), mode)
+            self.created.add(chromosome)
+        # most recently used handles are at the end
+        self.handles[chromosome] = fh
+        return fh
+
+    def flush(self, chromosome):
+        if self.sizes[chromosome]:
+            self.handle(chromosome).write("".join(self.buffers[chromosome]))
+            self.buffered -= self.sizes[chromosome]
+            self.buffers[chromosome] = []
+            self.sizes[chromosome] = 0
+
+    def flush_all(self):
+        for chromosome in self.buffers:
+            self.flush(chromosome)
+
+    def close(self):
+        self.flush_all()
+        for fh in self.handles.values():
+            fh.close()
+        self.handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def split_alignment(fp, out, suffix="", max_open=MAX_OPEN_FILES):
+
+    """
+    Write the alignments of fp into one <chromosome>.axt file per chromosome
+    in the out directory, renumbering the records of each chromosome from 0.
+    Returns a dictionary with the number of records written per chromosome.
+    """
+
+    # counter that keeps track of the numbering for each chromosome
+    chromosomes_counter = {}
+
+    # buffered writer for all chromosome files
+    with ChromosomeWriter(out, suffix, max_open=max_open) as writer:
+        for name, alignment1, alignment2 in readAlignment(fp):
+
+            # find the chomosome that it belongs
+            chromosome = find_chromosome(name)
+
+            # increase the counter for the correct chromosome
+            if chromosome not in chromosomes_counter:
+                chromosomes_counter[chromosome] = 0
+            else:
+                chromosomes_counter[chromosome] += 1
+
+            # add the correct counting 
+            name = name.split(" ") 
+            name[0] = str(chromosomes_counter[chromosome])
+            name = " ".join(name)
+
+            # write output files
+            writer.write(chromosome, name + alignment1 + alignment2 + os.linesep)
+
+    return dict((key, value + 1) for key, value in chromosomes_counter.items())
+
+
+def group_contigs(out, counts, max_size):
+
+    """
+    Move the <chromosome>.axt files of out that are smaller than max_size
+    bytes into one contigs.axt file, indexed by contigs.axt.index with the
+    chromosome, byte offset, length and number of records of each of them.
+    Readers fall back to axt_index.read_grouped_chromosome for chromosomes
+    without their own file. Returns the grouped chromosomes.
+    """
+
+    grouped = [chromosome for chromosome in sorted(counts)
+               if os.path.getsize(os.path.join(out, chromosome + '.axt')) < max_size]
+    if not grouped:
+        return grouped
+    offset = 0
+    with open(os.path.join(out, GROUPED_CONTIGS), 'wb') as w, \
+            open(os.path.join(out, GROUPED_CONTIGS_INDEX), 'w') as index:
+        for chromosome in grouped:
+            path = os.path.join(out, chromosome + '.axt')
+            size = os.path.getsize(path)
+            with open(path, 'rb') as fp:
+                w.write(fp.read())
+            index.write("%s\t%i\t%i\t%i\n" % (chromosome, offset, size, counts[chromosome]))
+            offset += size
+            os.remove(path)
+    return grouped
+
+
+read_grouped_chromosome = axt_index.read_grouped_chromosome
+
+
+# _____________________________________________________________________________
+# -----------------------------------------------------------------------------
+# Parallel splitting
+# -----------------------------------------------------------------------------
+
+def next_record_start(data, position):
+
+    """
+    Return the first position at or after position in data where a record
+    starts (the line after an empty line), or None if there is none.
+    """
+
+    index = data.find(RECORD_SEPARATOR, max(position - 1, 0))
+    if index == -1:
+        return None
+    return index + len(RECORD_SEPARATOR)
+
+
+def plain_chunks(path, chunk_size):
+
+    """
+    Find record aligned byte offsets in an uncompressed alignment file and
+    return them as (start, end) ranges of roughly chunk_size bytes.
+    """
+
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as fh:
+        position = chunk_size
+        while position < size:
+            fh.seek(position - 1)
+            data = b''
+            start = None
+            # extend the window until a record separator is found
+            while start is None:
+                block = fh.read(BUFFER_SIZE)
+                if not block:
+                    break
+                data += block
+                start = next_record_start(data, 1)
+            if start is None:
+                break
+            start += position - 1
+            if start >= size:
+                break
+            offsets.append(start)
+            position = start + chunk_size
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def read_plain_chunk(path, start, end):
+
+    """ Read bytes start to end of an uncompressed file """
+
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        return fh.read(end - start)
+
+
+def bgzf_blocks(fh, offset=0):
+
+    """
+    Bgzip block generator:
+    Yield the file offset and the uncompressed data of each bgzip block,
+    starting from the block at offset.
+    """
+
+    fh.seek(offset)
+    while True:
+        header = fh.read(BGZF_HEADER_SIZE)
+        if len(header) < BGZF_HEADER_SIZE:
+            return
+        block_size = struct.unpack('<H', header[16:18])[0] + 1
+        cdata = fh.read(block_size - BGZF_HEADER_SIZE)
+        # compressed data without the CRC32 and ISIZE trailer
+        yield offset, zlib.decompress(cdata[:-8], -zlib.MAX_WBITS)
+        offset += block_size
+
+
+def bgzf_block_offsets(fh):
+
+    """ Return the file offsets of all bgzip blocks, reading only headers """
+
+    offsets = []
+    offset = 0
+    fh.seek(0)
+    while True:
+        header = fh.read(BGZF_HEADER_SIZE)
+        if len(header) < BGZF_HEADER_SIZE:
+            return offsets
+        offsets.append(offset)
+        offset += struct.unpack('<H', header[16:18])[0] + 1
+        fh.seek(offset)
+
+
+def bgzip_chunks(path, chunk_size):
+
+    """
+    Find record aligned virtual offsets (block offset, offset within the
+    uncompressed block) in a bgzip compressed alignment file and return them
+    as (start, end) ranges of roughly chunk_size compressed bytes.
+    The end of the last range is None.
+    """
+
+    offsets = [(0, 0)]
+    with open(path, 'rb') as fh:
+        blocks = bgzf_block_offsets(fh)
+        candidates = [b for a, b in zip(blocks[:-1], blocks[1:]) if b // chunk_size != a // chunk_size]
+        for candidate in candidates:
+            if offsets[-1][0] >= candidate:
+                continue
+            data = b''
+            starts = []
+            start = None
+            for block_offset, block in bgzf_blocks(fh, candidate):
+                starts.append((len(data), block_offset))
+                data += block
+                start = next_record_start(data, 0)
+                # the record has to start within the data read so far
+                if start is not None and start < len(data):
+                    break
+                start = None
+            if start is None:
+                break
+            for position, block_offset in reversed(starts):
+                if position <= start:
+                    offsets.append((block_offset, start - position))
+                    break
+    offsets.append(None)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def read_bgzip_chunk(path, start, end):
+
+    """ Read the uncompressed bytes between two virtual offsets """
+
+    data = []
+    with open(path, 'rb') as fh:
+        for block_offset, block in bgzf_blocks(fh, start[0]):
+            if end is not None and block_offset == end[0]:
+                block = block[:end[1]]
+            if block_offset == start[0]:
+                block = block[start[1]:]
+            data.append(block)
+            if end is not None and block_offset == end[0]:
+                break
+    return b''.join(data)
+
+
+def part_suffix(index):
+
+    """ Suffix of the per chromosome part files of a chunk """
+
+    return ".part_%06d" % index
+
+
+def split_chunk(index, data, out, max_open=MAX_OPEN_FILES):
+
+    """
+    Split one record aligned chunk of the alignment into per chromosome part
+    files. Returns the chunk index and the number of records per chromosome.
+    """
+
+    fp = io.StringIO(data.decode(), newline=None)
+    return index, split_alignment(fp, out, part_suffix(index), max_open)
+
+
+def split_file_chunk(index, reader, path, start, end, out, max_open=MAX_OPEN_FILES):
+
+    """ Read a chunk of the alignment file and split it """
+
+    return split_chunk(index, reader(path, start, end), out, max_open)
+
+
+def stream_chunks(path, chunk_size):
+
+    """
+    Chunk generator for gzip compressed files that cannot be seeked into:
+    Read the uncompressed stream and yield record aligned chunks of roughly
+    chunk_size bytes.
+    """
+
+    rest = b''
+    with open_alignment(path, binary=True) as fh:
+        while True:
+            block = fh.read(chunk_size)
+            if not block:
+                break
+            data = rest + block
+            index = data.rfind(RECORD_SEPARATOR)
+            if index == -1:
+                rest = data
+                continue
+            index += len(RECORD_SEPARATOR)
+            rest = data[index:]
+            yield data[:index]
+    if rest:
+        yield rest
+
+
+def merge_chromosome(out, chromosome, counts):
+
+    """
+    Concatenate the part files of a chromosome in chunk order into
+    <chromosome>.axt, shifting the record numbers of each part by the number
+    of records of the chromosome in the previous chunks.
+    """
+
+    shift = 0
+    with open(os.path.join(out, chromosome + '.axt'), 'w') as w:
+        for index, count in counts:
+            part = os.path.join(out, chromosome + '.axt' + part_suffix(index))
+            with open(part) as fp:
+                if shift == 0:
+                    shutil.copyfileobj(fp, w, BUFFER_SIZE)
+                else:
+                    for line in fp:
+                        if line[0].isdigit():
+                            number, rest = line.split(" ", 1)
+                            line = str(int(number) + shift) + " " + rest
+                        w.write(line)
+            os.remove(part)
+            shift += count
+    return chromosome
+
+
+def split_alignment_parallel(path, out, processes, chunk_size, max_open=MAX_OPEN_FILES):
+
+    """
+    Split the alignment file with a pool of processes:
+    The file is cut into record aligned chunks that are split independently
+    into per chromosome part files, which are then merged per chromosome.
+    Returns a dictionary with the number of records written per chromosome.
+    """
+
+    counts = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        compression = compression_format(path)
+        futures = []
+        if compression == 'gzip':
+            # the stream is cut in this process, keep a bounded number
+            # of chunks in flight to bound the memory
+            pending = set()
+            for index, data in enumerate(stream_chunks(path, chunk_size)):
+                if len(pending) >= 2 * processes:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                future = executor.submit(split_chunk, index, data, out, max_open)
+                pending.add(future)
+                futures.append(future)
+        else:
+            if compression == 'bgzip':
+                chunks, reader = bgzip_chunks(path, chunk_size), read_bgzip_chunk
+            else:
+                chunks, reader = plain_chunks(path, chunk_size), read_plain_chunk
+            for index, (start, end) in enumerate(chunks):
+                futures.append(executor.submit(split_file_chunk, index, reader, path, start, end, out, max_open))
+
+        for future in futures:
+            index, chunk_counts = future.result()
+            for chromosome, count in chunk_counts.items():
+                counts.setdefault(chromosome, []).append((index, count))
+
+        merges = [executor.submit(merge_chromosome, out, chromosome, sorted(value))
+                  for chromosome, value in counts.items()]
+        for future in merges:
+            future.result()
+
+    return dict((key, sum(c for i, c in value)) for key, value in counts.items())
+
+
+def write_done(out):
+
+    """ Touch the file that marks the output directory as complete """
+
+    w = open(os.path.join(out, 'Done'), 'w')
+    w.write("Done" + os.linesep)
+    w.close()
+
+
 def main():
     """ Main function """
 
@@ -58,7 +584,7 @@ def main():
     parser.add_argument(
         "--alignment",
         dest="alignment",
-        help="Pairwise alignment file",
+        help="Pairwise alignment file (plain, gzip or bgzip compressed)",
         required=True,
         metavar="FILE"
     )
@@ -71,6 +597,59 @@ def main():
         metavar="FILE"
     )
 
+    parser.add_argument(
+        "--processes",
+        dest="processes",
+        type=int,
+        default=1,
+        help="Number of processes used to split the alignment file, defaults to 1"
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        type=int,
+        default=64,
+        help="Size (MB) of the chunks that are split in parallel, defaults to 64"
+    )
+
+    parser.add_argument(
+        "--max-open-files",
+        dest="max_open_files",
+        type=int,
+        default=MAX_OPEN_FILES,
+        help="Number of chromosome files kept open at the same time, defaults to %i" % MAX_OPEN_FILES
+    )
+
+    parser.add_argument(
+        "--group-contigs",
+        dest="group_contigs",
+        type=int,
+        default=0,
+        help="Group the chromosomes with less than this many bytes of alignments\n"
+             "into one indexed contigs.axt file, defaults to 0 (no grouping)"
+    )
+
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        dest="index",
+        default=False,
+        required=False,
+        help="Write an interval index next to each chromosome axt file"
+    )
+
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        dest="columnar",
+        default=False,
+        required=False,
+        help="Also write each chromosome as memory-mappable numpy columns (requires numpy)"
+    )
+
+    run_metrics.add_argument(parser)
+
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -99,48 +678,56 @@ def main():
         parser.print_help()
         sys.exit(1)
 
-    # counter that keeps track of the numbering for each chromosome
-    chromosomes_counter = {}
-    # dictionaty of file handles for each chromosome
-    chromosomes_fh = {}
-
-    # parse the full alignment file
-    with open(options.alignment) as fp:
-        for name, alignment1, alignment2 in readAlignment(fp):
-
-            # find the chomosome that it belongs
-            chromosome = find_chromosome(name)
-
-            # increase the counter for the correct chromosome
-            if chromosome not in chromosomes_counter:
-                chromosomes_counter[chromosome] = 0
-            else:
-                chromosomes_counter[chromosome] += 1
+    if options.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1 (MB)")
 
-            # leave the file handle open for each chromosome
-            # for faster writing to the file system
-            if chromosome not in chromosomes_fh:
-                chromosomes_fh[chromosome] = open(os.path.join(options.out, chromosome + '.axt'), 'w')
+    metrics = run_metrics.Metrics(options.metrics)
 
-            # add the correct counting 
-            name = name.split(" ") 
-            name[0] = str(chromosomes_counter[chromosome])
-            name = " ".join(name)
-
-            # write output files
-            chromosomes_fh[chromosome].write(name)
-            chromosomes_fh[chromosome].write(alignment1)
-            chromosomes_fh[chromosome].write(alignment2)
-            chromosomes_fh[chromosome].write(os.linesep)
-
-    # close all open file handles
-    for key, value in chromosomes_fh.items():
-        chromosomes_fh[key].close()
+    # parse the full alignment file
+    metrics.start("split")
+    if options.processes > 1:
+        counts = split_alignment_parallel(
+            options.alignment,
+            options.out,
+            options.processes,
+            options.chunk_size * 1024 * 1024,
+            options.max_open_files
+        )
+    else:
+        with open_alignment(options.alignment) as fp:
+            counts = split_alignment(fp, options.out, max_open=options.max_open_files)
+    metrics.count(sum(counts.values()))
+
+    # group tiny contigs into one file
+    if options.group_contigs > 0:
+        metrics.start("group_contigs")
+        for chromosome in group_contigs(options.out, counts, options.group_contigs):
+            del counts[chromosome]
+            metrics.count(1)
+
+    # index the reference intervals of each chromosome file
+    # and/or store its blocks as numpy columns
+    post_processing = []
+    if options.index:
+        post_processing.append(("index", axt_index.index_chromosome))
+    if options.columnar:
+        import axt_columns
+        post_processing.append(("columns", axt_columns.write_columns))
+
+    axt_paths = [os.path.join(options.out, chromosome + '.axt') for chromosome in counts]
+    for phase, function in post_processing:
+        metrics.start(phase)
+        metrics.count(len(axt_paths))
+        if options.processes > 1:
+            with ProcessPoolExecutor(max_workers=options.processes) as executor:
+                list(executor.map(function, axt_paths))
+        else:
+            for axt_path in axt_paths:
+                function(axt_path)
 
     # touch file that script is complete
-    w = open(os.path.join(options.out, 'Done'), 'w')
-    w.write("Done" + os.linesep)
-    w.close()
+    write_done(options.out)
+    metrics.close()
 
 
 # _____________________________________________________________________________
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Persistent cache of the alignments of transcripts, shared between runs
+
+The cache is an SQLite database with one row per transcript key and kind of
+result: the groups of the transcript in the assembled alignments (mln) and
+its blocks in the final alignments (pgln), zlib compressed. The key of a
+transcript is the hash of its match.tab rows, its sequence, the reference
+and the aligned assemblies (see rg_split_match_tab.py --keys), so a
+transcript is only taken from the cache if it would be aligned in the same
+way again.
+
+rg_split_match_tab.py --cache leaves the cached transcripts out of the
+batches, this script concatenates the batch results of a run, adds the new
+transcripts to the cache and appends the cached ones.
+"""
+
+# imports
+import os
+import sys
+import zlib
+import sqlite3
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import newick
+import run_metrics
+import alignment_index
+from alignment_index import iter_groups
+
+KINDS = ("mln", "pgln")
+
+# number of keys per query, below the limit of host parameters of sqlite
+QUERY_SIZE = 500
+
+class CacheError(Exception):
+    """Raised when a transcript expected in the cache is not there"""
+    pass
+
+
+class TranscriptCache(object):
+    """Key/value store of the results of transcripts in an SQLite database
+
+    Several runs may use the cache at the same time, writers wait up to
+    timeout seconds for each other.
+
+    """
+    def __init__(self, path, timeout=600):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                                    "key TEXT NOT NULL, kind TEXT NOT NULL, data BLOB NOT NULL, "
+                                    "PRIMARY KEY (key, kind))")
+
+    def cached(self, keys, kinds=KINDS):
+        """Subset of keys with results of all kinds in the cache"""
+        keys = list(keys)
+        counts = {}
+        for i in range(0, len(keys), QUERY_SIZE):
+            chunk = keys[i:i + QUERY_SIZE]
+            query = ("SELECT key, COUNT(*) FROM results WHERE kind IN (%s) AND key IN (%s) GROUP BY key"
+                     % (",".join("?" * len(kinds)), ",".join("?" * len(chunk))))
+            for key, count in self.connection.execute(query, list(kinds) + chunk):
+                counts[key] = count
+        return set(key for key, count in counts.items() if count == len(kinds))
+
+    def get(self, key, kind):
+        """Result of one kind of a transcript, None if it is not cached"""
+        row = self.connection.execute("SELECT data FROM results WHERE key = ? AND kind = ?",
+                                      (key, kind)).fetchone()
+        return zlib.decompress(row[0]) if row is not None else None
+
+    def put(self, items, kind):
+        """Add or replace (key, result) items of one kind in one transaction"""
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO results (key, kind, data) VALUES (?, ?, ?)",
+                                        ((key, kind, zlib.compress(data, 1)) for key, data in items))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def assembly_signature(reference, organisms, assemblies):
+    """Reference and assembly of each organism, e.g. hg38|mm=mm39,rn=rn7
+
+    :param organisms: organisms in the order of the alignments
+    :param assemblies: assemblies of the organisms (assemblies.txt)
+
+    """
+    versions = dict((newick.assembly_name(assembly), assembly) for assembly in assemblies)
+    return "%s|%s" % (reference, ",".join("%s=%s" % (organism, versions.get(organism, organism))
+                                          for organism in organisms))
+
+
+def read_assemblies(path):
+    """Assemblies of a comma separated assemblies.txt file"""
+    with open(path) as fp:
+        return [x.strip() for x in fp.read().split(',') if x.strip()]
+
+
+def write_keys(path, keys, cached=()):
+    """Write the cache key of each gene and whether it is cached"""
+    with open(path + ".tmp", 'w') as out:
+        out.write("gene\tkey\tcached\n")
+        for gene, key in keys:
+            out.write("%s\t%s\t%i\n" % (gene, key, gene in cached))
+    os.rename(path + ".tmp", path)
+
+
+def read_keys(path):
+    """Read a file of write_keys as a list of (gene, key, cached)"""
+    with open(path) as fh:
+        next(fh)
+        return [(gene, key, cached == "1")
+                for gene, key, cached in (line.rstrip("\n").split("\t") for line in fh)]
+
+
+def copy_lines(fh, out, written):
+    """Yield the lines of fh while copying them to out, counting the bytes in written[0]"""
+    for line in fh:
+        out.write(line)
+        written[0] += len(line)
+        yield line
+
+
+def concatenate(inputs, output, kind, anchor="", keys=(), cache=None, index=None):
+    """Concatenate the results of the batches of a run, add them to the cache
+    and append the results of the cached transcripts
+
+    :param keys: list of (gene, key, cached) of rg_split_match_tab.py --keys
+    :param index: alignment_index.IndexWriter to add the groups to
+    :returns: number of transcripts stored and taken from the cache
+
+    """
+    fresh = dict((gene, key) for gene, key, cached in keys if not cached)
+    stored = 0
+    taken = 0
+    written = [0]
+    with open(output, 'wb') as out:
+        for path in inputs:
+            results = {}
+            with open(path, 'rb') as fh:
+                for name, data in iter_groups(copy_lines(fh, out, written), kind, anchor):
+                    # transcripts on several chromosomes have several groups
+                    results[name] = results.get(name, b"") + data
+                    if index is not None:
+                        index.add(name, written[0] - len(data), data)
+            if cache is not None:
+                items = [(fresh[name], data) for name, data in results.items() if name in fresh]
+                cache.put(items, kind)
+                stored += len(items)
+        if cache is not None:
+            for gene, key, cached in keys:
+                if cached:
+                    data = cache.get(key, kind)
+                    if data is None:
+                        raise CacheError("%s of %s is not in the cache anymore" % (kind, gene))
+                    if index is not None:
+                        position = [written[0]]
+                        for name, group in iter_groups(copy_lines(data.splitlines(True), out, position),
+                                                       kind, anchor):
+                            index.add(name, position[0] - len(group), group)
+                        written[0] = position[0]
+                    else:
+                        out.write(data)
+                        written[0] += len(data)
+                    taken += 1
+    return stored, taken
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0] + os.linesep +
+                            "Concatenate the results of the batches of a run with the cached results",
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument("inputs",
+                        nargs="*",
+                        help="Results of the batches")
+    parser.add_argument("--kind",
+                        dest="kind",
+                        choices=KINDS,
+                        required=True,
+                        help="Kind of results")
+    parser.add_argument("--output",
+                        dest="output",
+                        required=True,
+                        help="Concatenated results")
+    parser.add_argument("--anchor",
+                        dest="anchor",
+                        default="",
+                        help="Anchor (reference) assembly, prefix of the ids in pgln files")
+    parser.add_argument("--keys",
+                        dest="keys",
+                        default=None,
+                        help="Cache keys of the genes written by rg_split_match_tab.py --keys")
+    parser.add_argument("--index",
+                        dest="index",
+                        default=None,
+                        help="Also write the offset index of the concatenated results\n"
+                             "(see alignment_index.py) to this file")
+    parser.add_argument("--db",
+                        dest="db",
+                        default=None,
+                        help="Cache database, the inputs are only concatenated if not given")
+    parser.add_argument("-v",
+                        "--verbose",
+                        dest="verbose",
+                        action="store_true",
+                        default=False,
+                        help="Be loud!")
+    run_metrics.add_argument(parser)
+    options = parser.parse_args()
+
+    metrics = run_metrics.Metrics(options.metrics)
+    index = None
+    if options.index is not None:
+        index = alignment_index.IndexWriter(options.kind, options.anchor)
+
+    metrics.start("concatenate")
+    metrics.count(len(options.inputs))
+    if options.db is None:
+        concatenate(options.inputs, options.output, options.kind, options.anchor, index=index)
+    else:
+        if options.keys is None:
+            parser.error("--db needs --keys")
+        with TranscriptCache(options.db) as cache:
+            try:
+                stored, taken = concatenate(options.inputs, options.output, options.kind,
+                                            options.anchor, read_keys(options.keys), cache, index)
+            except CacheError as e:
+                sys.stderr.write("%s\n" % e)
+                sys.exit(1)
+    if index is not None:
+        metrics.start("index")
+        index.write(options.index, os.path.getsize(options.output))
+        metrics.count(len(index.entries))
+    metrics.close()
+    if options.verbose and options.db is not None:
+        sys.stderr.write("Cached %i new transcripts, took %i from the cache\n" % (stored, taken))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.stderr.write("Interrupted by user\n")
+        sys.exit(1)
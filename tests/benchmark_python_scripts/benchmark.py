@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+"""
+Benchmark the Python scripts of the workflow on synthetic inputs
+
+The inputs are generated offline with a fixed seed, at several scales:
+net.axt pairwise alignments over chromosomes and many small scaffolds,
+GMAP-style PSL lines of multi-exon transcripts, the match.tab rows of the
+same kind of transcripts and an mln file with the alignments of each
+transcript to several organisms. Each script is run on each scale in a
+separate process and its wall time, CPU time and peak RSS are reported
+together with the throughput (records/s, MB/s) in one JSON document.
+
+Linux carries the peak RSS of a parent over to the children it starts, so
+the inputs are generated in a worker process and the peak RSS of a process
+doing nothing (rss_floor_mb of the report) is the lower bound of the
+reported values.
+"""
+
+__date__ = "2020-04-06"
+__license__ = "GPL"
+
+# imports
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+# redefine a functions for writing to stdout and stderr to save some writting
+syserr = sys.stderr.write
+sysout = sys.stdout.write
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "docker", "python")
+
+# random bases are sliced out of one pool instead of drawn one by one
+POOL_SIZE = 1024 * 1024
+BASES = "ACGTacgt"
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+Transcript = namedtuple("Transcript", ["name", "chromosome", "size", "strand", "exons"])
+
+Benchmark = namedtuple("Benchmark", ["script", "variant", "input", "arguments"])
+
+# arguments of each run given the input file and an empty output directory
+BENCHMARKS = [
+    Benchmark("split_pairwise_alignments_by_chromosome.py", "default", "axt",
+              lambda inp, out, p: ["--alignment", inp, "--out", out]),
+    Benchmark("split_pairwise_alignments_by_chromosome.py", "processes", "axt",
+              lambda inp, out, p: ["--alignment", inp, "--out", out,
+                                   "--processes", str(p.processes), "--chunk-size", "1"]),
+    Benchmark("split_pairwise_alignments_by_chromosome.py", "group_contigs_index", "axt",
+              lambda inp, out, p: ["--alignment", inp, "--out", out,
+                                   "--group-contigs", "100000", "--index"]),
+    Benchmark("rg_psl_to_match.py", "default", "psl",
+              lambda inp, out, p: ["--input", inp, "--output", os.path.join(out, "match.tab")]),
+    Benchmark("rg_psl_to_match.py", "batches", "psl",
+              lambda inp, out, p: ["--input", inp, "--output-dir", out, "--batch-size", "10"]),
+    Benchmark("rg_split_match_tab.py", "default", "match",
+              lambda inp, out, p: ["--input", inp, "--output-dir", out, "--batch-size", "10"]),
+    Benchmark("rg_split_match_tab.py", "streaming", "match",
+              lambda inp, out, p: ["--input", inp, "--output-dir", out, "--batch-size", "10",
+                                   "--streaming"]),
+    Benchmark("rg_split_match_tab.py", "by_chromosome", "match",
+              lambda inp, out, p: ["--input", inp, "--output-dir", out, "--batch-size", "10",
+                                   "--by-chromosome"]),
+    Benchmark("rg_split_match_tab.py", "incremental", "match",
+              lambda inp, out, p: ["--input", inp, "--output-dir", out, "--batch-size", "10",
+                                   "--incremental", "--organisms", ",".join(organism_names(p.organisms))]),
+    Benchmark("rg_divide_alignment_file.py", "default", "mln",
+              lambda inp, out, p: ["--mln", inp, "--output-dir", out]),
+    Benchmark("rg_divide_alignment_file.py", "writers", "mln",
+              lambda inp, out, p: ["--mln", inp, "--output-dir", out, "--writers", str(p.processes)]),
+    Benchmark("rg_divide_alignment_file.py", "store", "mln",
+              lambda inp, out, p: ["--mln", inp, "--output-file", os.path.join(out, "alignments.store")]),
+]
+
+
+class Sequences(object):
+    """Random sequences sliced out of a pool of random bases"""
+
+    def __init__(self, rng, size=POOL_SIZE):
+        self.rng = rng
+        self.pool = "".join(rng.choice(BASES) for i in range(size))
+
+    def bases(self, length):
+        start = self.rng.randrange(len(self.pool) - length)
+        return self.pool[start:start + length]
+
+    def gapped(self, length, gaps):
+        """Sequence of length columns with about gaps gap columns"""
+        sequence = list(self.bases(length))
+        for i in range(gaps):
+            sequence[self.rng.randrange(length)] = "-"
+        return "".join(sequence)
+
+
+def chromosome_names(chromosomes, scaffolds):
+    """Names and sizes of chromosomes chr1.. and of unplaced scaffolds, large to small
+
+    :returns: lists of (name, size) of the chromosomes and of the scaffolds
+
+    """
+    return ([("chr%i" % (i + 1), 250000000 - i * 10000000) for i in range(chromosomes)],
+            [("chrUn_KI27%04iv1" % i, 50000 + 1000 * i) for i in range(scaffolds)])
+
+
+def organism_names(organisms):
+    """Short names of the aligned organisms, like the keys of the tree"""
+    names = ["mm", "rn", "bosTau", "canFam", "galGal", "xenTro", "danRer", "monDom", "panTro", "rheMac"]
+    return (names * (organisms // len(names) + 1))[:organisms]
+
+
+def pick_chromosome(rng, chromosomes):
+    """Chromosome of a record, the scaffolds get one record in a hundred"""
+    placed, scaffolds = chromosomes
+    if scaffolds and (not placed or rng.random() < 0.01):
+        return rng.choice(scaffolds)
+    return rng.choice(placed)
+
+
+def generate_axt(path, records, chromosomes, rng):
+    """Write a net.axt file of records pairwise alignments
+
+    Records have the UCSC header (number, reference chromosome, start, end,
+    aligned chromosome, start, end, strand, score), are sorted by reference
+    chromosome and are 20 to 400 columns long with a few gaps.
+
+    :returns: number of records
+
+    """
+    sequences = Sequences(rng)
+    by_chromosome = {}
+    for i in range(records):
+        name, size = pick_chromosome(rng, chromosomes)
+        by_chromosome[name] = by_chromosome.get(name, 0) + 1
+    with open(path, 'w') as out:
+        out.write("##matrix=axtChain 16 91,-114,-31,-123,-114,100,-125,-31,-31,-125,100,-114,-123,-31,-114,91\n")
+        out.write("##gapPenalties=axtChain O=400 E=30\n")
+        number = 0
+        for name, size in chromosomes[0] + chromosomes[1]:
+            position = 1
+            for i in range(by_chromosome.get(name, 0)):
+                length = rng.randint(20, 400)
+                position += rng.randint(1, max(1, size // (by_chromosome[name] * 2)))
+                gaps = rng.randint(0, length // 20)
+                out.write("%i %s %i %i %s %i %i %s %i\n" % (number, name, position, position + length - gaps - 1,
+                                                           name.replace("chr", "tchr"), position,
+                                                           position + length - gaps - 1, rng.choice("+-"),
+                                                           rng.randint(1000, 40000)))
+                out.write(sequences.gapped(length, gaps) + "\n")
+                out.write(sequences.gapped(length, gaps) + "\n")
+                out.write("\n")
+                position += length
+                number += 1
+    return number
+
+
+def synthetic_transcripts(transcripts, chromosomes, rng):
+    """Yield multi-exon transcripts with exons on the genome and on the transcript"""
+    for i in range(transcripts):
+        name, size = pick_chromosome(rng, chromosomes)
+        exons = []
+        genome = rng.randrange(1, max(2, size - 1000000))
+        position = 0
+        for e in range(rng.randint(1, 12)):
+            length = rng.randint(30, 600)
+            exons.append((genome, position, length))
+            genome += length + rng.randint(100, 20000)
+            position += length
+        yield Transcript("ENST%011i" % i, name, size, rng.choice("+-"), exons)
+
+
+def generate_psl(path, transcripts, chromosomes, rng):
+    """Write GMAP-style PSL lines of multi-exon transcripts, some mapped twice
+
+    :returns: number of PSL lines
+
+    """
+    lines = 0
+    with open(path, 'w') as out:
+        for transcript in synthetic_transcripts(transcripts, chromosomes, rng):
+            for copy in range(2 if rng.random() < 0.05 else 1):
+                exons = transcript.exons
+                matches = sum(length for genome, position, length in exons)
+                out.write("\t".join(map(str, [
+                    matches, 0, 0, 0, 0, 0, len(exons) - 1,
+                    exons[-1][0] - exons[0][0] + exons[-1][2] - matches,
+                    transcript.strand, transcript.name, matches, 0, matches,
+                    transcript.chromosome, transcript.size,
+                    exons[0][0], exons[-1][0] + exons[-1][2], len(exons),
+                    "".join("%i," % length for genome, position, length in exons),
+                    "".join("%i," % position for genome, position, length in exons),
+                    "".join("%i," % genome for genome, position, length in exons)])) + "\n")
+                lines += 1
+    return lines
+
+
+def generate_match_tab(path, transcripts, chromosomes, rng):
+    """Write the match.tab rows (one per exon) of multi-exon transcripts
+
+    :returns: number of rows
+
+    """
+    rows = 0
+    with open(path, 'w') as out:
+        for transcript in synthetic_transcripts(transcripts, chromosomes, rng):
+            for exon, (genome, position, length) in enumerate(transcript.exons):
+                out.write("%s.%i\t%s\t%i\t%i\t%s\t%i\t%i\n" % (transcript.name, exon + 1, transcript.chromosome,
+                                                             genome + 1, genome + length, transcript.strand,
+                                                             position + 1, position + length))
+                rows += 1
+    return rows
+
+
+def generate_mln(path, transcripts, organisms, rng):
+    """Write an mln file with the alignments of each transcript to the organisms
+
+    :returns: number of transcripts
+
+    """
+    sequences = Sequences(rng)
+    names = organism_names(organisms)
+    with open(path, 'w') as out:
+        for i in range(transcripts):
+            name = "ENST%011i" % i
+            length = rng.randint(200, 5000)
+            for organism in names:
+                gaps = rng.randint(0, length // 10)
+                out.write(">%s %s\n%s\n%s\n" % (name, organism, sequences.gapped(length, gaps),
+                                               sequences.gapped(length, gaps)))
+            out.write("\n")
+    return transcripts
+
+
+def generate_inputs(directory, scale, options):
+    """Generate the inputs of one scale
+
+    :returns: dictionary input kind -> (path, number of records, kind of records)
+
+    """
+    rng = random.Random("%s-%s" % (options.seed, scale))
+    chromosomes = chromosome_names(options.chromosomes, options.scaffolds)
+    inputs = {}
+    path = os.path.join(directory, "net.axt")
+    inputs["axt"] = (path, generate_axt(path, options.axt_records * scale, chromosomes, rng), "axt records")
+    path = os.path.join(directory, "gmap.psl")
+    inputs["psl"] = (path, generate_psl(path, options.transcripts * scale, chromosomes, rng), "psl lines")
+    path = os.path.join(directory, "match.tab")
+    inputs["match"] = (path, generate_match_tab(path, options.transcripts * scale, chromosomes, rng), "exons")
+    path = os.path.join(directory, "alignments.mln")
+    inputs["mln"] = (path, generate_mln(path, options.mln_transcripts * scale, options.organisms, rng),
+                     "transcripts")
+    return inputs
+
+
+def run_measured(command, log):
+    """Run a command and measure it
+
+    :returns: exit status, wall seconds and the resource usage of the process and its children
+
+    """
+    with open(log, 'w') as err:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=err)
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return process.returncode, wall, usage
+
+
+def run_benchmark(benchmark, inputs, directory, scale, options):
+    """Run one benchmark options.repeats times, keep the fastest run"""
+    path, records, unit = inputs[benchmark.input]
+    size = os.path.getsize(path)
+    name = "%s_%s" % (os.path.splitext(benchmark.script)[0], benchmark.variant)
+    out = os.path.join(directory, name)
+    log = os.path.join(directory, name + ".log")
+    command = [sys.executable, os.path.join(options.scripts, benchmark.script)] + \
+        benchmark.arguments(path, out, options)
+
+    runs = []
+    for i in range(options.repeats):
+        if os.path.exists(out):
+            shutil.rmtree(out)
+        os.makedirs(out)
+        status, wall, usage = run_measured(command, log)
+        if status != 0:
+            with open(log) as fh:
+                return {"script": benchmark.script, "variant": benchmark.variant, "scale": scale,
+                        "command": command, "returncode": status, "error": fh.read()[-2000:]}
+        runs.append((wall, usage.ru_utime + usage.ru_stime, usage.ru_maxrss * RSS_UNIT))
+    wall, cpu, rss = min(runs)
+
+    return {"script": benchmark.script,
+            "variant": benchmark.variant,
+            "scale": scale,
+            "command": command,
+            "returncode": 0,
+            "records": records,
+            "record_unit": unit,
+            "input_bytes": size,
+            "wall_seconds": round(wall, 4),
+            "wall_seconds_all": [round(r[0], 4) for r in runs],
+            "cpu_seconds": round(cpu, 4),
+            "peak_rss_mb": round(rss / 1024.0 / 1024.0, 1),
+            "records_per_second": round(records / wall, 1),
+            "mb_per_second": round(size / 1024.0 / 1024.0 / wall, 2)}
+
+
+def main():
+    parser = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    parser.add_argument("-v",
+                        "--verbose",
+                        dest="verbose",
+                        action="store_true",
+                        default=False,
+                        help="Be loud!")
+    parser.add_argument("--output",
+                        dest="output",
+                        default="-",
+                        help="JSON report, defaults to stdout")
+    parser.add_argument("--work-dir",
+                        dest="work_dir",
+                        default="results",
+                        help="Directory of the inputs and outputs, defaults to results")
+    parser.add_argument("--scripts",
+                        dest="scripts",
+                        default=SCRIPTS,
+                        help="Directory of the scripts, defaults to docker/python of the repository")
+    parser.add_argument("--scales",
+                        dest="scales",
+                        default="1,4",
+                        help="Comma separated multipliers of the input sizes, defaults to 1,4")
+    parser.add_argument("--only",
+                        dest="only",
+                        default="",
+                        help="Comma separated scripts or script:variant to run, defaults to all")
+    parser.add_argument("--repeats",
+                        dest="repeats",
+                        type=int,
+                        default=1,
+                        help="Number of runs of each benchmark, the fastest is reported. Defaults to 1")
+    parser.add_argument("--processes",
+                        dest="processes",
+                        type=int,
+                        default=4,
+                        help="Processes or threads of the parallel variants, defaults to 4")
+    parser.add_argument("--seed",
+                        dest="seed",
+                        type=int,
+                        default=1,
+                        help="Seed of the generated inputs, defaults to 1")
+    parser.add_argument("--axt-records",
+                        dest="axt_records",
+                        type=int,
+                        default=50000,
+                        help="Pairwise alignments in net.axt at scale 1, defaults to 50000")
+    parser.add_argument("--chromosomes",
+                        dest="chromosomes",
+                        type=int,
+                        default=22,
+                        help="Number of chromosomes, defaults to 22")
+    parser.add_argument("--scaffolds",
+                        dest="scaffolds",
+                        type=int,
+                        default=200,
+                        help="Number of small unplaced scaffolds, defaults to 200")
+    parser.add_argument("--transcripts",
+                        dest="transcripts",
+                        type=int,
+                        default=10000,
+                        help="Transcripts of the PSL and match.tab files at scale 1, defaults to 10000")
+    parser.add_argument("--mln-transcripts",
+                        dest="mln_transcripts",
+                        type=int,
+                        default=1000,
+                        help="Transcripts of the mln file at scale 1, defaults to 1000")
+    parser.add_argument("--organisms",
+                        dest="organisms",
+                        type=int,
+                        default=5,
+                        help="Organisms aligned to each transcript in the mln file, defaults to 5")
+    parser.add_argument("--keep",
+                        dest="keep",
+                        action="store_true",
+                        default=False,
+                        help="Keep the generated inputs and the outputs of the scripts")
+    options = parser.parse_args()
+
+    scales = [int(x) for x in options.scales.split(",") if x]
+    only = [x for x in options.only.split(",") if x]
+    benchmarks = [b for b in BENCHMARKS
+                  if not only or any(x in (b.script, os.path.splitext(b.script)[0],
+                                           "%s:%s" % (os.path.splitext(b.script)[0], b.variant)) for x in only)]
+    if not benchmarks:
+        parser.error("--only does not match any benchmark")
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpu_count": os.cpu_count(),
+              "parameters": dict((k, v) for k, v in vars(options).items() if k not in ("output", "verbose")),
+              "results": []}
+    report["rss_floor_mb"] = round(run_measured(["true"], os.devnull)[2].ru_maxrss * RSS_UNIT / 1024.0 / 1024.0, 1)
+    failed = 0
+    for scale in scales:
+        directory = os.path.join(options.work_dir, "scale_%i" % scale)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        start = time.perf_counter()
+        # generate the inputs in a worker to keep the peak RSS of this process low
+        with ProcessPoolExecutor(1) as executor:
+            inputs = executor.submit(generate_inputs, directory, scale, options).result()
+        if options.verbose:
+            syserr("Generated the inputs of scale %i in %.1f s\n" % (scale, time.perf_counter() - start))
+        for benchmark in benchmarks:
+            result = run_benchmark(benchmark, inputs, directory, scale, options)
+            report["results"].append(result)
+            if result["returncode"] != 0:
+                failed += 1
+                syserr("%s %s failed at scale %i:\n%s\n" % (benchmark.script, benchmark.variant, scale,
+                                                           result["error"]))
+            elif options.verbose:
+                syserr("%-45s %-20s x%-3i %8.2f s %8.1f MB %10.0f %s/s %7.2f MB/s\n"
+                       % (benchmark.script, benchmark.variant, scale, result["wall_seconds"],
+                          result["peak_rss_mb"], result["records_per_second"], result["record_unit"],
+                          result["mb_per_second"]))
+        if not options.keep:
+            shutil.rmtree(directory)
+
+    text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if options.output == "-":
+        sysout(text)
+    else:
+        with open(options.output, 'w') as out:
+            out.write(text)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        syserr("Interrupted by user\n")
+        sys.exit(1)
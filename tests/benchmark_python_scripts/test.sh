@@ -0,0 +1,27 @@
+#!/bin/bash
+
+# Tear down test environment
+cleanup () {
+    rc=$?
+    cd $user_dir
+    echo "Exit status: $rc"
+}
+trap cleanup EXIT
+
+# Set up test environment
+set -eo pipefail  # ensures that script exits at first command that exits with non-zero status
+set -u  # ensures that script exits when unset variables are used
+set -x  # facilitates debugging by printing out executed commands
+user_dir=$PWD
+script_dir="$(cd "$(dirname "${BASH_SOURCE[0]}")" >/dev/null 2>&1 && pwd)"
+cd $script_dir
+
+# Run benchmarks on generated inputs, no downloads needed
+# (see python benchmark.py --help for the input sizes, scales and scripts)
+mkdir -p results
+python benchmark.py \
+    --work-dir="results" \
+    --scales="1,4" \
+    --output="results/benchmark.json" \
+    --verbose \
+    "$@"
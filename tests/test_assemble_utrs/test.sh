@@ -0,0 +1,36 @@
+#!/bin/bash
+
+# Tear down test environment
+cleanup () {
+    rc=$?
+    rm -rf results/
+    cd $user_dir
+    echo "Exit status: $rc"
+}
+trap cleanup EXIT
+
+# Set up test environment
+set -eo pipefail  # ensures that script exits at first command that exits with non-zero status
+set -u  # ensures that script exits when unset variables are used
+set -x  # facilitates debugging by printing out executed commands
+user_dir=$PWD
+script_dir="$(cd "$(dirname "${BASH_SOURCE[0]}")" >/dev/null 2>&1 && pwd)"
+cd $script_dir
+
+# The expected files were written by assembleUTRsFromPairwiseConsMultiRemovedComments.pl
+# and mergeAssembledUTRs.pl. The inputs hold gapped and overlapping blocks, a
+# block contained in the one before it that ends in gap columns, overlapping
+# exons, a minus strand, a |TR id and a chromosome without alignment file.
+mkdir -p results
+python "../../docker/python/rg_assemble_utrs.py" \
+    "input" \
+    "hg38" \
+    "mm,rn" \
+    "input/regions.tab" \
+    "results" \
+    --mln="results/alignments.mln" \
+    2> "results/stderr.txt"
+diff "results/hg38_Reg-to-mm_a1.aln" "expected/hg38_Reg-to-mm_a1.aln"
+diff "results/hg38_Reg-to-rn_a2.aln" "expected/hg38_Reg-to-rn_a2.aln"
+diff "results/alignments.mln" "expected/alignments.mln"
+diff "results/stderr.txt" "expected/stderr.txt"
@@ -0,0 +1,65 @@
+#!/bin/bash
+
+# Tear down test environment
+cleanup () {
+    rc=$?
+    rm -rf results/
+    cd $user_dir
+    echo "Exit status: $rc"
+}
+trap cleanup EXIT
+
+# Set up test environment
+set -eo pipefail  # ensures that script exits at first command that exits with non-zero status
+set -u  # ensures that script exits when unset variables are used
+set -x  # facilitates debugging by printing out executed commands
+user_dir=$PWD
+script_dir="$(cd "$(dirname "${BASH_SOURCE[0]}")" >/dev/null 2>&1 && pwd)"
+cd $script_dir
+scripts="../../docker/python"
+
+# Alignments of 3000 transcripts with regions on two chromosomes, each
+# transcript has two groups in the mln file and its file must hold the last
+mkdir -p results
+python - > results/alignments.mln <<'PYTHON'
+for i in range(3000):
+    for unit in ("ACGT", "TTGA"):
+        for organism in ("hg38", "mm10", "rn6"):
+            print(">ENST%011i %s" % (i, organism))
+            print(unit * (10 + i % 50))
+            print((unit[:2] + "-" + unit[3]) * (10 + i % 50))
+        print()
+PYTHON
+
+# Write the transcripts sequentially and with several writers
+python "${scripts}/rg_divide_alignment_file.py" \
+    --mln="results/alignments.mln" \
+    --output-dir="results/writers_1" \
+    --writers=1
+python "${scripts}/rg_divide_alignment_file.py" \
+    --mln="results/alignments.mln" \
+    --output-dir="results/writers_4" \
+    --writers=4
+python "${scripts}/rg_divide_alignment_file.py" \
+    --mln="results/alignments.mln" \
+    --output-dir="results/writers_4_fanout" \
+    --writers=4 \
+    --fanout=1
+
+# Check that every file holds the last group of its transcript
+test "$(ls results/writers_1 | wc -l)" -eq 3000
+diff -r "results/writers_1" "results/writers_4"
+PYTHONPATH="${scripts}" python - "results" <<'PYTHON'
+import os
+import sys
+import pickle
+from rg_divide_alignment_file import transcript_path
+
+results = sys.argv[1]
+for i in range(3000):
+    name = "ENST%011i" % i
+    for directory, fanout in (("writers_1", 0), ("writers_4", 0), ("writers_4_fanout", 1)):
+        with open(transcript_path(os.path.join(results, directory), name, fanout), 'rb') as fh:
+            value = pickle.load(fh)
+        assert value["hg38"][0] == "TTGA" * (10 + i % 50), (directory, name)
+PYTHON
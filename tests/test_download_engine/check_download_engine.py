@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Check download_engine.py against a local HTTP server with Range support:
+resumed and interrupted downloads, 416 responses to complete and outdated
+partial files, checksum mismatches, reuse of the cache and missing files
+"""
+
+# imports
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+from argparse import ArgumentParser
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import download_engine
+from download_engine import DownloadError, PART_SUFFIX, download, download_all
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    """Serve the files of a dictionary path -> bytes and record the requests
+
+    A path in truncate is served only up to the given number of bytes once,
+    like a connection that drops in the middle of the download.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.files = {}
+        self.truncate = {}
+        self.requests = []
+
+    def url(self, path):
+        return "http://127.0.0.1:%i%s" % (self.server_address[1], path)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%i" % len(data))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %i-%i/%i" % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        end = self.server.truncate.pop(self.path, len(data))
+        self.wfile.write(data[start:end])
+
+    def log_message(self, *args):
+        pass
+
+
+def content(size, seed):
+    """Deterministic bytes that differ between seeds"""
+    block = hashlib.sha256(str(seed).encode()).digest()
+    return (block * (size // len(block) + 1))[:size]
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+    sys.stdout.write("ok: %s\n" % message)
+
+
+def read(path):
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+
+def run_checks(server, work):
+    data = content(3 * download_engine.BLOCK_SIZE + 12345, 1)
+    server.files["/hg38/a.axt.gz"] = data
+    server.files["/hg38/md5sum.txt"] = ("%s  a.axt.gz\n%s  b.axt.gz\n"
+                                        % (hashlib.md5(data).hexdigest(), "0" * 32)).encode()
+    server.files["/hg38/b.axt.gz"] = content(1000, 2)
+    url = server.url("/hg38/a.axt.gz")
+    cache = os.path.join(work, "cache")
+
+    # full download, stored in the cache
+    destination = os.path.join(work, "full", "a.axt.gz")
+    download(url, destination, cache, hashlib.md5(data).hexdigest())
+    check(read(destination) == data, "download of the whole file")
+    check(not os.path.exists(destination + PART_SUFFIX), "no partial file is left")
+
+    # resume a partial file with a Range request
+    destination = os.path.join(work, "resume", "a.axt.gz")
+    os.makedirs(os.path.dirname(destination))
+    with open(destination + PART_SUFFIX, 'wb') as fh:
+        fh.write(data[:100000])
+    del server.requests[:]
+    download(url, destination)
+    check(server.requests == [("/hg38/a.axt.gz", "bytes=100000-")], "partial file resumed from its end")
+    check(read(destination) == data, "resumed file is complete")
+
+    # a dropped connection is resumed by the next attempt
+    destination = os.path.join(work, "dropped", "a.axt.gz")
+    server.truncate["/hg38/a.axt.gz"] = 2000000
+    del server.requests[:]
+    download(url, destination, retries=2)
+    check([r for p, r in server.requests] == [None, "bytes=2000000-"], "dropped download resumed by the retry")
+    check(read(destination) == data, "dropped download is complete")
+
+    # 416 to a partial file that is already complete
+    destination = os.path.join(work, "complete", "a.axt.gz")
+    os.makedirs(os.path.dirname(destination))
+    with open(destination + PART_SUFFIX, 'wb') as fh:
+        fh.write(data)
+    download(url, destination)
+    check(read(destination) == data, "complete partial file accepted on 416")
+
+    # 416 to a partial file longer than the remote file, which was replaced
+    destination = os.path.join(work, "replaced", "a.axt.gz")
+    os.makedirs(os.path.dirname(destination))
+    with open(destination + PART_SUFFIX, 'wb') as fh:
+        fh.write(content(len(data) + 5000, 3))
+    del server.requests[:]
+    download(url, destination)
+    check([r for p, r in server.requests] == ["bytes=%i-" % (len(data) + 5000), None],
+          "outdated partial file downloaded again on 416")
+    check(read(destination) == data, "outdated partial file replaced")
+
+    # checksum mismatch
+    destination = os.path.join(work, "mismatch", "a.axt.gz")
+    try:
+        download(url, destination, expected_md5="0" * 32, retries=2)
+        failed = False
+    except DownloadError:
+        failed = True
+    check(failed, "checksum mismatch raises DownloadError")
+    check(not os.path.exists(destination), "file with a wrong checksum is removed")
+    failures = download_all([(server.url("/hg38/b.axt.gz"), os.path.join(work, "mismatch", "b.axt.gz"))],
+                            threads=2, verify_md5=True, retries=1)
+    check(len(failures) == 1 and "Checksum mismatch" in str(failures[0][1]),
+          "checksum mismatch against md5sum.txt reported by download_all")
+
+    # cached files are not downloaded again
+    del server.requests[:]
+    destination = os.path.join(work, "cached", "a.axt.gz")
+    failures = download_all([(url, destination)], cache_dir=cache, verify_md5=True)
+    check(not failures and read(destination) == data, "file taken from the cache")
+    check(server.requests == [], "no request for a cached file")
+
+    # missing files are not retried
+    del server.requests[:]
+    try:
+        download(server.url("/hg38/missing.axt.gz"), os.path.join(work, "missing", "c.axt.gz"), retries=3)
+        failed = False
+    except DownloadError:
+        failed = True
+    check(failed and len(server.requests) == 1, "404 raises DownloadError without retrying")
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--work-dir",
+                        dest="work_dir",
+                        default=None,
+                        help="Directory for the downloads, a temporary directory if not given")
+    options = parser.parse_args()
+
+    work = options.work_dir or tempfile.mkdtemp()
+    if os.path.exists(work):
+        shutil.rmtree(work)
+    os.makedirs(work)
+    server = Server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        run_checks(server, work)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if options.work_dir is None:
+            shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()